@@ -0,0 +1,172 @@
+"""
+CoreMQ
+------
+A pure-Python messaging queue.
+
+License
+-------
+The MIT License (MIT)
+Copyright (c) 2015 Ross Peoples <ross.peoples@gmail.com>
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from eventloop import get_event_loop
+import socket
+import time
+
+
+class HostnameResolver(object):
+    """
+    Reverse DNS lookups for connecting clients, run in a thread pool so that a slow resolver never blocks the event
+    loop. Names are cached for ttl seconds and failed lookups for negative_ttl seconds, so the clients of a host
+    reconnecting together after a restart cause a single lookup.
+    """
+    def __init__(self, ttl=300.0, negative_ttl=60.0, max_size=10000, threads=4):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self.threads = threads
+        self.cache = OrderedDict()  # IP address to (expiry time, hostname or None), oldest first
+        self.pending = dict()  # IP address to the future of the lookup in progress
+        self.executor = None  # created on first use, so that each worker process has its own threads
+
+    def __len__(self):
+        return len(self.cache)
+
+    def cached(self, ip):
+        """
+        :param ip: The IP address
+        :return: The cached hostname, or None if it is not known yet or the lookup failed
+        """
+        entry = self.cache.get(ip)
+        if entry is not None and entry[0] > time.monotonic():
+            return entry[1]
+
+        return None
+
+    def resolve(self, ip):
+        """
+        Looks up the hostname of an IP address, unless it is cached or already being looked up
+        :param ip: The IP address
+        :return: Future - the hostname, or None if the address has none
+        """
+        future = self.pending.get(ip)
+        if future is not None:
+            return future
+
+        loop = get_event_loop()
+        entry = self.cache.get(ip)
+        if entry is not None and entry[0] > time.monotonic():
+            future = loop.create_future()
+            future.set_result(entry[1])
+            return future
+
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.threads)
+
+        future = loop.run_in_executor(self.executor, self.lookup, ip)
+        future.add_done_callback(lambda f: self.resolved(ip, f))
+        self.pending[ip] = future
+        return future
+
+    @staticmethod
+    def lookup(ip):
+        try:
+            return socket.gethostbyaddr(ip)[0]
+        except OSError:
+            return None
+
+    def resolved(self, ip, future):
+        del self.pending[ip]
+        if future.cancelled() or future.exception() is not None:
+            return
+
+        hostname = future.result()
+        self.cache.pop(ip, None)
+        self.cache[ip] = (time.monotonic() + (self.ttl if hostname else self.negative_ttl), hostname)
+        while len(self.cache) > self.max_size:
+            self.cache.popitem(last=False)
+
+
+class AdmissionLimiter(object):
+    """
+    Token bucket limiting how many new connections are admitted per second. A connection over the limit stays
+    accepted but is not welcomed, and nothing is read from it, until its turn comes, so that thousands of clients
+    reconnecting at once do not hold up the messages of the clients already connected.
+    """
+    def __init__(self, rate=0.0, burst=0):
+        """
+        :param rate: Connections admitted per second, 0 admits every connection right away
+        :param burst: Connections that can be admitted at once after a quiet period, default one second's worth
+        """
+        self.rate = rate
+        self.burst = burst or max(rate, 1)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.waiting = deque()  # callbacks of the connections waiting to be admitted
+        self.timer = None
+
+    def __len__(self):
+        return len(self.waiting)
+
+    def admit(self, callback):
+        """
+        Calls callback once the connection may be admitted
+        :return: bool - True if callback was called right away
+        """
+        if not self.rate:
+            callback()
+            return True
+
+        self.refill()
+        if self.tokens >= 1 and not self.waiting:
+            self.tokens -= 1
+            callback()
+            return True
+
+        self.waiting.append(callback)
+        self.schedule()
+        return False
+
+    def cancel(self, callback):
+        """
+        Stops waiting to admit a connection that closed before its turn came
+        """
+        try:
+            self.waiting.remove(callback)
+        except ValueError:
+            pass
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def schedule(self):
+        if self.timer is None and self.waiting:
+            self.timer = get_event_loop().call_later(max(1 - self.tokens, 0) / self.rate, self.admit_waiting)
+
+    def admit_waiting(self):
+        self.timer = None
+        self.refill()
+        while self.waiting and self.tokens >= 1:
+            self.tokens -= 1
+            self.waiting.popleft()()
+
+        self.schedule()
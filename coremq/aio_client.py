@@ -24,15 +24,34 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
-from common import construct_message, get_logger, load_configuration, validate_header
-import json
+try:
+    from .common import construct_message, decode_message, get_logger, load_configuration, negotiate_codec, \
+        negotiate_protocol, validate_queue, ConnectionClosed, FrameParser, ResponseError, JSON_CODEC, PROTOCOL_V1, \
+        PROTOCOL_V2, str_type
+    from .eventloop import get_event_loop
+    from .topics import is_pattern, validate_pattern, validate_topic, TopicTrie
+except ImportError:
+    # imported by the servers, which run from the coremq directory
+    from common import construct_message, decode_message, get_logger, load_configuration, negotiate_codec, \
+        negotiate_protocol, validate_queue, ConnectionClosed, FrameParser, ResponseError, JSON_CODEC, PROTOCOL_V1, \
+        PROTOCOL_V2, str_type
+    from eventloop import get_event_loop
+    from topics import is_pattern, validate_pattern, validate_topic, TopicTrie
+from collections import deque
+import asyncio
+import itertools
 import socket
-import trollius as asyncio
+
+# What a full Subscription does with another message. Reading from the server never stops, since acknowledgements and
+# replies arrive on the same connection as messages.
+OVERFLOW_DROP_OLDEST = 'drop_oldest'  # discard the oldest message held to make room
+OVERFLOW_DROP_NEWEST = 'drop_newest'  # discard the new message
+OVERFLOW_POLICIES = (OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_NEWEST)
 
 
 class CoreMqClientFactory(object):
     def __init__(self, protocol, servers, port=6747, loop=None,
-                 logger=None, auto_reconnect=True, attempts=1, subscriptions=None):
+                 logger=None, auto_reconnect=True, attempts=1, subscriptions=None, codec=None):
         if not isinstance(servers, (list, tuple)):
             servers = [servers]
 
@@ -40,7 +59,7 @@ class CoreMqClientFactory(object):
         self.port = port
         self.shutting_down = False
         self.protocol = protocol
-        self.loop = loop or asyncio.get_event_loop()
+        self.loop = loop or get_event_loop()
         self.logger = self.get_logger(logger)
         self.connection = None
         self.auto_reconnect = auto_reconnect
@@ -49,6 +68,7 @@ class CoreMqClientFactory(object):
         self.lost_connection_callback = None
         self.connected_once = False
         self.connected_server = None
+        self.codec = codec
 
     def __call__(self, *args, **kwargs):
         return self.protocol(self, loop=self.loop, logger=self.logger, subscriptions=self.initial_subscriptions)
@@ -61,9 +81,7 @@ class CoreMqClientFactory(object):
         c = load_configuration()
         return get_logger(c, 'CoreMQ')
 
-
-    @asyncio.coroutine
-    def connect(self):
+    async def connect(self):
         self.connection = None
         self.connected_server = None
         port = self.port
@@ -73,20 +91,20 @@ class CoreMqClientFactory(object):
 
             for i in range(self.attempts):
                 try:
-                    self.connection = yield asyncio.From(self.loop.create_connection(self, server, port))
+                    self.connection = await self.loop.create_connection(self, server, port)
                     self.connected_server = server
                     break
                 except (OSError, socket.gaierror, socket.herror) as ex:
                     self.connection = None
                     self.connected_server = None
-                    self.logger.warn('Failed to connect to CoreMQ %s: %s. Retrying in 1 second...' % (server, ex))
-                    yield asyncio.From(asyncio.sleep(1))
+                    self.logger.warning('Failed to connect to CoreMQ %s: %s. Retrying in 1 second...', server, ex)
+                    await asyncio.sleep(1)
 
             if self.connection:
                 break
 
         if not self.connection and self.lost_connection_callback and self.connected_once:
-            yield asyncio.From(self.loop.create_task(self.lost_connection_callback()))
+            await self.lost_connection_callback()
         elif self.connection:
             self.connected_once = True
 
@@ -95,45 +113,44 @@ class CoreMqClientFactory(object):
 
 
 class CoreMqClientProtocol(asyncio.Protocol):
+    PREFERRED_PROTOCOL = PROTOCOL_V2
+    PREFERRED_CODEC = JSON_CODEC.name
+
     def __init__(self, factory, loop=None, logger=None, subscriptions=None):
         super(CoreMqClientProtocol, self).__init__()
 
         self.factory = factory
         self.loop = loop or factory.loop
         self.transport = None
-        self.reader = asyncio.StreamReader()
+        self.parser = FrameParser()
+        self.protocol_version = PROTOCOL_V1
+        self.codec = JSON_CODEC
         self.writer = None
         self.uuid = None
         self.logger = factory.get_logger(logger)
         self.subscriptions = subscriptions or []
         self.options = dict()
         self.server = None
-        self.connected_future = asyncio.Future()
+        self.connected_future = self.loop.create_future()
 
     def connection_made(self, transport):
         self.logger.info('Connected to CoreMQ')
         self.transport = transport
-        self.reader.set_transport(transport)
-        self.writer = asyncio.StreamWriter(transport, self, self.reader, self.loop)
+        self.writer = asyncio.StreamWriter(transport, self, None, self.loop)
 
     def data_received(self, data):
-        data = data.decode('utf-8')
-        expected_length, data = validate_header(data)
-
-        if len(data) < expected_length:
-            data += self.reader.readexactly(expected_length - len(data)).decode('utf-8')
+        for queue, message, flags in self.parser.feed(data):
+            if message is not None:
+                self.frame_received(queue, message, flags)
 
-        if len(data) > expected_length:
-            more_data = data[expected_length:]
-            self.loop.call_soon(self.data_received, more_data)
-
-            data = data[:expected_length]
-
-        if ' ' not in data:
-            return None, data
-
-        queue, message = data.split(' ', 1)
-        self._new_message(queue, json.loads(message))
+    def frame_received(self, queue, data, flags=0):
+        """
+        Override this function to handle messages before they are decoded, such as to pass them on as they are
+        :param queue: The name of the queue the message is coming from
+        :param data: The encoded message
+        :param flags: The header flags of the frame, which identify the codec
+        """
+        self._new_message(queue, decode_message(data, flags))
 
     def _new_message(self, queue, message):
         if not self.uuid:
@@ -142,6 +159,13 @@ class CoreMqClientProtocol(asyncio.Protocol):
                 self.server = message['server']
 
             self.uuid = queue
+            protocol = negotiate_protocol(message, self.PREFERRED_PROTOCOL)
+            if protocol != PROTOCOL_V1:
+                codec = negotiate_codec(message, protocol, self.factory.codec or self.PREFERRED_CODEC)
+                self.send_message(self.uuid, dict(coremq_protocol=protocol, coremq_codec=codec.name))
+                self.protocol_version = protocol
+                self.codec = codec
+
             if self.subscriptions:
                 self.subscribe(*self.subscriptions)
 
@@ -150,7 +174,7 @@ class CoreMqClientProtocol(asyncio.Protocol):
 
             self.connected_future.set_result(True)
 
-        self.logger.debug('New message - queue: %s, message: %s' % (queue, message))
+        self.logger.debug('New message - queue: %s, message: %s', queue, message)
         self.new_message(queue, message)
 
     def new_message(self, queue, message):
@@ -162,7 +186,20 @@ class CoreMqClientProtocol(asyncio.Protocol):
         pass
 
     def send_message(self, queue, message):
-        data = construct_message(queue, message)
+        self.write(construct_message(queue, message, self.protocol_version, self.codec))
+
+    def send_batch(self, messages):
+        """
+        Publishes many messages in a single frame, which the server routes in one pass and acknowledges once
+        :param messages: iterable of (queue, message) pairs
+        """
+        return self.send_message(self.uuid, dict(coremq_batch=[[q, m] for q, m in messages]))
+
+    def write(self, data):
+        """
+        Writes an already constructed message to the server
+        :param data: bytes from construct_message
+        """
         self.transport.write(data)
 
     def get_history(self, *queues):
@@ -177,6 +214,18 @@ class CoreMqClientProtocol(asyncio.Protocol):
 
         return self.send_message(self.uuid, dict(coremq_gethistory=queues))
 
+    def set_history_settings(self, pattern, depth=None, max_bytes=None, max_age=None):
+        """
+        Changes how much history the server keeps for the queues matching a pattern
+        :param pattern: Queue name or pattern, matched like subscriptions, such as orders.#
+        :param depth: The number of messages to keep, 0 disables history
+        :param max_bytes: The maximum total size of the messages to keep
+        :param max_age: The maximum age in seconds of the messages to keep
+        """
+        return self.send_message(self.uuid, dict(coremq_history_settings=dict(
+            pattern=pattern, depth=depth, max_bytes=max_bytes, max_age=max_age
+        )))
+
     def subscribe(self, *queues):
         if not queues:
             raise ValueError('Must pass at least one queue name')
@@ -214,12 +263,527 @@ class CoreMqClientProtocol(asyncio.Protocol):
 
     def connection_lost(self, exc):
         if not self.factory.shutting_down and self.factory.auto_reconnect:
-            self.logger.warn('Connection to CoreMQ lost unexpectedly. Attempting to reconnect...')
+            self.logger.warning('Connection to CoreMQ lost unexpectedly. Attempting to reconnect...')
             self.loop.create_task(self.factory.connect())
         elif self.factory.shutting_down:
             self.logger.info('CoreMQ client shut down')
         else:
-            self.logger.warn('Connection to CoreMQ lost unexpectedly. Client is now shut down.')
+            self.logger.warning('Connection to CoreMQ lost unexpectedly. Client is now shut down.')
 
     def close(self):
-        self.factory.shutting_down = True
\ No newline at end of file
+        self.factory.shutting_down = True
+
+
+class ConnectionProtocol(CoreMqClientProtocol):
+    """
+    The protocol behind a Connection. The server answers the frames a client sends on its connection queue in the
+    order they were sent, so every frame gets a future that the matching answer resolves. History can be read from
+    another worker and answered out of order, so it has its own queue of futures.
+    """
+    def __init__(self, connection, factory, loop=None, logger=None, subscriptions=None):
+        super(ConnectionProtocol, self).__init__(factory, loop=loop, logger=logger, subscriptions=connection.queues())
+
+        self.connection = connection
+        self.replies = deque()
+        self.history_replies = deque()
+        self.welcomed = False
+
+    def send_message(self, queue, message):
+        """
+        :return: Future - resolved with the server's answer, or failed with ResponseError if it is an error
+        """
+        data = construct_message(queue, message, self.protocol_version, self.codec)
+        future = self.loop.create_future()
+        if queue == self.uuid and 'coremq_gethistory' in message:
+            self.history_replies.append(future)
+        else:
+            self.replies.append(future)
+
+        self.write(data)
+        return future
+
+    def new_message(self, queue, message):
+        if not self.welcomed:
+            self.welcomed = True
+            self.connection.connected(self)
+            return
+
+        if 'coremq_correlation' in message and 'coremq_replyto' not in message:
+            self.connection.reply_received(message)
+            return
+
+        # messages other clients send to the connection queue carry their sender
+        if queue == self.uuid and 'coremq_sender' not in message:
+            replies = self.history_replies if 'history' in message else self.replies
+            if replies:
+                self.answer(replies.popleft(), message)
+                return
+
+        self.connection.dispatch(queue, message)
+
+    @staticmethod
+    def answer(future, message):
+        if future.done():
+            return
+
+        response = message.get('response', '')
+        if response.startswith('ERROR'):
+            future.set_exception(ResponseError(response))
+        else:
+            future.set_result(message)
+
+    def connection_lost(self, exc):
+        for future in list(self.replies) + list(self.history_replies):
+            if not future.done():
+                future.set_exception(ConnectionClosed('Connection to CoreMQ lost'))
+
+        self.replies.clear()
+        self.history_replies.clear()
+        self.connection.disconnected(self)
+        super(ConnectionProtocol, self).connection_lost(exc)
+
+
+class Subscription(object):
+    """
+    Messages from one or more queues, read with async for as (queue, message) pairs. A subscription holds up to
+    maxsize messages. Once it is full, further messages are handled according to its overflow policy, and requests to
+    a responder are answered with an error so that the requester does not wait for its timeout.
+    """
+    def __init__(self, connection, queues, maxsize, responder=False, overflow=OVERFLOW_DROP_OLDEST):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError('overflow must be one of: %s' % ', '.join(OVERFLOW_POLICIES))
+
+        self.connection = connection
+        self.queues = queues
+        self.maxsize = maxsize
+        self.responder = responder  # True if the subscription receives requests to answer, see Connection.serve
+        self.overflow = overflow
+        self.dropped = 0  # messages discarded, or requests rejected, because the subscription was full
+        self.messages = deque()
+        self.waiter = None
+        self.closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self.messages:
+            if self.closed:
+                raise StopAsyncIteration
+
+            self.waiter = self.connection.loop.create_future()
+            await self.waiter
+
+        return self.messages.popleft()
+
+    def __len__(self):
+        return len(self.messages)
+
+    def put(self, queue, message):
+        if len(self.messages) >= self.maxsize:
+            self.dropped += 1
+            if self.responder:
+                self.connection.reject(message, 'Responder is busy')
+                return
+            elif self.overflow == OVERFLOW_DROP_NEWEST:
+                return
+
+            self.messages.popleft()
+
+        self.messages.append((queue, message))
+        self.wake()
+
+    def wake(self):
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+        self.waiter = None
+
+    def close(self):
+        """
+        Stops receiving messages. Messages already received can still be read.
+        """
+        if not self.closed:
+            self.closed = True
+            self.connection.unsubscribe(self)
+            self.wake()
+
+
+class Connection(object):
+    """
+    A connection to CoreMQ for asyncio applications, which does not need to be subclassed:
+
+        async with Connection('127.0.0.1') as conn:
+            await conn.publish('orders', dict(id=1))
+            async for queue, message in conn.subscribe('orders.#'):
+                ...
+
+    Messages published in the same loop iteration are sent to the server as one batch, and each publish resolves once
+    the server has acknowledged its batch. Requests are answered by the subscriptions returned by serve:
+
+        async for queue, request in conn.serve('prices'):
+            await conn.reply(request, dict(price=10))
+
+        reply = await conn.request('prices', dict(item='apple'), timeout=5)
+    """
+    def __init__(self, servers, port=6747, loop=None, logger=None, codec=None, queue_size=1000, batch_size=500):
+        """
+        :param servers: The CoreMQ server, or list of servers to try in order, optionally with :port
+        :param port: The port of servers given without one
+        :param codec: The name of the codec to negotiate for protocol version 2
+        :param queue_size: The number of messages each subscription holds before its overflow policy applies
+        :param batch_size: The largest number of messages sent in one batch
+        """
+        self.loop = loop or get_event_loop()
+        self.factory = CoreMqClientFactory(self.create_protocol, servers, port=port, loop=self.loop, logger=logger,
+                                           codec=codec)
+        self.factory.lost_connection_callback = self.connection_failed
+        self.protocol = None  # the ConnectionProtocol once the server has welcomed it
+        self.ready = self.loop.create_future()  # resolved while connected
+        self.consumers = dict()  # queue name to the Subscriptions reading from it
+        self.patterns = TopicTrie()  # pattern to the Subscriptions reading from it
+        self.responders = dict()  # queue name to the Subscriptions answering its requests, next in turn first
+        self.subscriptions = set()  # every open Subscription
+        self.requests = dict()  # correlation ID to the future waiting for the reply
+        self.correlation_ids = itertools.count(1)
+        self.pending = []  # (queue, message, future) published but not yet sent
+        self.flush_scheduled = False
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+
+    def create_protocol(self, factory, loop=None, logger=None, subscriptions=None):
+        return ConnectionProtocol(self, factory, loop=loop, logger=logger)
+
+    async def __aenter__(self):
+        return await self.connect()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.close()
+
+    async def connect(self):
+        """
+        :return: Connection - self, once the server has accepted the connection
+        """
+        if self.protocol is not None:
+            return self
+
+        if self.ready.done():
+            self.ready = self.loop.create_future()
+
+        self.factory.shutting_down = False
+        await self.factory.connect()
+        if not self.factory.connection:
+            raise ConnectionClosed('Could not connect to CoreMQ')
+
+        await self.ready
+        return self
+
+    def close(self):
+        self.factory.close()
+        if self.protocol is not None:
+            self.protocol.transport.close()
+            self.protocol = None
+
+        self.fail_pending(ConnectionClosed('Connection closed'))
+        for sub in list(self.subscriptions):
+            sub.closed = True
+            sub.wake()
+
+    def connected(self, protocol):
+        self.protocol = protocol
+        if not self.ready.done():
+            self.ready.set_result(True)
+
+        if self.responders:
+            protocol.send_message(protocol.uuid, dict(coremq_respond=list(self.responders)))
+        self.flush()
+
+    def disconnected(self, protocol):
+        if self.protocol is protocol:
+            self.protocol = None
+            self.ready = self.loop.create_future()
+
+    async def connection_failed(self):
+        error = ConnectionClosed('Could not reconnect to CoreMQ')
+        if not self.ready.done():
+            self.ready.set_exception(error)
+
+        self.fail_pending(error)
+
+    def fail_pending(self, error):
+        pending = self.pending
+        self.pending = []
+        for queue, message, future in pending:
+            if not future.done():
+                future.set_exception(error)
+
+    async def publish(self, queue, message):
+        """
+        Publishes a message, together with any others published in the same loop iteration
+        :param queue: The queue name
+        :param message: dict or str
+        :return: str - the server's response
+        """
+        self.validate(queue, message)
+        future = self.loop.create_future()
+        self.enqueue(queue, message, future)
+        return await future
+
+    async def publish_many(self, messages):
+        """
+        Publishes many messages in as few batches as batch_size allows
+        :param messages: iterable of (queue, message) pairs
+        :return: int - the number of messages published
+        """
+        messages = list(messages)
+        for queue, message in messages:
+            self.validate(queue, message)
+
+        futures = []
+        for queue, message in messages:
+            future = self.loop.create_future()
+            self.enqueue(queue, message, future)
+            futures.append(future)
+
+        await asyncio.gather(*futures)
+        return len(futures)
+
+    @staticmethod
+    def validate(queue, message):
+        validate_queue(queue)
+        validate_topic(queue)
+        if not isinstance(message, (dict, str_type)):
+            raise ValueError('Messages should be either a dictionary or a string')
+
+    async def request(self, queue, message, timeout=30):
+        """
+        Sends a request and waits for its reply
+        :param queue: The queue name, which can have responders or be the connection ID of another client
+        :param message: dict or str
+        :param timeout: Seconds to wait for the reply, None waits forever
+        :return: dict - the reply, or raises ResponseError if the server could not deliver the request
+        """
+        if isinstance(message, str_type):
+            message = dict(coremq_string=message)
+
+        self.validate(queue, message)
+        await self.ready
+        correlation = str(next(self.correlation_ids))
+        reply = self.requests[correlation] = self.loop.create_future()
+        sent = self.loop.create_future()
+        sent.add_done_callback(lambda f: self.request_sent(f, reply))
+        self.enqueue(queue, dict(message, coremq_replyto=self.protocol.uuid, coremq_correlation=correlation), sent)
+
+        try:
+            return await asyncio.wait_for(reply, timeout)
+        finally:
+            self.requests.pop(correlation, None)
+
+    @staticmethod
+    def request_sent(sent, reply):
+        error = sent.exception()
+        if error is not None and not reply.done():
+            reply.set_exception(error)
+
+    def reply_received(self, message):
+        future = self.requests.pop(message['coremq_correlation'], None)
+        if future is None or future.done():
+            return
+
+        if 'coremq_error' in message:
+            future.set_exception(ResponseError(message['coremq_error']))
+        else:
+            future.set_result(message)
+
+    def reject(self, request, error):
+        """
+        Answers a request with an error without waiting for the acknowledgement
+        """
+        future = self.loop.create_future()
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self.enqueue(request['coremq_replyto'], dict(coremq_correlation=request['coremq_correlation'],
+                                                     coremq_error=error), future)
+
+    async def reply(self, request, message):
+        """
+        Answers a request received from a subscription returned by serve
+        :param request: The request message
+        :param message: dict or str
+        """
+        if isinstance(message, str_type):
+            message = dict(coremq_string=message)
+
+        return await self.publish(request['coremq_replyto'], dict(
+            message, coremq_correlation=request['coremq_correlation']
+        ))
+
+    def enqueue(self, queue, message, future):
+        self.pending.append((queue, message, future))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+        elif not self.flush_scheduled:
+            self.flush_scheduled = True
+            self.loop.call_soon(self.flush)
+
+    def flush(self):
+        self.flush_scheduled = False
+        if not self.pending or self.protocol is None:
+            # sent once connected
+            return
+
+        pending = self.pending
+        self.pending = []
+        for i in range(0, len(pending), self.batch_size):
+            chunk = pending[i:i + self.batch_size]
+            if len(chunk) == 1:
+                reply = self.protocol.send_message(chunk[0][0], chunk[0][1])
+            else:
+                reply = self.protocol.send_batch((queue, message) for queue, message, future in chunk)
+
+            futures = [future for queue, message, future in chunk]
+            reply.add_done_callback(lambda r, futures=futures: self.acknowledged(r, futures))
+
+    @staticmethod
+    def acknowledged(reply, futures):
+        error = reply.exception()
+        for future in futures:
+            if future.done():
+                continue
+            elif error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(reply.result().get('response'))
+
+    def subscribe(self, *queues, **kwargs):
+        """
+        Starts receiving messages from queues or patterns
+        :param maxsize: The number of messages the subscription holds, default queue_size
+        :param overflow: What to do with messages once it is full, one of OVERFLOW_POLICIES, default drop_oldest
+        :return: Subscription - to read the messages with async for
+        """
+        if not queues:
+            raise ValueError('Must pass at least one queue name')
+
+        for q in queues:
+            validate_queue(q)
+            if is_pattern(q):
+                validate_pattern(q)
+
+        sub = Subscription(self, queues, kwargs.get('maxsize') or self.queue_size,
+                           overflow=kwargs.get('overflow', OVERFLOW_DROP_OLDEST))
+        self.subscriptions.add(sub)
+        added = []
+        for q in queues:
+            if is_pattern(q):
+                if self.patterns.add(q, sub):
+                    added.append(q)
+            else:
+                subs = self.consumers.setdefault(q, set())
+                if not subs:
+                    added.append(q)
+                subs.add(sub)
+
+        if added and self.protocol is not None:
+            self.protocol.subscribe(*added)
+
+        return sub
+
+    def serve(self, *queues, **kwargs):
+        """
+        Starts answering requests sent to queues. Each request goes to one of the responders for its queue, which take
+        turns, and is read from the returned subscription and answered with reply.
+        :param maxsize: The number of requests the subscription holds, default queue_size. Requests arriving while it is
+                        full are answered with an error.
+        :return: Subscription
+        """
+        if not queues:
+            raise ValueError('Must pass at least one queue name')
+
+        for q in queues:
+            validate_queue(q)
+            if is_pattern(q):
+                raise ValueError('Responders must use queue names, not patterns: %s' % q)
+
+        sub = Subscription(self, queues, kwargs.get('maxsize') or self.queue_size, responder=True)
+        self.subscriptions.add(sub)
+        added = []
+        for q in queues:
+            subs = self.responders.setdefault(q, deque())
+            if not subs:
+                added.append(q)
+            subs.append(sub)
+
+        if added and self.protocol is not None:
+            self.protocol.send_message(self.protocol.uuid, dict(coremq_respond=added))
+
+        return sub
+
+    def unsubscribe(self, sub):
+        self.subscriptions.discard(sub)
+        if sub.responder:
+            removed = []
+            for q in sub.queues:
+                subs = self.responders.get(q)
+                if subs is not None and sub in subs:
+                    subs.remove(sub)
+                    if not subs:
+                        del self.responders[q]
+                        removed.append(q)
+
+            if removed and self.protocol is not None:
+                self.protocol.send_message(self.protocol.uuid, dict(coremq_unrespond=removed))
+            return
+
+        removed = []
+        for q in sub.queues:
+            if is_pattern(q):
+                if self.patterns.discard(q, sub):
+                    removed.append(q)
+            elif q in self.consumers:
+                self.consumers[q].discard(sub)
+                if not self.consumers[q]:
+                    del self.consumers[q]
+                    removed.append(q)
+
+        if removed and self.protocol is not None:
+            self.protocol.unsubscribe(*removed)
+
+    def queues(self):
+        """
+        :return: list - the queues and patterns subscribed to
+        """
+        return list(self.consumers) + list(self.patterns.patterns)
+
+    def dispatch(self, queue, message):
+        if 'coremq_replyto' in message:
+            responders = self.responders.get(queue)
+            if responders:
+                responders.rotate(-1)
+                responders[-1].put(queue, message)
+
+        subs = self.consumers.get(queue, ())
+        if self.patterns:
+            matched = self.patterns.match(queue)
+            if matched:
+                subs = matched.union(subs)
+
+        for sub in subs:
+            sub.put(queue, message)
+
+    async def get_history(self, *queues):
+        """
+        :return: dict - queue name to the list of recent messages
+        """
+        await self.ready
+        reply = await self.protocol.get_history(*queues)
+        return reply['history']
+
+    async def get_status(self):
+        await self.ready
+        return await self.protocol.send_message(self.protocol.uuid, dict(coremq_status=True))
+
+    async def set_history_settings(self, pattern, depth=None, max_bytes=None, max_age=None):
+        """
+        See CoreMqClientProtocol.set_history_settings
+        """
+        await self.ready
+        return await self.protocol.set_history_settings(pattern, depth, max_bytes, max_age)
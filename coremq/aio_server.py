@@ -24,16 +24,138 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
-from common import comma_string_to_list, get_logger, construct_message, load_configuration, validate_header
+from common import codecs, comma_string_to_list, get_codec, get_logger, construct_frame, construct_message, \
+    decode_message, encode_message, load_configuration, validate_queue, FrameParser, ProtocolError, JSON_CODEC, \
+    PROTOCOL_V1, PROTOCOLS, str_type
+from admission import AdmissionLimiter, HostnameResolver
 from aio_client import CoreMqClientFactory, CoreMqClientProtocol
 from collections import deque
-import json
+from eventloop import get_event_loop, install_event_loop
+from history import HistorySettings, HistoryStore
+from metrics import Metrics, MetricsHttpProtocol
+from replication import DedupCache, MessageIds, ReplicationLog, UpstreamBatcher
+from storage import SegmentLog, FSYNC_ALWAYS, FSYNC_INTERVAL
+from topics import is_pattern, matches, validate_pattern, validate_topic, TopicTrie
+from tracing import create_sink, RingSink, Tracer, STAGE_DECODE, STAGE_FANOUT, STAGE_PARSE, STAGE_ROUTE, \
+    STAGE_STORE, STAGE_WRITE
+from workers import create_listen_socket, WorkerBus
+import asyncio
+import multiprocessing
+import os
 import socket
+import tempfile
 import time
-import trollius as asyncio
 import uuid
 
 
+SLOW_CONSUMER_DROP_NEWEST = 'drop_newest'  # discard messages that do not fit in the buffer
+SLOW_CONSUMER_DROP_OLDEST = 'drop_oldest'  # discard the oldest buffered messages to make room
+SLOW_CONSUMER_DISCONNECT = 'disconnect'  # close the connection
+SLOW_CONSUMER_PAUSE_PUBLISHER = 'pause_publisher'  # stop reading from publishers until the consumer catches up
+SLOW_CONSUMER_POLICIES = (
+    SLOW_CONSUMER_DROP_NEWEST, SLOW_CONSUMER_DROP_OLDEST, SLOW_CONSUMER_DISCONNECT, SLOW_CONSUMER_PAUSE_PUBLISHER
+)
+
+
+class SubscriptionIndex(object):
+    """
+    Inverted index from queue name to the set of connections subscribed to it, so that publishing only touches the
+    connections that actually want the message. Pattern subscriptions are kept in a TopicTrie. Replicants receive every
+    message and are kept under REPLICANTS. Responders take turns answering the requests sent to a queue.
+    """
+    REPLICANTS = None  # queue names are always strings, so this key can never collide with a real queue
+
+    def __init__(self):
+        self.queues = dict()
+        self.patterns = TopicTrie()
+        self.responders = dict()  # queue name to the connections answering its requests, next in turn first
+        self.listener = None  # told when a queue gains its first or loses its last subscriber, see WorkerBus
+
+    def add(self, queue, conn):
+        if queue is not None and is_pattern(queue):
+            if self.patterns.add(queue, conn) and self.listener:
+                self.listener.queue_added(queue)
+            return
+
+        subs = self.queues.get(queue)
+        if subs is None:
+            subs = self.queues[queue] = set()
+            if self.listener:
+                self.listener.queue_added(queue)
+
+        subs.add(conn)
+
+    def discard(self, queue, conn):
+        if queue is not None and is_pattern(queue):
+            if self.patterns.discard(queue, conn) and self.listener:
+                self.listener.queue_removed(queue)
+            return
+
+        subs = self.queues.get(queue)
+        if subs is None:
+            return
+
+        subs.discard(conn)
+        if not subs:
+            del self.queues[queue]
+            if self.listener:
+                self.listener.queue_removed(queue)
+
+    def get(self, queue):
+        subs = self.queues.get(queue, ())
+        if not self.patterns:
+            return subs
+
+        matched = self.patterns.match(queue)
+        if not matched:
+            return subs
+        elif not subs:
+            return matched
+
+        return matched.union(subs)
+
+    def replicants(self):
+        return self.queues.get(self.REPLICANTS, ())
+
+    def add_responder(self, queue, conn):
+        conns = self.responders.get(queue)
+        if conns is None:
+            conns = self.responders[queue] = deque()
+            if self.listener:
+                self.listener.responder_added(queue)
+
+        if conn not in conns:
+            conns.append(conn)
+
+    def discard_responder(self, queue, conn):
+        conns = self.responders.get(queue)
+        if conns is None or conn not in conns:
+            return
+
+        conns.remove(conn)
+        if not conns:
+            del self.responders[queue]
+            if self.listener:
+                self.listener.responder_removed(queue)
+
+    def next_responder(self, queue):
+        conns = self.responders.get(queue)
+        if not conns:
+            return None
+
+        conns.rotate(-1)
+        return conns[-1]
+
+    def remove_connection(self, conn, queues, responding=()):
+        for q in queues:
+            self.discard(q, conn)
+
+        for q in responding:
+            self.discard_responder(q, conn)
+
+        self.discard(self.REPLICANTS, conn)
+
+
 class ServerState(object):
     logger = None
     name = socket.gethostname().lower()
@@ -42,8 +164,38 @@ class ServerState(object):
     cluster_nodes = []
     allowed_replicants = []
     replicant_id_to_name = dict()  # replicants have connection IDs just like clients and this maps that ID to its name
-    history = dict()
+    subscribers = SubscriptionIndex()  # queue name to subscribed connections
+    history = HistoryStore()  # recent encoded messages per queue, or references into storage when it is enabled
     master = None  # the MQ master if this server is a replicant
+    storage = None  # SegmentLog when storage_path is configured
+    storage_interval = 1.0  # seconds between storage fsyncs and retention checks
+    storage_sync_pending = False
+    write_high_water = 64 * 1024  # transport buffer size at which a connection is considered slow
+    write_low_water = 16 * 1024  # transport buffer size at which a slow connection has caught up
+    max_write_buffer = 4 * 1024 * 1024  # messages held per slow connection before slow_consumer applies
+    slow_consumer = SLOW_CONSUMER_DROP_OLDEST  # default policy, connections can choose their own with set_options
+    publisher = None  # the connection whose message is being routed
+    event_loop = 'asyncio'  # asyncio, uvloop, or auto to use uvloop when it is installed
+    listen_backlog = 1024
+    resolver = HostnameResolver()  # reverse DNS for connecting clients, cached
+    admission = AdmissionLimiter()  # limits how many new connections are welcomed per second
+    workers = 1  # number of worker processes sharing the listening port
+    worker_id = 0
+    worker_socket_dir = tempfile.gettempdir()  # where the Unix sockets connecting the workers are created
+    bus = None  # WorkerBus when running more than one worker
+    metrics = Metrics()
+    metrics_port = 0  # port of the HTTP metrics endpoint, offset by the worker ID, 0 disables it
+    metrics_interval = 10.0  # seconds between rate calculations
+    tracer = Tracer()  # pipeline stage timings, disabled until a sink is added
+    replication = ReplicationLog()  # sequenced messages for this server's replicants
+    upstream = UpstreamBatcher()  # messages published on this server for its master, kept until acknowledged
+    replication_batch_bytes = 64 * 1024  # replication batches are sent once this large...
+    replication_flush_interval = 0.005  # ...or this many seconds after their first message
+    replication_backlog = 100000  # entries kept for replicants to resume from, and messages kept for the master
+    replicated_epoch = None  # the epoch of the master's replication log, if this server is a replicant
+    replicated_seq = 0  # the last sequence number applied from the master's replication log
+    message_ids = None  # MessageIds for messages published on this worker, created once the worker has started
+    dedup = DedupCache()  # IDs of recently routed messages, so that ones arriving again through replication are dropped
 
 
 class CoreMqServerProtocol(asyncio.Protocol):
@@ -52,16 +204,28 @@ class CoreMqServerProtocol(asyncio.Protocol):
     def __init__(self, loop=None):
         super(CoreMqServerProtocol, self).__init__()
 
-        self.LOOP = loop or asyncio.get_event_loop()
+        self.LOOP = loop or get_event_loop()
         self.uuid = str(uuid.uuid4())
         self.transport = None
         self.peer = None
         self.local_ip = None
-        self.reader = asyncio.StreamReader()
-        self.subscriptions = []
+        self.parser = FrameParser()
+        self.protocol_version = PROTOCOL_V1
+        self.codec = JSON_CODEC
+        self.subscriptions = set()
+        self.responding = set()  # queues this connection answers requests for
         self.options = dict()
         self.is_replicant = False
+        self.forwarding = None  # the client of a bridge such as CoreWS that the current command came from
         self.hostname = None
+        self.resolving = None  # future of the reverse DNS lookup of the peer
+        self.waiting_admission = False
+        self.writing_paused = False
+        self.outbox = deque()  # messages waiting for the transport to drain
+        self.outbox_size = 0
+        self.dropped = 0  # messages discarded by the slow consumer policy
+        self.paused_publishers = set()  # publishers whose reading is paused until this connection catches up
+        self.paused_by = set()  # slow consumers that paused reading from this connection
         ServerState.connections[self.uuid] = self
 
     def connection_made(self, transport):
@@ -69,108 +233,281 @@ class CoreMqServerProtocol(asyncio.Protocol):
         self.peer = transport.get_extra_info('peername')
         self.hostname = self.peer[0]
         self.local_ip = transport.get_extra_info('sockname')[0]
-        self.reader.set_transport(transport)
-        self.send_message(self.uuid, dict(response='OK: Welcome to CoreMQ server', server=ServerState.name))
+        transport.set_write_buffer_limits(high=ServerState.write_high_water, low=ServerState.write_low_water)
 
-        try:
-            self.hostname = socket.gethostbyaddr(self.peer[0])[0]
-        except socket.herror:
-            pass
+        if not ServerState.admission.admit(self.admit):
+            # nothing is read from the connection until it is welcomed
+            transport.pause_reading()
+            self.waiting_admission = True
 
-        ServerState.logger.debug('New connections: %s' % self.hostname)
+    def admit(self):
+        """
+        Welcomes the connection once the admission limit allows it
+        """
+        if self.transport.is_closing():
+            return
 
-    def data_received(self, data):
-        data = data.decode('utf-8')
-        expected_length, data = validate_header(data)
+        if self.waiting_admission:
+            self.waiting_admission = False
+            self.transport.resume_reading()
+
+        self.send_message(self.uuid, dict(
+            response='OK: Welcome to CoreMQ server',
+            server=ServerState.name,
+            protocols=list(PROTOCOLS),
+            codecs=list(codecs)
+        ))
+
+        # messages sent to the connection ID, such as replies to requests, go straight to this connection
+        self.subscriptions.add(self.uuid)
+        ServerState.subscribers.add(self.uuid, self)
 
-        if len(data) < expected_length:
-            data += self.reader.readexactly(expected_length - len(data)).decode('utf-8')
+        # the hostname is only needed for logging and authorizing replicants, so it is looked up without waiting
+        self.hostname = ServerState.resolver.cached(self.peer[0]) or self.peer[0]
+        self.resolving = ServerState.resolver.resolve(self.peer[0])
+        self.resolving.add_done_callback(self.resolved)
 
-        if len(data) > expected_length:
-            more_data = data[expected_length:]
-            self.LOOP.call_soon(self.data_received, more_data)
+        ServerState.logger.debug('New connections: %s', self.hostname)
 
-            data = data[:expected_length]
+    def resolved(self, future):
+        if not future.cancelled() and future.exception() is None and future.result():
+            self.hostname = future.result()
 
-        if ' ' not in data:
+    def data_received(self, data):
+        tracer = ServerState.tracer
+        t = tracer.start() if tracer.enabled else 0
+        try:
+            frames = self.parser.feed(data)
+        except ProtocolError as ex:
+            self.respond(self.uuid, 'ERROR: %s' % ex)
+            self.transport.close()
+            return
+
+        if t:
+            tracer.record(STAGE_PARSE, t)
+
+        for queue, message, flags in frames:
+            self.frame_received(queue, message, flags)
+
+    def frame_received(self, queue, data, flags=0):
+        if data is None:
             self.respond(self.uuid, 'ERROR: Missing queue or message')
             return
 
-        queue, message = data.split(' ', 1)
-        message = json.loads(message)
+        try:
+            validate_queue(queue)
+            validate_topic(queue)
+        except ValueError as ex:
+            self.respond(self.uuid, 'ERROR: %s' % ex)
+            return
+
+        tracer = ServerState.tracer
+        t = tracer.start() if tracer.enabled else 0
+        try:
+            message = decode_message(data, flags)
+        except Exception as ex:
+            self.respond(self.uuid, 'ERROR: Message could not be decoded: %s' % ex)
+            return
+
+        if t:
+            tracer.record(STAGE_DECODE, t, queue)
+
         if not isinstance(message, dict):
             self.respond(self.uuid, 'ERROR: Message must be a dictionary')
             return
 
         message.update(dict(
+            coremq_id=ServerState.message_ids.next(),
             coremq_sender=self.uuid,
             coremq_sent=time.time()
         ))
 
-        self.LOOP.create_task(self.new_message(queue, message))
-
-    @asyncio.coroutine
-    def new_message(self, queue, message):
-        if 'coremq_server' not in message:
-            message['coremq_server'] = '%s:%s' % (ServerState.name, ServerState.listen_address[1])
-            quiet = False
-        else:
-            # received via replication
-            quiet = True
+        self.new_message(queue, message, len(data))
 
+    def new_message(self, queue, message, size=0):
         if 'coremq_fwdto' in message and self.is_replicant:
             to = message['coremq_fwdto']
         else:
+            # bridges are answered on their own queue, with the ID of the client they forwarded the command for
             to = self.uuid
+            self.forwarding = message.get('coremq_fwdto')
 
-        ServerState.logger.debug('New message - queue: %s, message: %s' % (queue, message))
+        ServerState.logger.debug('New message - queue: %s, message: %s', queue, message)
 
+        ServerState.publisher = self
         try:
             if 'coremq_subscribe' in message:
                 self.subscribe(message['coremq_subscribe'])
-                self.respond(to, 'OK: Subscribe successful', quiet)
+                self.respond(to, 'OK: Subscribe successful')
             elif 'coremq_unsubscribe' in message:
                 self.unsubscribe(message['coremq_unsubscribe'])
-                self.respond(to, 'OK: Unsubscribe successful', quiet)
+                self.respond(to, 'OK: Unsubscribe successful')
+            elif 'coremq_respond' in message:
+                self.add_responder(message['coremq_respond'])
+                self.respond(to, 'OK: Responder added')
+            elif 'coremq_unrespond' in message:
+                self.remove_responder(message['coremq_unrespond'])
+                self.respond(to, 'OK: Responder removed')
+            elif 'coremq_protocol' in message:
+                self.set_protocol(message['coremq_protocol'], message.get('coremq_codec'))
+                self.respond(to, 'OK: Protocol set')
             elif 'coremq_options' in message:
                 self.set_options(message['coremq_options'])
-                self.respond(to, 'OK: Options set', quiet)
+                self.respond(to, 'OK: Options set')
+            elif 'coremq_history_settings' in message:
+                self.set_history_settings(message['coremq_history_settings'])
+                self.respond(to, 'OK: History settings set')
             elif 'coremq_gethistory' in message:
                 self.get_history(message['coremq_gethistory'], to)
             elif 'coremq_replicant' in message:
-                self.begin_replication(message['coremq_replicant'])
+                self.begin_replication(message['coremq_replicant'], message.get('coremq_resume'))
+            elif 'coremq_replication' in message and self.is_replicant:
+                seq = self.apply_replication(message['coremq_replication'], ServerState.replicant_id_to_name[self.uuid])
+                self.send_message(self.uuid, dict(coremq_upstream_ack=seq))
+            elif 'coremq_replication_ack' in message:
+                ServerState.replication.acked(self, message['coremq_replication_ack'])
             elif 'coremq_status' in message:
                 self.get_status(to)
+            elif 'coremq_batch' in message:
+                count = self.publish_batch(message['coremq_batch'], message)
+                self.respond(to, 'OK: Batch sent (%s messages)' % count, not self.options.get('ack', True))
             else:
-                self.store_message(queue, message)
-                yield asyncio.From(self.broadcast(queue, message))
+                payload = self.route(queue, message)
+                self.store_message(queue, message, payload)
+                ServerState.metrics.publish(queue, size or len(payload or b''))
 
-                self.respond(to, 'OK: Message sent', quiet)
+                self.respond(to, 'OK: Message sent', not self.options.get('ack', True))
         except Exception as ex:
-            ServerState.logger.error(str(ex))
-            self.respond(to, 'ERROR: %s' % ex, quiet)
-            raise
+            ServerState.logger.exception(str(ex))
+            self.respond(to, 'ERROR: %s' % ex)
+        finally:
+            ServerState.publisher = None
+            self.forwarding = None
 
     def respond(self, to, message, quiet=False):
         if not quiet:
-            self.send_message(to, dict(response=message))
+            self.send_message(to, self.response(response=message))
+
+    def response(self, **response):
+        if self.forwarding is not None:
+            response['coremq_fwdto'] = self.forwarding
+
+        return response
 
     def send_message(self, queue, message):
-        data = construct_message(queue, message)
+        self.write(construct_message(queue, message, self.protocol_version, self.codec))
 
+    def write(self, data):
+        """
+        Writes an already constructed message to this connection. While the transport is over its high water mark,
+        messages are held in the outbox, and once that is full the connection's slow consumer policy applies.
+        :param data: bytes from construct_message, which may be shared between many connections
+        """
+        if self.writing_paused or self.outbox:
+            self.hold(data)
+            return
+
+        tracer = ServerState.tracer
+        t = tracer.start() if tracer.enabled else 0
         try:
             self.transport.write(data)
         except Exception:
             self.transport.close()
 
+        if t:
+            tracer.record(STAGE_WRITE, t, self.uuid)
+
+    def hold(self, data):
+        if self.outbox_size + len(data) > ServerState.max_write_buffer:
+            policy = SLOW_CONSUMER_PAUSE_PUBLISHER if self.is_replicant else self.options.get(
+                'slow_consumer', ServerState.slow_consumer)
+
+            if policy == SLOW_CONSUMER_PAUSE_PUBLISHER:
+                publisher = ServerState.publisher
+                if publisher is None or publisher is self or self.outbox_size > 2 * ServerState.max_write_buffer:
+                    # nothing can be paused for messages from history, replication or other workers, and paused
+                    # publishers only get to finish the data already read from them, so past twice the limit the
+                    # buffer is kept bounded instead. Replicants resume from the replication log once they reconnect.
+                    policy = SLOW_CONSUMER_DISCONNECT if self.is_replicant else SLOW_CONSUMER_DROP_OLDEST
+                elif publisher not in self.paused_publishers:
+                    self.paused_publishers.add(publisher)
+                    publisher.paused_by.add(self)
+                    publisher.transport.pause_reading()
+
+            if policy == SLOW_CONSUMER_DROP_NEWEST:
+                self.dropped += 1
+                ServerState.metrics.dropped += 1
+                return
+            elif policy == SLOW_CONSUMER_DROP_OLDEST:
+                while self.outbox and self.outbox_size + len(data) > ServerState.max_write_buffer:
+                    self.outbox_size -= len(self.outbox.popleft())
+                    self.dropped += 1
+                    ServerState.metrics.dropped += 1
+            elif policy == SLOW_CONSUMER_DISCONNECT:
+                ServerState.logger.warning('Disconnecting slow consumer: %s', self.hostname)
+                self.outbox.clear()
+                self.outbox_size = 0
+                self.transport.abort()
+                return
+
+        self.outbox.append(data)
+        self.outbox_size += len(data)
+
+    def pause_writing(self):
+        self.writing_paused = True
+
+    def resume_writing(self):
+        self.writing_paused = False
+
+        # writing can pause again part way through, in which case the rest waits for the next resume
+        while self.outbox and not self.writing_paused:
+            data = self.outbox.popleft()
+            self.outbox_size -= len(data)
+            try:
+                self.transport.write(data)
+            except Exception:
+                self.transport.close()
+                return
+
+        if not self.outbox:
+            self.release_publishers()
+
+    def release_publishers(self):
+        for publisher in self.paused_publishers:
+            publisher.paused_by.discard(self)
+            if not publisher.paused_by:
+                publisher.transport.resume_reading()
+
+        self.paused_publishers.clear()
+
+    @property
+    def buffered(self):
+        """
+        The number of bytes waiting to be sent to this connection
+        """
+        return self.outbox_size + (self.transport.get_write_buffer_size() if self.transport else 0)
+
     def connection_lost(self, exc):
         del ServerState.connections[self.uuid]
+        if self.waiting_admission:
+            ServerState.admission.cancel(self.admit)
+        ServerState.subscribers.remove_connection(self, self.subscriptions, self.responding)
+        ServerState.history.remove(self.uuid)
+        ServerState.metrics.remove(self.uuid)
+        ServerState.replication.remove_replicant(self)
+        self.outbox.clear()
+        self.outbox_size = 0
+        self.release_publishers()
+
+        for consumer in self.paused_by:
+            consumer.paused_publishers.discard(self)
+        self.paused_by.clear()
 
         # clean up replicants
         if self.uuid in ServerState.replicant_id_to_name:
             del ServerState.replicant_id_to_name[self.uuid]
 
-        ServerState.logger.debug('Closed connection: %s' % self.hostname)
+        ServerState.logger.debug('Closed connection: %s', self.hostname)
 
     def subscribe(self, queues):
         if not queues:
@@ -179,10 +516,15 @@ class CoreMqServerProtocol(asyncio.Protocol):
         if not isinstance(queues, (list, tuple)):
             queues = [queues]
 
-        subs = ServerState.connections[self.uuid].subscriptions
         for q in queues:
-            if q not in subs:
-                subs.append(q)
+            validate_queue(q)
+            if is_pattern(q):
+                validate_pattern(q)
+
+        for q in queues:
+            if q not in self.subscriptions:
+                self.subscriptions.add(q)
+                ServerState.subscribers.add(q, self)
 
     def unsubscribe(self, queues):
         if not queues:
@@ -191,12 +533,51 @@ class CoreMqServerProtocol(asyncio.Protocol):
         if not isinstance(queues, (list, tuple)):
             queues = [queues]
 
-        subs = ServerState.connections[self.uuid].subscriptions
         for q in queues:
-            if q in subs:
-                subs.remove(q)
+            if q in self.subscriptions:
+                self.subscriptions.remove(q)
+                ServerState.subscribers.discard(q, self)
+
+    def add_responder(self, queues):
+        """
+        Makes this connection one of the responders for queues, which take turns receiving the requests sent to them
+        """
+        if not isinstance(queues, (list, tuple)):
+            queues = [queues]
+
+        for q in queues:
+            validate_queue(q)
+            if is_pattern(q):
+                raise ValueError('Responders must use queue names, not patterns: %s' % q)
+
+        for q in queues:
+            self.responding.add(q)
+            ServerState.subscribers.add_responder(q, self)
+
+    def remove_responder(self, queues):
+        if not isinstance(queues, (list, tuple)):
+            queues = [queues]
+
+        for q in queues:
+            if q in self.responding:
+                self.responding.remove(q)
+                ServerState.subscribers.discard_responder(q, self)
+
+    def set_protocol(self, version, codec=None):
+        if version not in PROTOCOLS:
+            raise ValueError('Unsupported protocol version: %s' % version)
+
+        codec = get_codec(codec or JSON_CODEC.name)
+        if version == PROTOCOL_V1 and codec is not JSON_CODEC:
+            raise ValueError('Protocol version 1 only supports the json codec')
+
+        self.protocol_version = version
+        self.codec = codec
 
     def set_options(self, options):
+        if options.get('slow_consumer') not in (None,) + SLOW_CONSUMER_POLICIES:
+            raise ValueError('slow_consumer must be one of: %s' % ', '.join(SLOW_CONSUMER_POLICIES))
+
         opts = ServerState.connections[self.uuid].options
         opts.update(options)
 
@@ -205,97 +586,484 @@ class CoreMqServerProtocol(asyncio.Protocol):
                 del opts[key]
 
     def get_history(self, queues, to):
-        result = dict()
+        if not isinstance(queues, (list, tuple)):
+            queues = [queues]
+
+        # the history of a queue is kept by a single worker, while patterns can match queues in any of them
+        bus = ServerState.bus
+        remote = [q for q in queues if is_pattern(q) or not bus.owns(q)] if bus else []
+        result = self.read_history([q for q in queues if is_pattern(q) or q not in remote])
+        response = self.response(history=result)
+
+        if not remote:
+            self.send_message(to, response)
+            return
+
+        # the history of these queues is kept by other workers
+        def reply(history):
+            result.update(history)
+            if self.transport and not self.transport.is_closing():
+                self.send_message(to, response)
+
+        bus.request_history(remote, reply)
+
+    @staticmethod
+    def read_history(queues):
+        """
+        Reads the history of queues from this worker
+        :param queues: Queue names or patterns
+        :return: dict of queue name to list of messages
+        """
+        names = []
         for q in queues:
-            if q in ServerState.history:
-                result[q] = list(ServerState.history[q])
+            if is_pattern(q):
+                names.extend(name for name in list(ServerState.history.keys()) if matches(q, name))
+            else:
+                names.append(q)
+
+        result = dict()
+        for q in names:
+            if q not in ServerState.history:
+                continue
+
+            result[q] = []
+            for ref in ServerState.history.get(q):
+                if ServerState.storage is not None:
+                    record = ServerState.storage.read(ref)
+                    if record is None:  # the segment has been deleted by retention
+                        continue
+                    ref = bytes(record[1])
+
+                result[q].append(JSON_CODEC.loads(ref))
 
-        self.send_message(to, dict(history=result))
+        return result
+
+    @staticmethod
+    def set_history_settings(settings, broadcast=True):
+        """
+        Changes the history limits of the queues matching a pattern
+        :param settings: dict with a pattern, and any of depth, max_bytes and max_age
+        """
+        if not isinstance(settings, dict) or 'pattern' not in settings:
+            raise ValueError('History settings must be a dictionary with a pattern')
+
+        changes = dict(settings)
+        pattern = changes.pop('pattern')
+        history = ServerState.history
+        history.set_settings(pattern, history.settings_for(pattern).updated(**changes))
+
+        if ServerState.bus and broadcast:
+            ServerState.bus.broadcast_control(dict(history_settings=settings))
+
+    def begin_replication(self, name, resume=None):
+        """
+        Makes this connection a replicant, which is sent every message through the replication log
+        :param name: The replicant's server name, which messages published on it are tagged with
+        :param resume: Optional dict with the epoch and sequence number the replicant last applied
+        """
+        if self.transport.is_closing():
+            return
 
-    def begin_replication(self, name):
         allowed = [r.split(':')[0].split('.')[0].lower() for r in ServerState.allowed_replicants]
-        if self.peer[0] in allowed or self.hostname.split('.')[0].lower() in allowed:
+        if self.peer[0] not in allowed and not self.resolving.done():
+            # replicants listed by hostname wait for the reverse DNS lookup, without holding up other connections
+            self.resolving.add_done_callback(lambda f: self.begin_replication(name, resume))
+            return
+
+        # the lookup can be done before its callbacks have run, so the result is read from it directly, and it can
+        # still be pending when the replicant is allowed by its address
+        hostname = (self.resolving.result() if self.resolving.done() else None) or self.peer[0]
+        if self.peer[0] in allowed or hostname.split('.')[0].lower() in allowed:
             if self.uuid not in ServerState.replicant_id_to_name:
                 ServerState.replicant_id_to_name[self.uuid] = name
+                ServerState.subscribers.add(SubscriptionIndex.REPLICANTS, self)
             self.is_replicant = True
-            self.respond(self.uuid, 'OK: Replication request successful')
-            ServerState.logger.info('New replicant: %s' % self.hostname)
+
+            resume = resume or dict()
+            resumed = ServerState.replication.add_replicant(self, name, resume.get('epoch'), resume.get('seq'))
+            self.send_message(self.uuid, dict(
+                response='OK: Replication request successful',
+                epoch=ServerState.replication.epoch,
+                resumed=resumed
+            ))
+            ServerState.replication.catch_up(self)
+            ServerState.logger.info('New replicant: %s (resumed: %s)', self.hostname, resumed)
         else:
             self.respond(self.uuid, 'ERROR: Not allowed to be a replicant')
 
+    @staticmethod
+    def apply_replication(entries, origin=None):
+        """
+        Routes and stores a batch of messages from the replication stream, skipping any that were already routed
+        :param entries: list of [sequence, queue, message]
+        :param origin: The name of the replicant that sent the batch, or None if it came from the master
+        :return: int - the last sequence number in the batch
+        """
+        seq = 0
+        dedup = ServerState.dedup
+        for seq, queue, message in entries:
+            message_id = message.get('coremq_id')
+            if message_id is not None and dedup.seen(message_id):
+                continue
+
+            payload = CoreMqServerProtocol.route(queue, message, origin=origin, from_master=origin is None)
+            payload = CoreMqServerProtocol.store_message(queue, message, payload)
+            ServerState.metrics.publish(queue, len(payload or b''))
+
+        return seq
+
     def get_status(self, to):
         if ServerState.master is None:
-            self.send_message(to, dict(
+            status = dict(
                 coremq_fwdto=to,
                 master=ServerState.name,
-                replicants=list(ServerState.replicant_id_to_name.values()),
-                connections=len(ServerState.connections)
-            ))
+            )
         else:
-            self.send_message(to, dict(
+            status = dict(
                 replicant_of=ServerState.master.factory.connected_server,
-                replicants=list(ServerState.replicant_id_to_name.values()),
-                connections=len(ServerState.connections)
-            ))
+            )
+
+        status.update(
+            replicants=list(ServerState.replicant_id_to_name.values()),
+            connections=len(ServerState.connections),
+            worker=ServerState.worker_id,
+            workers=ServerState.workers,
+            slow_consumers=self.get_slow_consumers(),
+            metrics=ServerState.metrics.snapshot(self.get_gauges()),
+            replication=ServerState.replication.status()
+        )
 
-    @staticmethod
-    @asyncio.coroutine
-    def store_message(queue, message):
-        if queue not in ServerState.history:
-            ServerState.history[queue] = deque(maxlen=10)
+        for sink in ServerState.tracer.sinks:
+            if isinstance(sink, RingSink):
+                status['trace'] = sink.summary()
 
-        ServerState.history[queue].append(message)
+        self.send_message(to, status)
 
     @staticmethod
-    @asyncio.coroutine
-    def broadcast(queue, message):
-        if ServerState.master and 'coremq_master' not in message:
-            if 'coremq_fwdto' not in message and 'coremq_sender' in message:
-                message['coremq_fwdto'] = message['coremq_sender']
+    def get_gauges():
+        """
+        Current values for the metrics that are read from the broker's state instead of being counted
+        """
+        buffered = [c.buffered for c in ServerState.connections.values()]
+        gauges = dict(
+            connections=len(ServerState.connections),
+            subscribed_queues=len(ServerState.subscribers.queues),
+            buffered_bytes=sum(buffered),
+            max_buffered_bytes=max(buffered) if buffered else 0,
+            slow_consumers=sum(1 for b in buffered if b > ServerState.write_high_water),
+            history_bytes=ServerState.history.size,
+            history_queues=len(ServerState.history),
+            waiting_admission=len(ServerState.admission),
+            cached_hostnames=len(ServerState.resolver),
+        )
 
-            ServerState.master.send_message(queue, message)
+        if ServerState.storage is not None:
+            gauges['storage_sequence'] = ServerState.storage.next_seq
 
-        for i, n in ServerState.replicant_id_to_name.items():
-            c = ServerState.connections[i]
-            if not ServerState.master:
-                message['coremq_master'] = ServerState.name
-            if n != message['coremq_server']:
-                c.send_message(queue, message)
+        return gauges
 
+    @staticmethod
+    def get_slow_consumers():
+        result = dict()
         for i, c in ServerState.connections.items():
-            if i == message.get('coremq_sender', None) or c.is_replicant:
+            buffered = c.buffered
+            if buffered or c.dropped:
+                result[i] = dict(hostname=c.hostname, buffered=buffered, dropped=c.dropped)
+
+        return result
+
+    @staticmethod
+    def store_message(queue, message, payload=None):
+        """
+        Adds a message to the history of its queue, and to storage when it is enabled
+        :param queue: The queue name
+        :param message: The message
+        :param payload: The message already encoded with the json codec, if route produced it
+        :return: bytes - the encoded message, or None if it is not stored here and route did not encode it
+        """
+        # requests and replies are only of use to the connections waiting for them
+        if 'coremq_correlation' in message:
+            return payload
+
+        if ServerState.bus and not ServerState.bus.owns(queue):
+            return payload
+
+        # history would drop the message straight away, so it is not written to storage either
+        if ServerState.history.settings_for(queue).depth <= 0:
+            return payload
+
+        tracer = ServerState.tracer
+        t = tracer.start() if tracer.enabled else 0
+        if payload is None:
+            payload = encode_message(message)
+
+        timestamp = message.get('coremq_sent')
+        if ServerState.storage is None:
+            ServerState.history.append(queue, payload, len(payload), timestamp)
+            if t:
+                tracer.record(STAGE_STORE, t, queue)
+            return payload
+
+        seq, ref = ServerState.storage.append(queue, payload, timestamp)
+        ServerState.history.append(queue, ref, len(payload), timestamp)
+        if t:
+            tracer.record(STAGE_STORE, t, queue)
+
+        # group commit: every append made during this iteration of the event loop shares one fsync
+        if ServerState.storage.fsync == FSYNC_ALWAYS and not ServerState.storage_sync_pending:
+            ServerState.storage_sync_pending = True
+            get_event_loop().call_soon(sync_storage)
+
+        return payload
+
+    def publish_batch(self, batch, envelope):
+        """
+        Publishes every message in a coremq_batch command in a single pass. Frames going to the same connection are
+        written together, and the whole batch is validated before anything is published.
+        :param batch: list of [queue, message] pairs
+        :param envelope: The coremq_batch message, whose sender and routing fields are applied to every message
+        :return: int - the number of messages published
+        """
+        if not isinstance(batch, (list, tuple)):
+            raise ValueError('coremq_batch must be a list of [queue, message] pairs')
+
+        messages = []
+        for item in batch:
+            if not isinstance(item, (list, tuple)) or len(item) != 2:
+                raise ValueError('coremq_batch must be a list of [queue, message] pairs')
+
+            queue, message = item
+            validate_queue(queue)
+            validate_topic(queue)
+
+            if isinstance(message, str_type):
+                message = dict(coremq_string=message)
+            elif not isinstance(message, dict):
+                raise ValueError('Message must be a dictionary')
+
+            for key in ('coremq_sender', 'coremq_sent', 'coremq_fwdto'):
+                if key in envelope:
+                    message[key] = envelope[key]
+            message['coremq_id'] = ServerState.message_ids.next()
+
+            messages.append((queue, message))
+
+        outbox = dict()
+        for queue, message in messages:
+            payload = self.route(queue, message, outbox)
+            payload = self.store_message(queue, message, payload)
+            ServerState.metrics.publish(queue, len(payload or b''))
+
+        for c, frames in outbox.items():
+            c.write(b''.join(frames))
+
+        return len(messages)
+
+    @staticmethod
+    def route(queue, message, outbox=None, from_bus=False, origin=None, from_master=False):
+        """
+        Sends a published message to subscribers and other workers, and adds it to the batches for the master and
+        replicants
+        :param queue: The queue name
+        :param message: The message
+        :param outbox: Optional dict, when given frames are appended to a list per connection instead of written
+        :param from_bus: True if the message was published in another worker, which has already sent it to the master
+                         and the rest of the workers
+        :param origin: The name of the replicant the message came from, which it is not sent back to
+        :param from_master: True if the message came from this server's master
+        :return: bytes - the message encoded with the json codec, or None if no recipient needed it
+        """
+        # every recipient gets the same bytes, so the message is finalized first and encoded at most once
+        tracer = ServerState.tracer
+        t = tracer.start() if tracer.enabled else 0
+        recipients = []
+        replicants = ServerState.subscribers.replicants()
+
+        # messages from replication were checked against the cache by apply_replication
+        message_id = message.get('coremq_id')
+        if message_id is not None and origin is None and not from_master:
+            ServerState.dedup.seen(message_id)
+
+        if from_master and 'coremq_sent' in message:
+            ServerState.metrics.replicated(time.time() - message['coremq_sent'])
+
+        # every worker has its own link to the master, so messages from the master are never passed between workers
+        if ServerState.bus and not from_bus and not from_master:
+            recipients.extend(ServerState.bus.recipients(queue))
+
+        forward = ServerState.master is not None and not from_bus and not from_master
+
+        # a bridge is sent what it publishes for its clients, since other clients of the same bridge may want it
+        sender = message.get('coremq_sender', None) if 'coremq_fwdto' not in message else None
+        subscribers = ServerState.subscribers.get(queue)
+        for c in subscribers:
+            if c.uuid == sender or c.is_replicant:
                 continue
 
-            if queue in c.subscriptions:
-                c.send_message(queue, message)
+            recipients.append(c)
+
+        # a request goes to one responder in the worker it was published in, or else in another worker, in turn
+        request = 'coremq_replyto' in message and origin is None and not from_master and not from_bus
+        request_sent = False
+        if request:
+            responder = ServerState.subscribers.next_responder(queue)
+            if responder is not None:
+                if responder not in subscribers:
+                    recipients.append(responder)
+                request_sent = True
+            elif ServerState.bus:
+                request_sent = ServerState.bus.send_request(queue, message)
+
+        if t:
+            tracer.record(STAGE_ROUTE, t, queue)
+            t = tracer.start()
+
+        if not recipients and not forward and not replicants:
+            ServerState.metrics.deliver(queue, 0, 0)
+            if request and not request_sent:
+                # after the publisher's acknowledgement, which is sent once routing is done
+                get_event_loop().call_soon(
+                    CoreMqServerProtocol.reply_error, message, 'No subscribers or responders for %s' % queue
+                )
+            return None
+
+        # the message is serialized once per codec and framed once per protocol version in use, so recipients
+        # sharing a codec share the same bytes
+        encoded = dict()
+        frames = dict()
+        size = 0
+        for c in recipients:
+            key = (c.protocol_version, c.codec)
+            data = frames.get(key)
+            if data is None:
+                payload = encoded.get(c.codec)
+                if payload is None:
+                    payload = encoded[c.codec] = encode_message(message, c.codec)
+
+                data = frames[key] = construct_frame(queue, payload, c.protocol_version, c.codec.id)
+
+            if outbox is None:
+                c.write(data)
+            else:
+                outbox.setdefault(c, []).append(data)
+            size += len(data)
+
+        # the master and replicants are sent batches of json messages
+        payload = encoded.get(JSON_CODEC)
+        if forward or replicants:
+            if payload is None:
+                payload = encoded[JSON_CODEC] = encode_message(message)
+
+            if forward:
+                ServerState.master.forward(queue, payload)
+
+            if replicants:
+                ServerState.replication.append(origin, queue, payload)
+
+        if t:
+            tracer.record(STAGE_FANOUT, t, queue)
+
+        sent = message.get('coremq_sent')
+        ServerState.metrics.deliver(queue, len(recipients), size, time.time() - sent if sent else None)
+        return payload
+
+    @staticmethod
+    def reply_error(request, error):
+        """
+        Answers a request on behalf of the responder, so that the requester does not wait for its timeout
+        """
+        CoreMqServerProtocol.route(request['coremq_replyto'], dict(
+            coremq_correlation=request.get('coremq_correlation'),
+            coremq_error=error,
+            coremq_sent=time.time()
+        ))
+
+    @staticmethod
+    def request_received(queue, message):
+        """
+        Delivers a request another worker passed to this one for its responders
+        """
+        responder = ServerState.subscribers.next_responder(queue)
+        if responder is None:
+            CoreMqServerProtocol.reply_error(message, 'No subscribers or responders for %s' % queue)
+        else:
+            responder.write(construct_message(queue, message, responder.protocol_version, responder.codec))
 
 
 class ReplicationClientProtocol(CoreMqClientProtocol):
+    """
+    Connection from a replicant to its master. Messages published on the replicant are forwarded to the master in
+    batches, and batches from the master's replication log are routed straight into this server. When the connection
+    is re-established, replication resumes from the last message applied if the master still has it.
+    """
+    def __init__(self, *args, **kwargs):
+        super(ReplicationClientProtocol, self).__init__(*args, **kwargs)
+
+        self.connected_future.add_done_callback(
+            lambda _: self.begin_replication('%s:%s' % (ServerState.name, ServerState.listen_address[1]))
+        )
+
+    def connection_made(self, transport):
+        super(ReplicationClientProtocol, self).connection_made(transport)
+        ServerState.master = self
+
+    def connection_lost(self, exc):
+        # unacknowledged messages are kept for the next connection
+        ServerState.upstream.detach(self)
+        super(ReplicationClientProtocol, self).connection_lost(exc)
+
     def begin_replication(self, server_name):
         """
         Attempts to promote this connection to allow replication
-        :param server_name: This must match the coremq_server attribute, set by ServerState.name
+        :param server_name: The name of this server, which must be listed in the master's allowed_replicants
         """
-        return self.send_message(self.uuid, dict(coremq_replicant=server_name))
+        return self.send_message(self.uuid, dict(
+            coremq_replicant=server_name,
+            coremq_resume=dict(epoch=ServerState.replicated_epoch, seq=ServerState.replicated_seq)
+        ))
 
-    def new_message(self, queue, message):
-        loop = asyncio.get_event_loop()
+    def forward(self, queue, payload):
+        """
+        Sends a message published on this server to the master
+        :param payload: The message encoded with the json codec
+        """
+        ServerState.upstream.append(queue, None, payload)
 
-        # make sure to blackhole any OK responses coming back from begin_replication
-        if queue == self.uuid:
-            if 'response' in message and 'Replication' in message['response']:
-                if not message['response'].startswith('OK:'):
-                    ServerState.logger.error('From replication client: %s' % message['response'])
-                    self.close()
-                    loop.stop()
-                    return
-                else:
-                    return
+    def new_message(self, queue, message):
+        if queue != self.uuid:
+            # not part of a replication batch, which only happens if this connection subscribed to something
+            payload = CoreMqServerProtocol.route(queue, message)
+            CoreMqServerProtocol.store_message(queue, message, payload)
+        elif 'coremq_replication' in message:
+            self.apply_batch(message['coremq_epoch'], message['coremq_replication'])
+        elif 'coremq_upstream_ack' in message:
+            ServerState.upstream.acked(message['coremq_upstream_ack'])
+        elif 'response' in message and 'Replication' in message['response']:
+            if not message['response'].startswith('OK:'):
+                ServerState.logger.error('From replication client: %s', message['response'])
+                self.close()
+                self.loop.stop()
+                return
+            elif not message.get('resumed') and ServerState.replicated_epoch is not None:
+                ServerState.logger.warning('Could not resume replication, messages sent while disconnected are missing')
+
+            # forwarding starts once the master accepts this server, with whatever it has not acknowledged yet
+            dropped = ServerState.upstream.attach(self)
+            if dropped:
+                ServerState.logger.warning('%s messages for the master were dropped while disconnected', dropped)
+
+    def apply_batch(self, epoch, entries):
+        if epoch != ServerState.replicated_epoch:
+            ServerState.replicated_epoch = epoch
+            ServerState.replicated_seq = 0
+
+        # entries already applied before a reconnect can be sent again
+        entries = [e for e in entries if e[0] > ServerState.replicated_seq]
+        if not entries:
+            return
 
-        # hijack an existing server connection and act like a client to forward on the message
-        if ServerState.connections:
-            conn = ServerState.connections[list(ServerState.connections.keys())[0]]
-            self.loop.create_task(conn.new_message(queue, message))
+        ServerState.replicated_seq = CoreMqServerProtocol.apply_replication(entries)
+        self.send_message(self.uuid, dict(coremq_replication_ack=ServerState.replicated_seq))
 
 
 def load_settings():
@@ -304,20 +1072,132 @@ def load_settings():
     ServerState.allowed_replicants = comma_string_to_list(c.get('CoreMQ', 'allowed_replicants', ''))
     ServerState.allowed_replicants.extend(ServerState.cluster_nodes)
 
+    ServerState.event_loop = c.get('CoreMQ', 'event_loop', ServerState.event_loop)
+    ServerState.listen_backlog = int(c.get('CoreMQ', 'listen_backlog', str(ServerState.listen_backlog)))
+    ServerState.admission = AdmissionLimiter(
+        rate=float(c.get('CoreMQ', 'accept_rate', '0')),
+        burst=int(c.get('CoreMQ', 'accept_burst', '0'))
+    )
+    ServerState.resolver = HostnameResolver(
+        ttl=float(c.get('CoreMQ', 'hostname_cache_ttl', '300')),
+        negative_ttl=float(c.get('CoreMQ', 'hostname_cache_negative_ttl', '60')),
+        threads=int(c.get('CoreMQ', 'resolver_threads', '4'))
+    )
+    ServerState.workers = int(c.get('CoreMQ', 'workers', '1'))
+    ServerState.worker_socket_dir = c.get('CoreMQ', 'worker_socket_dir', ServerState.worker_socket_dir)
+
     address = c.get('CoreMQ', 'address', '0.0.0.0')
     port = int(c.get('CoreMQ', 'port', '6747'))
     ServerState.listen_address = (address, port)
     ServerState.logger = get_logger(c, 'CoreMQ')
 
+    ServerState.replication_batch_bytes = int(c.get('CoreMQ', 'replication_batch_bytes', str(64 * 1024)))
+    ServerState.replication_flush_interval = float(c.get('CoreMQ', 'replication_flush_interval', '0.005'))
+    ServerState.dedup = DedupCache(int(c.get('CoreMQ', 'dedup_cache_size', '100000')))
+    ServerState.replication_backlog = int(c.get('CoreMQ', 'replication_backlog', '100000'))
+
+    ServerState.metrics = Metrics(max_queues=int(c.get('CoreMQ', 'metrics_max_queues', '1000')))
+    ServerState.metrics_port = int(c.get('CoreMQ', 'metrics_port', '0'))
+    ServerState.metrics_interval = float(c.get('CoreMQ', 'metrics_interval', str(ServerState.metrics_interval)))
+
+    trace_sink = c.get('CoreMQ', 'trace_sink', '')
+    ServerState.tracer = Tracer(sample_every=int(c.get('CoreMQ', 'trace_sample_every', '100')))
+    if trace_sink:
+        ServerState.tracer.add_sink(create_sink(
+            trace_sink,
+            path=c.get('CoreMQ', 'trace_path', ''),
+            ring_size=int(c.get('CoreMQ', 'trace_ring_size', '10000')),
+            window=float(c.get('CoreMQ', 'trace_profile_window', '60'))
+        ))
+
+    history = HistoryStore(
+        HistorySettings(
+            depth=c.get('CoreMQ', 'history_depth', '10'),
+            max_bytes=c.get('CoreMQ', 'history_max_bytes', '0'),
+            max_age=c.get('CoreMQ', 'history_max_age', '0')
+        ),
+        budget=int(c.get('CoreMQ', 'history_memory_budget', '0'))
+    )
+
+    # patterns listed first take priority, so they are applied last
+    for pattern, settings in reversed(c.items('History')):
+        history.set_settings(pattern, HistorySettings.parse(settings, history.default))
+
+    ServerState.history = history
+
+    ServerState.write_high_water = int(c.get('CoreMQ', 'write_high_water', str(ServerState.write_high_water)))
+    ServerState.write_low_water = int(c.get('CoreMQ', 'write_low_water', str(ServerState.write_low_water)))
+    ServerState.max_write_buffer = int(c.get('CoreMQ', 'max_write_buffer', str(ServerState.max_write_buffer)))
+    ServerState.slow_consumer = c.get('CoreMQ', 'slow_consumer', ServerState.slow_consumer)
+    if ServerState.slow_consumer not in SLOW_CONSUMER_POLICIES:
+        raise ValueError('slow_consumer must be one of: %s' % ', '.join(SLOW_CONSUMER_POLICIES))
+
+    storage_path = c.get('CoreMQ', 'storage_path', '')
+    if storage_path:
+        ServerState.storage = SegmentLog(
+            storage_path,
+            segment_size=int(c.get('CoreMQ', 'storage_segment_size', str(64 * 1024 * 1024))),
+            fsync=c.get('CoreMQ', 'storage_fsync', FSYNC_INTERVAL),
+            retention_bytes=int(c.get('CoreMQ', 'storage_retention_bytes', '0')),
+            retention_age=float(c.get('CoreMQ', 'storage_retention_age', '0'))
+        )
+        ServerState.storage_interval = float(c.get('CoreMQ', 'storage_fsync_interval', '1.0'))
+
+
+def sync_storage():
+    ServerState.storage_sync_pending = False
+    ServerState.storage.sync()
+
+
+def maintain_storage():
+    loop = get_event_loop()
+    sync_storage()
+    ServerState.storage.enforce_retention()
+    loop.call_later(ServerState.storage_interval, maintain_storage)
+
+
+def load_storage():
+    """
+    Opens the storage log and rebuilds the history of every queue from it. Only record headers are read, so no
+    messages are decoded or routed.
+    """
+    storage = ServerState.storage
+    storage.open()
+
+    for seq, timestamp, queue, ref, length in storage.scan():
+        ServerState.history.append(queue, ref, length, timestamp)
+
+    ServerState.logger.info(
+        'Loaded %s queues from storage, next sequence is %s', len(ServerState.history), storage.next_seq)
+    maintain_storage()
 
-def promote_to_master():
+
+def maintain_metrics():
+    ServerState.metrics.tick()
+    get_event_loop().call_later(ServerState.metrics_interval, maintain_metrics)
+
+
+def collect_metrics(kind):
+    """
+    Renders the metrics for the HTTP endpoint
+    :param kind: 'metrics' for the Prometheus text format or 'status' for JSON
+    """
+    gauges = CoreMqServerProtocol.get_gauges()
+    if kind == 'metrics':
+        return ServerState.metrics.prometheus(gauges, labels=dict(worker=ServerState.worker_id))
+
+    status = ServerState.metrics.snapshot(gauges)
+    status.update(worker=ServerState.worker_id, workers=ServerState.workers)
+    return JSON_CODEC.dumps(status).decode('utf-8')
+
+
+async def promote_to_master():
     ServerState.master = None
-    ServerState.logger.warn('Lost connection to master and no others are available. Assuming role of master MQ')
-    yield
+    ServerState.logger.warning('Lost connection to master and no others are available. Assuming role of master MQ')
 
 
-def find_master():
-    loop = asyncio.get_event_loop()
+async def find_master():
+    loop = get_event_loop()
     ServerState.logger.info('Attempting to locate master CoreMQ server for replication...')
     servers = ServerState.cluster_nodes[:]
     removals = []
@@ -338,28 +1218,77 @@ def find_master():
         return
 
     factory = CoreMqClientFactory(ReplicationClientProtocol, servers, loop=loop)
-    yield asyncio.From(factory.connect())
+    await factory.connect()
     factory.lost_connection_callback = promote_to_master
 
     if not factory.connection:
-        ServerState.logger.warn('No other CoreMQ servers found. Assuming role of master MQ')
+        ServerState.logger.warning('No other CoreMQ servers found. Assuming role of master MQ')
     else:
-        conn = factory.connection[1]
-        conn.connected_future.add_done_callback(
-            lambda _: conn.begin_replication('%s:%s' % (ServerState.name, ServerState.listen_address[1]))
-        )
-        ServerState.master = conn
+        ServerState.master = factory.connection[1]
+
+
+def bus_message(queue, message):
+    payload = CoreMqServerProtocol.route(queue, message, from_bus=True)
+    CoreMqServerProtocol.store_message(queue, message, payload)
+
+
+def start_bus(loop):
+    bus = WorkerBus(
+        ServerState.worker_id, ServerState.workers, ServerState.worker_socket_dir, ServerState.listen_address[1],
+        loop=loop, logger=ServerState.logger
+    )
+    bus.message_handler = bus_message
+    bus.history_handler = CoreMqServerProtocol.read_history
+    bus.settings_handler = lambda settings: CoreMqServerProtocol.set_history_settings(settings, broadcast=False)
+    bus.request_handler = CoreMqServerProtocol.request_received
+    ServerState.subscribers.listener = bus
+    ServerState.bus = bus
+    loop.run_until_complete(bus.start())
+
+
+def serve(worker_id=0):
+    """
+    Runs the broker event loop, either as the only process or as one of several workers
+    :param worker_id: The index of this worker
+    """
+    ServerState.worker_id = worker_id
+    ServerState.message_ids = MessageIds()
+
+    # every worker sequences its own replication stream, so each needs its own epoch for replicants to resume in
+    ServerState.replication = ReplicationLog(
+        backlog=ServerState.replication_backlog,
+        batch_bytes=ServerState.replication_batch_bytes,
+        flush_interval=ServerState.replication_flush_interval
+    )
+    ServerState.upstream = UpstreamBatcher(
+        batch_bytes=ServerState.replication_batch_bytes,
+        flush_interval=ServerState.replication_flush_interval,
+        backlog=ServerState.replication_backlog
+    )
+    ServerState.logger.info('Event loop: %s (worker %s)', install_event_loop(ServerState.event_loop), worker_id)
+    loop = get_event_loop()
+
+    if ServerState.storage:
+        if ServerState.workers > 1:
+            ServerState.storage.path = os.path.join(ServerState.storage.path, 'worker-%s' % worker_id)
+        load_storage()
+
+    if ServerState.workers > 1:
+        start_bus(loop)
 
-
-def main():
-    load_settings()
-    ServerState.logger.info('CoreMQ Starting up...')
-
-    loop = asyncio.get_event_loop()
     address = ServerState.listen_address
-    server_coro = loop.create_server(lambda: CoreMqServerProtocol(), address[0], address[1])
+    sock = create_listen_socket(address, ServerState.listen_backlog, reuse_port=ServerState.workers > 1)
+    server_coro = loop.create_server(lambda: CoreMqServerProtocol(), sock=sock)
     loop.run_until_complete(server_coro)
-    ServerState.logger.info('CoreMQ Server running on %s' % address[1])
+    ServerState.logger.info('CoreMQ Server running on %s (worker %s)', address[1], worker_id)
+
+    maintain_metrics()
+    if ServerState.metrics_port:
+        metrics_port = ServerState.metrics_port + worker_id
+        loop.run_until_complete(loop.create_server(
+            lambda: MetricsHttpProtocol(collect_metrics), address[0], metrics_port
+        ))
+        ServerState.logger.info('Metrics available on http://%s:%s/metrics', address[0], metrics_port)
 
     if ServerState.cluster_nodes:
         loop.run_until_complete(find_master())
@@ -370,9 +1299,38 @@ def main():
         pass
     finally:
         ServerState.logger.info('Shutting down CoreMQ...')
+        if ServerState.bus:
+            ServerState.bus.close()
+        if ServerState.storage:
+            ServerState.storage.sync()
+            ServerState.storage.close()
+        ServerState.tracer.close()
         loop.close()
         ServerState.logger.info('CoreMQ is now shut down')
 
 
+def main():
+    load_settings()
+    ServerState.logger.info('CoreMQ Starting up...')
+
+    if ServerState.workers <= 1:
+        serve()
+        return
+
+    # the workers inherit the settings loaded above, which a spawned process would have to load again
+    context = multiprocessing.get_context('fork')
+    processes = [context.Process(target=serve, args=(i,)) for i in range(ServerState.workers)]
+    for p in processes:
+        p.start()
+
+    try:
+        for p in processes:
+            p.join()
+    except KeyboardInterrupt:
+        # the workers receive the same interrupt and shut themselves down
+        for p in processes:
+            p.join()
+
+
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,419 @@
+"""
+CoreMQ
+------
+A pure-Python messaging queue.
+
+License
+-------
+The MIT License (MIT)
+Copyright (c) 2015 Ross Peoples <ross.peoples@gmail.com>
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+Benchmarks the brokers. Each scenario starts a fresh broker, connects subscriber and publisher processes to it and
+reports throughput, latency percentiles and the broker's memory and CPU use as JSON:
+
+    python -m coremq.benchmark --server aio threaded --publishers 1 4 --subscribers 1 10 --output results.json
+
+--loop asyncio uvloop runs the aio scenarios with both event loops, uvloop must be installed.
+
+Passing the output of an earlier run as --baseline reports every scenario that got slower by more than --tolerance,
+and exits with status 1 if there are any.
+"""
+
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from .client import MessageQueue
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+SERVER_SCRIPTS = dict(aio='aio_server.py', threaded='server.py')
+EVENT_LOOPS = ('asyncio', 'uvloop')
+QUEUE = 'coremq_benchmark'
+
+# the matrix dimensions, in the order they appear in scenario names
+DIMENSIONS = ('server', 'loop', 'publishers', 'subscribers', 'payload', 'batch', 'window')
+DEFAULT_MATRIX = dict(
+    server=['aio'],
+    loop=['asyncio'],
+    publishers=[1, 4],
+    subscribers=[1, 10],
+    payload=[64, 4096],
+    batch=[1, 50],
+    window=[1, 100],
+)
+
+
+def scenario_name(scenario):
+    return ' '.join('%s=%s' % (d, scenario[d]) for d in DIMENSIONS)
+
+
+def percentile(values, p):
+    """
+    :param values: Sorted list of numbers
+    :param p: The percentile, between 0 and 100
+    """
+    if not values:
+        return None
+
+    return values[min(int(len(values) * p / 100.0), len(values) - 1)]
+
+
+def process_usage(pid):
+    """
+    Returns the memory and CPU time used by a process and its children, which is where server.py does its work
+    :return: (int, float) - resident set size in bytes and CPU seconds, or (None, None) if they cannot be read
+    """
+    if psutil is not None:
+        try:
+            parent = psutil.Process(pid)
+            processes = [parent] + parent.children(recursive=True)
+            rss = sum(p.memory_info().rss for p in processes)
+            cpu = sum(sum(p.cpu_times()[:2]) for p in processes)
+            return rss, cpu
+        except psutil.Error:
+            return None, None
+
+    if not os.path.isdir('/proc/%s' % pid):
+        return None, None
+
+    # without psutil, read the same numbers from /proc on Linux
+    pids = [pid]
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open('/proc/%s/stat' % entry) as f:
+                    if int(f.read().rsplit(')', 1)[1].split()[1]) == pid:
+                        pids.append(int(entry))
+            except (IOError, OSError, IndexError, ValueError):
+                pass
+
+    rss = 0
+    cpu = 0.0
+    ticks = os.sysconf('SC_CLK_TCK')
+    page_size = os.sysconf('SC_PAGE_SIZE')
+    for p in pids:
+        try:
+            with open('/proc/%s/stat' % p) as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+            cpu += (int(fields[11]) + int(fields[12])) / float(ticks)
+            rss += int(fields[21]) * page_size
+        except (IOError, OSError, IndexError, ValueError):
+            pass
+
+    return rss, cpu
+
+
+def free_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class Broker(object):
+    """
+    A broker running in a subprocess, started in a temporary directory with its own configuration file
+    """
+    def __init__(self, server, port, settings=None):
+        self.server = server
+        self.port = port
+        self.settings = settings or dict()
+        self.directory = None
+        self.process = None
+        self.log = None
+
+    def start(self, timeout=10):
+        self.directory = tempfile.mkdtemp(prefix='coremq-benchmark-')
+        with open(os.path.join(self.directory, 'coremq.conf'), 'w') as f:
+            f.write('[CoreMQ]\nport = %s\nlog_level = WARN\n' % self.port)
+            for key, val in self.settings.items():
+                f.write('%s = %s\n' % (key, val))
+
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), SERVER_SCRIPTS[self.server])
+        self.log = open(os.path.join(self.directory, 'broker.log'), 'w')
+        # the broker gets its own process group, so that stopping it also stops the processes it starts
+        self.process = subprocess.Popen(
+            [sys.executable, script, str(self.port)], cwd=self.directory, stdout=self.log, stderr=subprocess.STDOUT,
+            preexec_fn=os.setsid
+        )
+
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.process.poll() is not None:
+                break
+
+            try:
+                socket.create_connection(('127.0.0.1', self.port), 1).close()
+                return
+            except socket.error:
+                time.sleep(0.1)
+
+        self.stop()
+        raise RuntimeError('The %s broker did not start, see its log in %s' % (self.server, self.directory))
+
+    def usage(self):
+        return process_usage(self.process.pid)
+
+    def stop(self, timeout=10):
+        if self.process is not None and self.process.poll() is None:
+            os.killpg(self.process.pid, signal.SIGTERM)
+            deadline = time.time() + timeout
+            while self.process.poll() is None and time.time() < deadline:
+                time.sleep(0.1)
+
+            if self.process.poll() is None:
+                os.killpg(self.process.pid, signal.SIGKILL)
+                self.process.wait()
+
+        if self.log is not None:
+            self.log.close()
+            self.log = None
+
+    def cleanup(self):
+        if self.directory:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def subscriber(port, expected, ready, start, results, idle_timeout):
+    m = MessageQueue('127.0.0.1', port)
+    m.connect()
+    m.subscribe(QUEUE)
+    ready.put(True)
+    start.wait()
+
+    latencies = []
+    last = None
+    idle_since = time.time()
+    while len(latencies) < expected:
+        queue, message = m.get_message(timeout=1)
+        now = time.time()
+        if queue != QUEUE:
+            if now - idle_since > idle_timeout:
+                break
+            continue
+
+        latencies.append(now - message['t'])
+        last = idle_since = now
+
+    m.close()
+    results.put(('subscriber', dict(latencies=latencies, last=last)))
+
+
+def publisher(port, count, payload, batch, window, ready, start, results):
+    m = MessageQueue('127.0.0.1', port, window=window)
+    m.connect()
+    padding = 'x' * payload
+    ready.put(True)
+    start.wait()
+
+    errors = 0
+    began = time.time()
+    sent = 0
+    while sent < count:
+        size = min(batch, count - sent)
+        try:
+            if batch > 1:
+                m.send_batch([(QUEUE, dict(t=time.time(), p=padding)) for i in range(size)])
+            else:
+                m.send_message(QUEUE, dict(t=time.time(), p=padding))
+        except socket.error:
+            errors += size
+        sent += size
+
+    errors += len(m.flush())
+    ended = time.time()
+    m.close()
+    results.put(('publisher', dict(began=began, ended=ended, errors=errors)))
+
+
+def run_scenario(scenario, messages, idle_timeout=5):
+    """
+    Runs one scenario against a freshly started broker
+    :param scenario: dict with a value for every name in DIMENSIONS
+    :param messages: The number of messages each publisher sends
+    :return: dict - the scenario and its results
+    """
+    result = dict(scenario)
+    result['name'] = scenario_name(scenario)
+    if scenario['server'] == 'threaded' and scenario['batch'] > 1:
+        result['skipped'] = 'server.py does not support batches'
+        return result
+    elif scenario['server'] == 'threaded' and scenario['loop'] != 'asyncio':
+        result['skipped'] = 'server.py does not use an event loop'
+        return result
+
+    broker = Broker(scenario['server'], free_port(), dict(event_loop=scenario['loop']))
+    broker.start()
+    try:
+        ready = multiprocessing.Queue()
+        results = multiprocessing.Queue()
+        start = multiprocessing.Event()
+        expected = scenario['publishers'] * messages
+        processes = [multiprocessing.Process(
+            target=subscriber, args=(broker.port, expected, ready, start, results, idle_timeout)
+        ) for i in range(scenario['subscribers'])]
+        processes.extend(multiprocessing.Process(
+            target=publisher,
+            args=(broker.port, messages, scenario['payload'], scenario['batch'], scenario['window'], ready, start,
+                  results)
+        ) for i in range(scenario['publishers']))
+
+        for p in processes:
+            p.start()
+        for p in processes:
+            ready.get(timeout=60)
+
+        rss_before, cpu_before = broker.usage()
+        began = time.time()
+        start.set()
+
+        collected = [results.get() for p in processes]
+        for p in processes:
+            p.join()
+
+        rss, cpu = broker.usage()
+    finally:
+        broker.stop()
+        broker.cleanup()
+
+    publishers = [r for kind, r in collected if kind == 'publisher']
+    subscribers = [r for kind, r in collected if kind == 'subscriber']
+    latencies = sorted(itertools.chain.from_iterable(s['latencies'] for s in subscribers))
+    published = scenario['publishers'] * messages
+    publish_time = max(p['ended'] for p in publishers) - began
+    last = [s['last'] for s in subscribers if s['last']]
+    deliver_time = max(last) - began if last else None
+
+    result.update(
+        messages=published,
+        errors=sum(p['errors'] for p in publishers),
+        delivered=len(latencies),
+        lost=published * scenario['subscribers'] - len(latencies),
+        publish_throughput=published / publish_time if publish_time > 0 else None,
+        deliver_throughput=len(latencies) / deliver_time if deliver_time else None,
+        latency_p50=percentile(latencies, 50),
+        latency_p99=percentile(latencies, 99),
+        latency_p999=percentile(latencies, 99.9),
+        latency_max=latencies[-1] if latencies else None,
+        broker_rss=rss,
+        broker_rss_growth=rss - rss_before if rss is not None and rss_before is not None else None,
+        broker_cpu=cpu - cpu_before if cpu is not None and cpu_before is not None else None,
+    )
+    if result['broker_cpu'] is not None and deliver_time:
+        result['broker_cpu_percent'] = 100 * result['broker_cpu'] / max(deliver_time, publish_time)
+
+    return result
+
+
+def compare(results, baseline, tolerance):
+    """
+    Finds the scenarios that regressed against a baseline
+    :param results: list of scenario results
+    :param baseline: list of scenario results from an earlier run
+    :param tolerance: The fraction a value may get worse by before it counts as a regression
+    :return: list of str - a description of every regression
+    """
+    before = dict((r['name'], r) for r in baseline)
+    regressions = []
+    for r in results:
+        old = before.get(r['name'])
+        if old is None or 'skipped' in r or 'skipped' in old:
+            continue
+
+        # throughput should not go down, latency and memory should not go up
+        for key, higher_is_better in (('publish_throughput', True), ('deliver_throughput', True),
+                                      ('latency_p50', False), ('latency_p99', False), ('broker_rss', False)):
+            new_val, old_val = r.get(key), old.get(key)
+            if not new_val or not old_val:
+                continue
+
+            change = (new_val - old_val) / float(old_val)
+            if (higher_is_better and change < -tolerance) or (not higher_is_better and change > tolerance):
+                regressions.append('%s: %s %s -> %s (%+.1f%%)' % (r['name'], key, old_val, new_val, change * 100))
+
+        if r.get('lost', 0) > old.get('lost', 0):
+            regressions.append('%s: lost %s -> %s' % (r['name'], old.get('lost', 0), r['lost']))
+
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks the CoreMQ brokers')
+    parser.add_argument('--server', nargs='+', choices=sorted(SERVER_SCRIPTS), default=DEFAULT_MATRIX['server'])
+    parser.add_argument('--loop', nargs='+', choices=EVENT_LOOPS, default=DEFAULT_MATRIX['loop'])
+    for dimension in DIMENSIONS[2:]:
+        parser.add_argument('--' + dimension, nargs='+', type=int, default=DEFAULT_MATRIX[dimension])
+    parser.add_argument('--messages', type=int, default=2000, help='messages sent by each publisher')
+    parser.add_argument('--output', help='file to write the results to, default stdout')
+    parser.add_argument('--baseline', help='results of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='fraction a result may get worse by')
+    args = parser.parse_args(argv)
+
+    matrix = [dict(zip(DIMENSIONS, values)) for values in itertools.product(
+        *[getattr(args, d) for d in DIMENSIONS]
+    )]
+
+    results = []
+    for scenario in matrix:
+        sys.stderr.write('%s\n' % scenario_name(scenario))
+        results.append(run_scenario(scenario, args.messages))
+
+    report = dict(
+        created=time.time(),
+        python=platform.python_version(),
+        platform=platform.platform(),
+        cpus=multiprocessing.cpu_count(),
+        messages=args.messages,
+        results=results,
+    )
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f)['results'], args.tolerance)
+        report['regressions'] = regressions
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+    for r in regressions:
+        sys.stderr.write('REGRESSION %s\n' % r)
+
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
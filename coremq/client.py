@@ -24,21 +24,53 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
+from collections import deque
+import itertools
 import socket
-from .common import get_message, send_message
+import time
+from .common import get_message, negotiate_codec, negotiate_protocol, send_message, validate_queue, ResponseError, \
+    JSON_CODEC, PROTOCOL_V1, PROTOCOL_V2, str_type
 
 
 class MessageQueue(object):
-    def __init__(self, server, port=6747):
+    def __init__(self, server, port=6747, protocol=PROTOCOL_V2, codec=JSON_CODEC.name, window=1, ack=True,
+                 ack_timeout=30):
+        """
+        :param server: The CoreMQ server to connect to
+        :param port: The port the server listens on
+        :param protocol: The highest wire protocol version to negotiate
+        :param codec: The name of the codec to negotiate for protocol version 2
+        :param window: The number of published messages that may be awaiting acknowledgement. With the default of 1,
+                       send_message waits for each response. Anything larger pipelines messages, see flush()
+        :param ack: Set to False to ask the server not to acknowledge published messages at all
+        :param ack_timeout: Seconds to wait for an acknowledgement before giving up
+        """
+        if window < 1:
+            raise ValueError('window must be at least 1')
+
         self.server = server
         self.port = port
+        self.window = window
+        self.ack_timeout = ack_timeout
+        self.in_flight = 0  # published messages not yet acknowledged
+        self.pending = deque()  # messages received while waiting for acknowledgements
+        self.errors = []  # error responses to pipelined messages, see flush()
+        self.preferred_protocol = protocol
+        self.preferred_codec = codec
+        self.protocol_version = PROTOCOL_V1
+        self.codec = JSON_CODEC
         self.socket = None
         self.connection_id = None
         self.welcome_message = None
         self.subscriptions = []
+        self.responding = []  # queues this client answers requests for
+        self.correlation_ids = itertools.count(1)
         self.options = dict()
         self.last_message_time = 0
 
+        if not ack:
+            self.options['ack'] = False
+
     def connect(self):
         if self.socket:
             return
@@ -46,11 +78,26 @@ class MessageQueue(object):
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.socket.settimeout(30)
         self.socket.connect((self.server, self.port))
+        self.protocol_version = PROTOCOL_V1
+        self.codec = JSON_CODEC
+        self.in_flight = 0
+        self.pending.clear()
+        self.errors = []
         self.connection_id, self.welcome_message = get_message(self.socket)
 
+        protocol = negotiate_protocol(self.welcome_message, self.preferred_protocol)
+        if protocol != PROTOCOL_V1:
+            codec = negotiate_codec(self.welcome_message, protocol, self.preferred_codec)
+            self._command(dict(coremq_protocol=protocol, coremq_codec=codec.name))
+            self.protocol_version = protocol
+            self.codec = codec
+
         if self.subscriptions:
             self.subscribe(*self.subscriptions)
 
+        if self.responding:
+            self.respond(*self.responding)
+
         if self.options:
             self.set_options(**self.options)
 
@@ -59,24 +106,195 @@ class MessageQueue(object):
             self.socket.close()
             self.socket = None
 
+    @property
+    def ack(self):
+        return self.options.get('ack', True)
+
     def send_message(self, queue, message):
+        """
+        Publishes a message to a queue
+        :param queue: The queue name
+        :param message: dict or str
+        :return: (queue, message) - the server's response when window is 1, otherwise (None, None). Pipelined messages
+                 only block once window messages are awaiting acknowledgement
+        """
+        return self._publish(queue, message)
+
+    def send_batch(self, messages):
+        """
+        Publishes many messages in a single frame, which the server routes in one pass and acknowledges once. Batches
+        count as one message towards the pipelining window.
+        :param messages: iterable of (queue, message) pairs
+        :return: (queue, message) - see send_message
+        """
+        batch = []
+        for queue, message in messages:
+            validate_queue(queue)
+            batch.append([queue, message])
+
+        if not self.connection_id:
+            self.connect()
+
+        return self._publish(self.connection_id, dict(coremq_batch=batch))
+
+    def request(self, queue, message, timeout=30):
+        """
+        Sends a request and waits for its reply. Messages received in the meantime are kept for get_message.
+        :param queue: The queue name, which can have responders or be the connection ID of another client
+        :param message: dict or str
+        :param timeout: Seconds to wait for the reply
+        :return: dict - the reply
+        """
+        if isinstance(message, str_type):
+            message = dict(coremq_string=message)
+
+        if not self.connection_id:
+            self.connect()
+
+        correlation = str(next(self.correlation_ids))
+        self._send(queue, dict(message, coremq_replyto=self.connection_id, coremq_correlation=correlation))
+        acknowledged = not self.ack
+
+        deadline = time.time() + timeout
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise socket.timeout('Timed out waiting for a reply')
+
+            q, reply = self._read(remaining)
+            if reply is None:
+                continue
+            elif reply.get('coremq_correlation') == correlation and 'coremq_replyto' not in reply:
+                if 'coremq_error' in reply:
+                    raise ResponseError(reply['coremq_error'])
+                return reply
+            elif self._is_ack(q, reply):
+                continue
+            elif not acknowledged and q == self.connection_id and 'response' in reply and \
+                    'coremq_sender' not in reply:
+                # the server answers the request itself before any reply can arrive
+                acknowledged = True
+                if reply['response'].startswith('ERROR'):
+                    raise ResponseError(reply['response'])
+                continue
+
+            self.pending.append((q, reply))
+
+    def reply(self, request, message):
+        """
+        Answers a request received from get_message
+        :param request: The request message
+        :param message: dict or str
+        """
+        if isinstance(message, str_type):
+            message = dict(coremq_string=message)
+
+        self._send(request['coremq_replyto'], dict(message, coremq_correlation=request['coremq_correlation']))
+
+        # more requests can arrive before the acknowledgement, so it is always waited for like a pipelined message
+        # and anything else read in the meantime is kept for get_message
+        if self.ack:
+            self.in_flight += 1
+            while self.in_flight >= self.window:
+                self._wait_for_ack()
+
+    def _publish(self, queue, message):
+        self._send(queue, message)
+
+        if not self.ack:
+            return None, None
+
+        if self.window > 1:
+            self.in_flight += 1
+            while self.in_flight >= self.window:
+                self._wait_for_ack()
+
+            return None, None
+
+        try:
+            return self._wait_for_response()
+        except socket.error:
+            return None, None
+
+    def flush(self):
+        """
+        Waits until every pipelined message has been acknowledged
+        :return: list of error responses received for pipelined messages since the last flush
+        """
+        while self.in_flight > 0:
+            self._wait_for_ack()
+
+        errors = self.errors
+        self.errors = []
+        return errors
+
+    def _send(self, queue, message):
         if not self.socket:
             self.connect()
 
         try:
-            send_message(self.socket, queue, message)
+            send_message(self.socket, queue, message, self.protocol_version, self.codec)
         except socket.error:
             # attempt to reconnect if there was a connection error
             self.close()
             self.connect()
-            send_message(self.socket, queue, message)
+            send_message(self.socket, queue, message, self.protocol_version, self.codec)
+
+    def _command(self, message):
+        # commands are never pipelined, so their response is the next one the server sends on the connection queue
+        self.flush()
+        self._send(self.connection_id, message)
 
         try:
-            return self.get_message()
+            return self._wait_for_response()
         except socket.error:
             return None, None
 
+    def _wait_for_response(self, timeout=1):
+        # subscription traffic read before the response is kept for get_message
+        while True:
+            queue, message = self._read(timeout)
+            if queue is None and message is None:
+                return queue, message
+
+            if queue == self.connection_id and isinstance(message, dict) and 'response' in message:
+                return queue, message
+
+            self.pending.append((queue, message))
+
+    def _is_ack(self, queue, message):
+        if not self.in_flight or queue != self.connection_id or not isinstance(message, dict):
+            return False
+
+        response = message.get('response', '')
+        if response.startswith(('OK: Message sent', 'OK: Batch sent')):
+            self.in_flight -= 1
+            return True
+        elif response.startswith('ERROR'):
+            self.in_flight -= 1
+            self.errors.append(response)
+            return True
+
+        return False
+
+    def _wait_for_ack(self):
+        queue, message = self._read(self.ack_timeout)
+        if queue is None and message is None:
+            raise socket.timeout('Timed out waiting for acknowledgement')
+
+        if not self._is_ack(queue, message):
+            self.pending.append((queue, message))
+
     def get_message(self, timeout=1):
+        if self.pending:
+            return self.pending.popleft()
+
+        while True:
+            queue, message = self._read(timeout)
+            if not self._is_ack(queue, message):
+                return queue, message
+
+    def _read(self, timeout):
         if not self.socket:
             self.connect()
 
@@ -104,23 +322,6 @@ class MessageQueue(object):
             if m[0]:
                 print(m[0], m[1])
 
-    def stress(self, queue, count=10000, wait=0, silent=False):
-        import time
-
-        start_time = time.time()
-        for i in range(count):
-            self.send_message(queue, dict(iteration=i))
-            if wait:
-                time.sleep(wait)
-        end_time = time.time()
-
-        if not silent:
-            print('Stress results:')
-            print('Iterations: %s' % count)
-            print('Forced wait time: %s' % wait)
-            print('Time taken: %s seconds' % (end_time - start_time))
-            print('Messages per second: %s' % (float(count) / (end_time - start_time)))
-
     def get_history(self, *queues):
         if not queues:
             queues = self.subscriptions
@@ -131,7 +332,25 @@ class MessageQueue(object):
         if not isinstance(queues, (list, tuple)):
             queues = [queues]
 
-        return self.send_message(self.connection_id, dict(coremq_gethistory=queues))
+        return self._command(dict(coremq_gethistory=queues))
+
+    def get_status(self):
+        """
+        Returns the server's status, including its metrics
+        """
+        return self._command(dict(coremq_status=True))
+
+    def set_history_settings(self, pattern, depth=None, max_bytes=None, max_age=None):
+        """
+        Changes how much history the server keeps for the queues matching a pattern
+        :param pattern: Queue name or pattern, matched like subscriptions, such as orders.#
+        :param depth: The number of messages to keep, 0 disables history
+        :param max_bytes: The maximum total size of the messages to keep
+        :param max_age: The maximum age in seconds of the messages to keep
+        """
+        return self._command(dict(coremq_history_settings=dict(
+            pattern=pattern, depth=depth, max_bytes=max_bytes, max_age=max_age
+        )))
 
     def subscribe(self, *queues):
         if not queues:
@@ -144,7 +363,7 @@ class MessageQueue(object):
             if q not in self.subscriptions:
                 self.subscriptions.append(q)
 
-        return self.send_message(self.connection_id, dict(coremq_subscribe=queues))
+        return self._command(dict(coremq_subscribe=queues))
 
     def unsubscribe(self, *queues):
         if not queues:
@@ -157,7 +376,31 @@ class MessageQueue(object):
             if q in self.subscriptions:
                 self.subscriptions.remove(q)
 
-        return self.send_message(self.connection_id, dict(coremq_unsubscribe=queues))
+        return self._command(dict(coremq_unsubscribe=queues))
+
+    def respond(self, *queues):
+        """
+        Makes this client one of the responders for queues. Requests sent to them go to one responder at a time, and are
+        read with get_message and answered with reply.
+        """
+        if not queues:
+            raise ValueError('Must pass at least one queue name')
+
+        for q in queues:
+            if q not in self.responding:
+                self.responding.append(q)
+
+        return self._command(dict(coremq_respond=queues))
+
+    def unrespond(self, *queues):
+        if not queues:
+            raise ValueError('Must pass at least one queue name')
+
+        for q in queues:
+            if q in self.responding:
+                self.responding.remove(q)
+
+        return self._command(dict(coremq_unrespond=queues))
 
     def set_options(self, **options):
         self.options.update(options)
@@ -166,111 +409,5 @@ class MessageQueue(object):
             if val is None and key in self.options:
                 del self.options[key]
 
-        return self.send_message(self.connection_id, dict(coremq_options=options))
-
-
-def stress_worker(args):
-    import random
-    import time
-    server, port, queue, count, wait, listen_only = args
+        return self._command(dict(coremq_options=options))
 
-    time.sleep(random.uniform(0, 1))
-    m = MessageQueue(server, port)
-    try:
-        m.connect()
-    except:
-        time.sleep(1)
-        m.connect()
-
-    if listen_only:
-        try:
-            m.subscribe(queue)
-            messages = 0
-            null_msg = 0
-            errors = 0
-            for i in range(count):
-                try:
-                    msg = m.get_message(timeout=10)
-                    if msg[0] is not None:
-                        messages += 1
-                    else:
-                        null_msg += 1
-                        if null_msg >= 2:
-                            break
-                except:
-                    errors += 1
-        except:
-            return count, 1
-
-        m.close()
-
-        return count - messages, errors
-    else:
-        time.sleep(random.uniform(0, 1))
-        errors = 0
-        start_time = time.time()
-        for i in range(count):
-            try:
-                m.send_message(queue, dict(iteration=i+1))
-                if wait:
-                    time.sleep(wait)
-            except:
-                errors += 1
-
-        end_time = time.time()
-
-        m.close()
-        return end_time - start_time, float(count) / (end_time - start_time), errors
-
-
-def parallel_stress(server, port, queue, count=1000, wait=0.01, workers=10, listeners=90):
-    import multiprocessing
-
-    print('Beginning stress test with these settings:')
-    print('Server: %s' % server)
-    print('Queue: %s' % queue)
-    print('Count per worker: %s' % count)
-    print('Delay between messages: %s' % wait)
-    print('Number of workers: %s' % workers)
-    print('Number of listeners: %s' % listeners)
-    print('')
-
-    pool1 = multiprocessing.Pool(listeners)
-    pool2 = multiprocessing.Pool(workers)
-    tasks1 = [(server, port, queue, count, wait, True) for i in range(listeners)]
-    tasks2 = [(server, port, queue, count, wait, False) for i in range(workers)]
-
-    job1 = pool1.map_async(stress_worker, tasks1)
-    job2 = pool2.map_async(stress_worker, tasks2)
-    job1.wait()
-    job2.wait()
-    listen_results = job1.get()
-    worker_results = job2.get()
-    slowest = 0
-    fastest = 9999
-    average_mps = 0
-    errors = 0
-    missed = 0
-
-    for t, mps, errs in worker_results:
-        if t > slowest:
-            slowest = t
-
-        if t < fastest:
-            fastest = t
-
-        average_mps += mps
-        errors += errs
-
-    average_mps /= float(workers)
-
-    for m, errs in listen_results:
-        missed += m
-
-    print('Test results:')
-    print('Total count: %s' % (count * workers))
-    print('Fastest worker: %s seconds' % fastest)
-    print('Slowest worker: %s seconds' % slowest)
-    print('Number of errors: %s' % errors)
-    print('Number of missing messages: %s' % missed)
-    print('Average messages per second: %s' % average_mps)
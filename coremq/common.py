@@ -24,10 +24,13 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
+from collections import deque
 import logging
 import json
 import os
+import struct
 import sys
+import weakref
 
 if sys.version[0] == '2':
     str_type = basestring
@@ -39,6 +42,22 @@ else:
 
 loggers = dict()
 
+# Wire protocol versions. Version 1 frames are text: "+<length> <queue> <message>". Version 2 frames start with a
+# fixed-width binary header (marker, flags, queue name length, message length) followed by the raw queue name and
+# message bytes, so nothing has to be decoded to find frame boundaries. Version 2 is opt-in: the server lists the
+# versions and codecs it supports in its welcome message and the client switches with the coremq_protocol command.
+PROTOCOL_V1 = 1
+PROTOCOL_V2 = 2
+PROTOCOLS = (PROTOCOL_V1, PROTOCOL_V2)
+V1_MAX_LENGTH = 99999999  # 100 MB max int that can fit in message header (8 characters, plus two controls)
+V2_MARKER = 0x02  # never a valid first byte for version 1, which always starts with +
+V2_HEADER = struct.Struct('!BBHI')
+V2_MAX_LENGTH = 0xffffffff
+V2_MAX_QUEUE_LENGTH = 0xffff
+FLAG_CODEC_MASK = 0x0f  # the low bits of the version 2 flags identify the codec the message was serialized with
+RECV_SIZE = 64 * 1024  # bytes read from a blocking socket at a time, see get_message
+receive_buffers = weakref.WeakKeyDictionary()  # socket to the FrameParser and parsed frames not yet returned
+
 
 class ConnectionClosed(Exception):
     pass
@@ -48,15 +67,97 @@ class ProtocolError(Exception):
     pass
 
 
+class ResponseError(Exception):
+    """
+    The server answered a request with an ERROR response
+    """
+    pass
+
+
+class Codec(object):
+    """
+    A message serializer. dumps must return bytes and loads must accept bytes. The codec_id is sent in the flags of
+    every version 2 frame, so a receiver can always decode a frame no matter which codec the sender chose.
+    """
+    def __init__(self, name, codec_id, dumps, loads):
+        self.name = name
+        self.id = codec_id
+        self.dumps = dumps
+        self.loads = loads
+
+
+codecs = dict()  # registered codecs by name
+codecs_by_id = dict()
+
+
+def register_codec(name, codec_id, dumps, loads):
+    """
+    Makes a codec available for negotiation. Both ends of a connection must register a codec under the same name and
+    ID to use it.
+    :param name: The name clients ask for during negotiation
+    :param codec_id: int between 0 and 15
+    :param dumps: function taking a message and returning bytes
+    :param loads: function taking bytes and returning a message
+    :return: Codec
+    """
+    if not 0 <= codec_id <= FLAG_CODEC_MASK:
+        raise ValueError('Codec ID must be between 0 and %s' % FLAG_CODEC_MASK)
+
+    if codec_id in codecs_by_id and codecs_by_id[codec_id].name != name:
+        raise ValueError('Codec ID %s is already used by %s' % (codec_id, codecs_by_id[codec_id].name))
+
+    codec = Codec(name, codec_id, dumps, loads)
+    codecs[name] = codec
+    codecs_by_id[codec_id] = codec
+    return codec
+
+
+def get_codec(name):
+    if name not in codecs:
+        raise ValueError('Unknown codec: %s' % name)
+
+    return codecs[name]
+
+
+# JSON is always available and is the only codec version 1 frames can carry. orjson produces the same format much
+# faster, so it is used for the json codec whenever it is installed.
+try:
+    import orjson
+    JSON_CODEC = register_codec(
+        'json', 0, lambda m: orjson.dumps(m, option=orjson.OPT_NON_STR_KEYS), orjson.loads
+    )
+except ImportError:
+    JSON_CODEC = register_codec(
+        'json', 0, lambda m: json.dumps(m).encode('utf-8'), lambda b: json.loads(b.decode('utf-8'))
+    )
+
+try:
+    import msgpack
+    register_codec('msgpack', 1, lambda m: msgpack.packb(m, use_bin_type=True), lambda b: msgpack.unpackb(b, raw=False))
+except ImportError:
+    pass
+
+
 class CoreConfigParser(ConfigParser, object):
-    def get(self, section, option, default=None):
+    def optionxform(self, optionstr):
+        # option names are kept as written, since the History section uses case-sensitive queue name patterns
+        return optionstr
+
+    def get(self, section, option, default=None, **kwargs):
+        # Python 3 interpolation calls get with raw and fallback keyword arguments
         try:
-            return super(CoreConfigParser, self).get(section, option)
+            return super(CoreConfigParser, self).get(section, option, **kwargs)
         except (NoOptionError, NoSectionError):
             return default
 
+    def items(self, section, default=None):
+        try:
+            return super(CoreConfigParser, self).items(section)
+        except NoSectionError:
+            return default or []
+
 
-def construct_message(queue, message):
+def validate_queue(queue):
     if not isinstance(queue, str_type):
         raise ValueError('Queue name must be a string, not %s' % queue)
 
@@ -66,66 +167,226 @@ def construct_message(queue, message):
     if ' ' in queue:
         raise ValueError('Queue name must not contain spaces')
 
+
+def encode_message(message, codec=JSON_CODEC):
+    """
+    Serializes a message for the wire
+    :param message: dict, or str which is wrapped as dict(coremq_string=message)
+    :param codec: The Codec to serialize with
+    :return: bytes
+    """
     if isinstance(message, str_type):
         message = dict(coremq_string=message)
 
-    if isinstance(message, dict):
-        message = json.dumps(message)
-    else:
+    if not isinstance(message, dict):
         raise ValueError('Messages should be either a dictionary or a string')
 
-    if len(message) > 99999999:  # 100 MB max int that can fit in message header (8 characters, plus two controls)
+    return codec.dumps(message)
+
+
+def decode_message(message, flags=0):
+    """
+    Deserializes a message received in a frame
+    :param message: The message bytes from FrameParser or get_message
+    :param flags: The header flags of the frame, which identify the codec
+    :return: The message
+    """
+    codec = codecs_by_id.get(flags & FLAG_CODEC_MASK)
+    if codec is None:
+        raise ProtocolError('Unknown codec ID: %s' % (flags & FLAG_CODEC_MASK))
+
+    return codec.loads(message)
+
+
+def construct_frame(queue, message, protocol=PROTOCOL_V1, flags=0):
+    """
+    Wraps an already encoded message in a frame for the given protocol version
+    :param queue: The queue name
+    :param message: bytes from encode_message
+    :param protocol: PROTOCOL_V1 or PROTOCOL_V2
+    :param flags: Version 2 header flags, usually the ID of the codec used by encode_message
+    :return: bytes
+    """
+    queue = queue.encode('utf-8')
+
+    if protocol == PROTOCOL_V2:
+        if len(message) > V2_MAX_LENGTH:
+            raise ValueError('Message cannot be 4GB or larger')
+
+        if len(queue) > V2_MAX_QUEUE_LENGTH:
+            raise ValueError('Queue name cannot be 64KB or larger')
+
+        return V2_HEADER.pack(V2_MARKER, flags, len(queue), len(message)) + queue + message
+
+    length = len(message) + len(queue) + 1
+    if length > V1_MAX_LENGTH:
         raise ValueError('Message cannot be 100MB or larger')
 
-    if not isinstance(message, bytes):
-        message = message.encode('utf-8')
+    return b''.join((('+%s ' % length).encode('utf-8'), queue, b' ', message))
+
 
-    return ('+%s %s ' % (len(message) + len(queue) + 1, queue)).encode('utf-8') + message
+def construct_message(queue, message, protocol=PROTOCOL_V1, codec=JSON_CODEC):
+    validate_queue(queue)
 
+    if protocol == PROTOCOL_V1:
+        codec = JSON_CODEC
 
-def send_message(socket, queue, message):
-    socket.send(construct_message(queue, message))
+    return construct_frame(queue, encode_message(message, codec), protocol, codec.id)
+
+
+def send_message(socket, queue, message, protocol=PROTOCOL_V1, codec=JSON_CODEC):
+    socket.send(construct_message(queue, message, protocol, codec))
 
 
 def get_message(socket, timeout=1):
-    socket.settimeout(timeout)
-    data = socket.recv(10).decode('utf-8')
-    expected_length, data = validate_header(data)
+    """
+    Reads the next message from a blocking socket. Data is received in large chunks and split into frames with a
+    FrameParser kept for the socket, so frames received past the one returned are kept for the next call.
+    :param socket: The socket to read from
+    :param timeout: Seconds to wait for data, raises socket.timeout once they pass
+    :return: (str, message) - the queue name and the decoded message, or (None, str) for a version 1 frame without a
+             space separating the queue from the message
+    """
+    state = receive_buffers.get(socket)
+    if state is None:
+        state = receive_buffers[socket] = (FrameParser(), deque())
 
-    while len(data) < expected_length:
-        data += socket.recv(expected_length - len(data)).decode('utf-8')
+    parser, frames = state
+    if not frames:
+        socket.settimeout(timeout)
+        while not frames:
+            data = socket.recv(RECV_SIZE)
+            if not data:
+                raise ConnectionClosed()
 
-    if ' ' not in data:
-        return None, data
+            frames.extend(parser.feed(data))
 
-    queue, message = data.split(' ', 1)
-    return queue, json.loads(message)
+    queue, data, flags = frames.popleft()
+    if data is None:
+        return None, queue
 
+    return queue, decode_message(data, flags)
 
-def validate_header(data):
+
+def decode_queue(data):
     """
-    Validates that data is in the form of "+5 Hello", with + beginning messages, followed by the length of the
-    message as an integer, followed by a space, then the message.
-    :param data: The raw data from the socket
-    :return: (int, str) - the expected length of the message, the message
+    :param data: The queue name bytes of a frame
+    :return: str
     """
-    if not data:
-        raise ConnectionClosed()
+    try:
+        return data.decode('utf-8')
+    except UnicodeDecodeError:
+        raise ProtocolError('Queue name must be UTF-8')
 
-    if data[0] != '+':
-        raise ProtocolError('Missing beginning +')
 
-    if ' ' not in data:
-        raise ProtocolError('Missing space after length')
+class FrameParser(object):
+    """
+    Incremental parser for both wire protocol versions. Data is fed in as it arrives from the transport, in whatever
+    chunks TCP delivered it, and every message that is complete so far is returned. Incomplete data stays in the
+    buffer until the next call. Each frame identifies its own version, so a peer may switch versions mid-stream.
+    """
+    MAX_HEADER = 10  # "+" plus up to 8 digits plus the space, see construct_frame
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        """
+        Adds data to the buffer and extracts all complete messages
+        :param data: bytes received from the transport
+        :return: list of (str, bytes, int) - queue name, undecoded message and header flags for each complete frame.
+                 The message is None if a version 1 frame did not contain a space separating the queue from the message
+        """
+        buf = self.buffer
+        buf.extend(data)
+        end = len(buf)
+        pos = 0
+        frames = []
+        view = memoryview(buf)
 
-    length, data = data.split(' ', 1)
+        try:
+            while pos < end:
+                if buf[pos] == V2_MARKER:
+                    if end - pos < V2_HEADER.size:
+                        break
+
+                    marker, flags, queue_length, message_length = V2_HEADER.unpack_from(buf, pos)
+                    start = pos + V2_HEADER.size
+                    split = start + queue_length
+                    stop = split + message_length
+                    if stop > end:
+                        break
+
+                    frames.append((decode_queue(bytes(view[start:split])), bytes(view[split:stop]), flags))
+                    pos = stop
+                    continue
+
+                if buf[pos] != 43:  # ord('+')
+                    raise ProtocolError('Missing beginning +')
+
+                space = buf.find(b' ', pos, pos + self.MAX_HEADER)
+                if space < 0:
+                    if end - pos >= self.MAX_HEADER:
+                        raise ProtocolError('Missing space after length')
+                    break
+
+                # int() also accepts signs, whitespace and underscores, and a negative length would never advance
+                digits = buf[pos + 1:space]
+                if not digits.isdigit():
+                    raise ProtocolError('Length integer must be between + and space')
+
+                length = int(digits)
+
+                start = space + 1
+                stop = start + length
+                if stop > end:
+                    break
+
+                split = buf.find(b' ', start, stop)
+                if split < 0:
+                    frames.append((decode_queue(bytes(view[start:stop])), None, 0))
+                else:
+                    frames.append((decode_queue(bytes(view[start:split])), bytes(view[split + 1:stop]), 0))
+
+                pos = stop
+        except ProtocolError:
+            # the rest of the stream cannot be trusted, so nothing is kept for the next call, including the frames
+            # parsed from this data
+            del view
+            del buf[:]
+            raise
+
+        # the view must be gone before the bytearray can be resized
+        del view
+        if pos:
+            del buf[:pos]
+
+        return frames
+
+
+def negotiate_protocol(welcome, preferred=PROTOCOL_V2):
+    """
+    Picks the protocol version to use based on the server's welcome message
+    :param welcome: The first message received from the server
+    :param preferred: The highest version the client wants to use
+    :return: int
+    """
+    supported = [p for p in welcome.get('protocols', (PROTOCOL_V1,)) if p in PROTOCOLS and p <= preferred]
+    return max(supported) if supported else PROTOCOL_V1
 
-    try:
-        length = int(length[1:])
-    except ValueError:
-        raise ProtocolError('Length integer must be between + and space')
 
-    return length, data
+def negotiate_codec(welcome, protocol, preferred='json'):
+    """
+    Picks the codec to use based on the server's welcome message and the negotiated protocol version
+    :param welcome: The first message received from the server
+    :param protocol: The result of negotiate_protocol
+    :param preferred: The name of the codec the client wants to use
+    :return: Codec
+    """
+    if protocol == PROTOCOL_V1 or preferred not in codecs or preferred not in welcome.get('codecs', ()):
+        return JSON_CODEC
+
+    return codecs[preferred]
 
 
 def load_configuration(path=None):
@@ -169,7 +430,7 @@ def get_logger(config, section, logger_name=None):
     else:
         handler = logging.FileHandler(log_file)
 
-    log_level = config.get('CoreMQ', 'log_level', 'DEBUG')
+    log_level = config.get('CoreMQ', 'log_level', 'INFO')
     logger.setLevel(logging.getLevelName(log_level))
 
     formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
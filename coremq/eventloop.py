@@ -0,0 +1,75 @@
+"""
+CoreMQ
+------
+A pure-Python messaging queue.
+
+License
+-------
+The MIT License (MIT)
+Copyright (c) 2015 Ross Peoples <ross.peoples@gmail.com>
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import asyncio
+
+# asyncio uses the standard library loop, uvloop requires uvloop and auto uses uvloop when it is installed
+EVENT_LOOP_ASYNCIO = 'asyncio'
+EVENT_LOOP_UVLOOP = 'uvloop'
+EVENT_LOOP_AUTO = 'auto'
+EVENT_LOOPS = (EVENT_LOOP_ASYNCIO, EVENT_LOOP_UVLOOP, EVENT_LOOP_AUTO)
+
+
+def install_event_loop(name=EVENT_LOOP_ASYNCIO):
+    """
+    Selects the event loop implementation, which must happen before the first loop is created
+    :param name: One of EVENT_LOOPS
+    :return: str - the name of the implementation installed, asyncio or uvloop
+    """
+    if name not in EVENT_LOOPS:
+        raise ValueError('event_loop must be one of: %s' % ', '.join(EVENT_LOOPS))
+
+    if name == EVENT_LOOP_ASYNCIO:
+        return name
+
+    try:
+        import uvloop
+    except ImportError:
+        if name == EVENT_LOOP_UVLOOP:
+            raise ValueError('event_loop is uvloop, but uvloop is not installed')
+        return EVENT_LOOP_ASYNCIO
+
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return EVENT_LOOP_UVLOOP
+
+
+def get_event_loop():
+    """
+    Returns the running loop, or the current thread's loop, creating one if there is none. Python 3.12 and later no
+    longer create a loop in asyncio.get_event_loop, which the servers call before they start running.
+    """
+    try:
+        return asyncio.get_running_loop()
+    except (AttributeError, RuntimeError):
+        pass
+
+    policy = asyncio.get_event_loop_policy()
+    try:
+        return policy.get_event_loop()
+    except RuntimeError:
+        loop = policy.new_event_loop()
+        policy.set_event_loop(loop)
+        return loop
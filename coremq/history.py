@@ -0,0 +1,192 @@
+"""
+CoreMQ
+------
+A pure-Python messaging queue.
+
+License
+-------
+The MIT License (MIT)
+Copyright (c) 2015 Ross Peoples <ross.peoples@gmail.com>
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+from collections import deque, OrderedDict
+from topics import matches, validate_pattern
+import time
+
+
+class HistorySettings(object):
+    """
+    Limits for the history of a queue. A limit of 0 means unlimited, except for depth where 0 disables history.
+    """
+    def __init__(self, depth=10, max_bytes=0, max_age=0):
+        self.depth = int(depth)
+        self.max_bytes = int(max_bytes)
+        self.max_age = float(max_age)
+
+    def updated(self, **settings):
+        """
+        Returns a copy of these settings with some values replaced
+        """
+        values = dict(depth=self.depth, max_bytes=self.max_bytes, max_age=self.max_age)
+        for key, val in settings.items():
+            if key not in values:
+                raise ValueError('Unknown history setting: %s' % key)
+
+            if val is not None:
+                values[key] = val
+
+        return HistorySettings(**values)
+
+    @classmethod
+    def parse(cls, s, default):
+        """
+        Parses settings from a config value such as "depth=100, max_bytes=1048576, max_age=3600"
+        :param s: The config value
+        :param default: HistorySettings to take missing values from
+        :return: HistorySettings
+        """
+        settings = dict()
+        for item in s.split(','):
+            if not item.strip():
+                continue
+
+            if '=' not in item:
+                raise ValueError('History settings must be in the form name=value, not %s' % item)
+
+            key, val = item.split('=', 1)
+            settings[key.strip()] = val.strip()
+
+        return default.updated(**settings)
+
+
+class QueueHistory(object):
+    """
+    The recent messages of one queue. Entries are (timestamp, size, ref) where ref is either the encoded message or a
+    reference into storage.
+    """
+    __slots__ = ('entries', 'size', 'settings')
+
+    def __init__(self, settings):
+        self.entries = deque()
+        self.size = 0
+        self.settings = settings
+
+    def prune(self, now):
+        settings = self.settings
+        entries = self.entries
+        freed = 0
+
+        while entries and (
+                len(entries) > settings.depth or
+                (settings.max_bytes and self.size > settings.max_bytes) or
+                (settings.max_age and entries[0][0] < now - settings.max_age)):
+            size = entries.popleft()[1]
+            self.size -= size
+            freed += size
+
+        return freed
+
+
+class HistoryStore(object):
+    """
+    The history of every queue. Each queue has its own limits, taken from the first matching pattern. The total size
+    of all histories is kept under budget by dropping whole queues, least recently used first.
+    """
+    def __init__(self, default=None, budget=0):
+        self.default = default or HistorySettings()
+        self.budget = budget
+        self.patterns = []  # (pattern, HistorySettings), first match wins
+        self.queues = OrderedDict()  # least recently used first
+        self.size = 0
+
+    def __contains__(self, queue):
+        return queue in self.queues
+
+    def __len__(self):
+        return len(self.queues)
+
+    def settings_for(self, queue):
+        for pattern, settings in self.patterns:
+            if matches(pattern, queue):
+                return settings
+
+        return self.default
+
+    def set_settings(self, pattern, settings):
+        """
+        Sets the limits for queues matching a pattern and applies them to the existing histories
+        :param pattern: Queue name or pattern, matched like subscriptions
+        :param settings: HistorySettings
+        """
+        validate_pattern(pattern)
+        self.patterns = [(p, s) for p, s in self.patterns if p != pattern]
+        self.patterns.insert(0, (pattern, settings))
+
+        now = time.time()
+        for queue, history in list(self.queues.items()):
+            history.settings = self.settings_for(queue)
+            self.size -= history.prune(now)
+            if not history.entries:
+                del self.queues[queue]
+
+    def append(self, queue, ref, size, timestamp=None):
+        """
+        Adds a message to the history of a queue
+        :param queue: The queue name
+        :param ref: The encoded message, or a reference into storage
+        :param size: The size of the encoded message in bytes
+        :param timestamp: When the message was sent, defaults to now
+        """
+        history = self.queues.pop(queue, None)
+        if history is None:
+            history = QueueHistory(self.settings_for(queue))
+            if history.settings.depth <= 0:
+                return
+
+        self.queues[queue] = history
+        now = time.time()
+        history.entries.append((timestamp or now, size, ref))
+        history.size += size
+        self.size += size - history.prune(now)
+
+        while self.budget and self.size > self.budget and len(self.queues) > 1:
+            oldest, evicted = self.queues.popitem(last=False)
+            self.size -= evicted.size
+
+    def get(self, queue):
+        """
+        Returns the refs in the history of a queue, oldest first, and marks it as recently used
+        """
+        history = self.queues.pop(queue, None)
+        if history is None:
+            return []
+
+        self.size -= history.prune(time.time())
+        if not history.entries:
+            return []
+
+        self.queues[queue] = history
+        return [e[2] for e in history.entries]
+
+    def remove(self, queue):
+        history = self.queues.pop(queue, None)
+        if history is not None:
+            self.size -= history.size
+
+    def keys(self):
+        return self.queues.keys()
@@ -0,0 +1,311 @@
+"""
+CoreMQ
+------
+A pure-Python messaging queue.
+
+License
+-------
+The MIT License (MIT)
+Copyright (c) 2015 Ross Peoples <ross.peoples@gmail.com>
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import asyncio
+import bisect
+import time
+
+FANOUT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000)
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# queues beyond max_queues are counted together under this name, so clients publishing to endless unique queue names
+# cannot grow the metrics without bound
+OTHER_QUEUES = 'coremq_other'
+
+
+class Histogram(object):
+    """
+    Counts observations into fixed buckets, each bucket counting the values up to and including its upper bound
+    """
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # the last bucket is everything above the highest bound
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """
+        :return: list of (upper bound, count of values up to it) pairs, ending with ('+Inf', count)
+        """
+        result = []
+        total = 0
+        for bound, count in zip(self.bounds + ('+Inf',), self.counts):
+            total += count
+            result.append((bound, total))
+
+        return result
+
+    def snapshot(self):
+        return dict(count=self.count, sum=self.sum, buckets=[[str(b), c] for b, c in self.cumulative()])
+
+
+class QueueStats(object):
+    __slots__ = ('published', 'published_bytes', 'delivered', 'delivered_bytes', 'rates', 'last')
+
+    def __init__(self):
+        self.published = 0
+        self.published_bytes = 0
+        self.delivered = 0
+        self.delivered_bytes = 0
+        self.rates = (0.0, 0.0, 0.0, 0.0)  # per second over the last interval, in the same order as the counters
+        self.last = (0, 0, 0, 0)
+
+    def counters(self):
+        return self.published, self.published_bytes, self.delivered, self.delivered_bytes
+
+
+class Metrics(object):
+    """
+    Broker metrics. Everything updated while routing messages is a plain counter or histogram bucket, rates are
+    worked out from the counters once per interval by tick(), and values that can be read from the broker's state when
+    needed, like buffer and history sizes, are passed in as gauges when a snapshot is taken.
+    """
+    def __init__(self, max_queues=1000):
+        self.max_queues = max_queues
+        self.started = time.time()
+        self.queues = dict()  # queue name to QueueStats
+        self.fanout = Histogram(FANOUT_BUCKETS)
+        self.latency = Histogram(LATENCY_BUCKETS)  # seconds from a message being received to being written
+        self.replication_lag = Histogram(LATENCY_BUCKETS)  # seconds from the master receiving a message to this server
+        self.last_replication_lag = 0.0
+        self.dropped = 0  # messages discarded by slow consumer policies
+        self.last_tick = self.started
+
+    def stats(self, queue):
+        stats = self.queues.get(queue)
+        if stats is None:
+            if len(self.queues) >= self.max_queues:
+                queue = OTHER_QUEUES
+                stats = self.queues.get(queue)
+
+            if stats is None:
+                stats = self.queues[queue] = QueueStats()
+
+        return stats
+
+    def publish(self, queue, size):
+        stats = self.stats(queue)
+        stats.published += 1
+        stats.published_bytes += size
+
+    def deliver(self, queue, count, size, latency=None):
+        """
+        Records the routing of one message
+        :param queue: The queue name
+        :param count: The number of connections the message was sent to
+        :param size: The total number of bytes sent
+        :param latency: Seconds since the message was received, if known
+        """
+        self.fanout.observe(count)
+        if not count:
+            return
+
+        stats = self.stats(queue)
+        stats.delivered += count
+        stats.delivered_bytes += size
+        if latency is not None:
+            self.latency.observe(latency)
+
+    def replicated(self, lag):
+        self.replication_lag.observe(lag)
+        self.last_replication_lag = lag
+
+    def remove(self, queue):
+        self.queues.pop(queue, None)
+
+    def tick(self, now=None):
+        """
+        Works out the rate of every counter since the last tick
+        """
+        now = now or time.time()
+        elapsed = now - self.last_tick
+        if elapsed <= 0:
+            return
+
+        for stats in self.queues.values():
+            counters = stats.counters()
+            stats.rates = tuple((c - l) / elapsed for c, l in zip(counters, stats.last))
+            stats.last = counters
+
+        self.last_tick = now
+
+    def totals(self):
+        totals = [0, 0, 0, 0]
+        rates = [0.0, 0.0, 0.0, 0.0]
+        for stats in self.queues.values():
+            for i, c in enumerate(stats.counters()):
+                totals[i] += c
+                rates[i] += stats.rates[i]
+
+        return totals, rates
+
+    def snapshot(self, gauges=None, queues=True):
+        """
+        :param gauges: dict of other current values to include
+        :param queues: Include the counters of every queue
+        :return: dict
+        """
+        (published, published_bytes, delivered, delivered_bytes), rates = self.totals()
+        result = dict(
+            uptime=time.time() - self.started,
+            published=published,
+            published_bytes=published_bytes,
+            delivered=delivered,
+            delivered_bytes=delivered_bytes,
+            publish_rate=rates[0],
+            publish_byte_rate=rates[1],
+            deliver_rate=rates[2],
+            deliver_byte_rate=rates[3],
+            dropped=self.dropped,
+            fanout=self.fanout.snapshot(),
+            latency=self.latency.snapshot(),
+            replication_lag=self.last_replication_lag,
+        )
+
+        if queues:
+            result['queues'] = dict((q, dict(
+                published=s.published,
+                published_bytes=s.published_bytes,
+                delivered=s.delivered,
+                delivered_bytes=s.delivered_bytes,
+                publish_rate=s.rates[0],
+                publish_byte_rate=s.rates[1],
+                deliver_rate=s.rates[2],
+                deliver_byte_rate=s.rates[3],
+            )) for q, s in self.queues.items())
+
+        if gauges:
+            result.update(gauges)
+
+        return result
+
+    def prometheus(self, gauges=None, labels=None):
+        """
+        Renders the metrics in the Prometheus text exposition format
+        :param gauges: dict of other current values, each exported as a gauge named coremq_<name>
+        :param labels: dict of labels added to every sample, such as the worker ID
+        :return: str
+        """
+        base = ''.join(',%s="%s"' % (k, escape_label(v)) for k, v in sorted((labels or dict()).items()))
+        lines = []
+
+        def header(name, kind, help_text):
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s %s' % (name, kind))
+
+        def sample(name, value, extra=''):
+            label_str = (extra + base).lstrip(',')
+            lines.append('%s{%s} %s' % (name, label_str, value) if label_str else '%s %s' % (name, value))
+
+        for i, (name, help_text) in enumerate((
+                ('coremq_published_messages_total', 'Messages published to each queue'),
+                ('coremq_published_bytes_total', 'Bytes published to each queue'),
+                ('coremq_delivered_messages_total', 'Messages written to connections for each queue'),
+                ('coremq_delivered_bytes_total', 'Bytes written to connections for each queue'))):
+            header(name, 'counter', help_text)
+            for queue, stats in sorted(self.queues.items()):
+                sample(name, stats.counters()[i], ',queue="%s"' % escape_label(queue))
+
+        header('coremq_dropped_messages_total', 'counter', 'Messages discarded by slow consumer policies')
+        sample('coremq_dropped_messages_total', self.dropped)
+
+        for name, histogram, help_text in (
+                ('coremq_fanout', self.fanout, 'Number of connections each published message was sent to'),
+                ('coremq_delivery_latency_seconds', self.latency, 'Time from receiving a message to sending it'),
+                ('coremq_replication_lag_seconds', self.replication_lag,
+                 'Time from the master receiving a message to this server receiving it')):
+            header(name, 'histogram', help_text)
+            for bound, count in histogram.cumulative():
+                sample(name + '_bucket', count, ',le="%s"' % bound)
+            sample(name + '_sum', histogram.sum)
+            sample(name + '_count', histogram.count)
+
+        for key, value in sorted((gauges or dict()).items()):
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                header('coremq_' + key, 'gauge', key.replace('_', ' ').capitalize())
+                sample('coremq_' + key, value)
+
+        return '\n'.join(lines) + '\n'
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class MetricsHttpProtocol(asyncio.Protocol):
+    """
+    Minimal HTTP server for scraping metrics. GET /metrics returns the Prometheus text format and GET /status returns
+    the same information as the coremq_status command as JSON.
+    :param collect: Called with 'metrics' or 'status', returns the response body as str
+    """
+    def __init__(self, collect):
+        super(MetricsHttpProtocol, self).__init__()
+
+        self.collect = collect
+        self.transport = None
+        self.buffer = b''
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.buffer += data
+        if b'\r\n\r\n' not in self.buffer and b'\n\n' not in self.buffer:
+            if len(self.buffer) > 8192:
+                self.respond('431 Request Header Fields Too Large', 'text/plain', 'Request too large\n')
+            return
+
+        try:
+            method, path = self.buffer.split(b'\n', 1)[0].decode('latin-1').split()[:2]
+        except ValueError:
+            self.respond('400 Bad Request', 'text/plain', 'Bad request\n')
+            return
+
+        path = path.split('?', 1)[0]
+        if method != 'GET':
+            self.respond('405 Method Not Allowed', 'text/plain', 'Only GET is supported\n')
+        elif path in ('/', '/metrics'):
+            self.respond('200 OK', 'text/plain; version=0.0.4; charset=utf-8', self.collect('metrics'))
+        elif path == '/status':
+            self.respond('200 OK', 'application/json', self.collect('status'))
+        else:
+            self.respond('404 Not Found', 'text/plain', 'Not found\n')
+
+    def respond(self, status, content_type, body):
+        body = body.encode('utf-8')
+        self.transport.write((
+            'HTTP/1.0 %s\r\nContent-Type: %s\r\nContent-Length: %s\r\nConnection: close\r\n\r\n' % (
+                status, content_type, len(body))
+        ).encode('latin-1') + body)
+        self.transport.close()
+
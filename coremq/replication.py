@@ -0,0 +1,332 @@
+"""
+CoreMQ
+------
+A pure-Python messaging queue.
+
+License
+-------
+The MIT License (MIT)
+Copyright (c) 2015 Ross Peoples <ross.peoples@gmail.com>
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+from collections import deque
+from common import construct_frame, encode_message, JSON_CODEC
+from eventloop import get_event_loop
+import itertools
+import os
+import uuid
+
+# Replication frames are always json, so that entries encoded once can be joined into a batch for any replicant.
+# A batch is {"coremq_epoch": "...", "coremq_replication": [[sequence, queue, message], ...]}
+
+
+def encode_entry(seq, queue, payload):
+    """
+    :param seq: The sequence number of the entry
+    :param queue: The queue name
+    :param payload: The message encoded with the json codec
+    :return: bytes - the entry as a json array
+    """
+    return b''.join((b'[', str(seq).encode('ascii'), b',', JSON_CODEC.dumps(queue), b',', bytes(payload), b']'))
+
+
+def batch_frame(queue, epoch, entries, protocol):
+    """
+    Joins encoded entries into a replication batch frame
+    :param queue: The queue the frame is sent on, which is the replicant's connection queue
+    :param epoch: The epoch of the sequence numbers in the batch
+    :param entries: list of bytes from encode_entry
+    :param protocol: The wire protocol version of the connection
+    """
+    payload = b''.join((
+        b'{"coremq_epoch":', JSON_CODEC.dumps(epoch), b',"coremq_replication":[', b','.join(entries), b']}'
+    ))
+    return construct_frame(queue, payload, protocol, JSON_CODEC.id)
+
+
+class MessageIds(object):
+    """
+    Gives every message published on this process a short ID that is unique across the cluster: a random prefix
+    chosen when the process starts, followed by a counter in hex
+    """
+    def __init__(self):
+        self.prefix = '%s.' % ''.join('%02x' % b for b in bytearray(os.urandom(6)))
+        self.counter = itertools.count(1)
+
+    def next(self):
+        return '%s%x' % (self.prefix, next(self.counter))
+
+
+class DedupCache(object):
+    """
+    The IDs of the most recent messages seen, so that a message reaching a server more than once, such as through
+    several masters, is only routed the first time. The oldest ID is forgotten once size IDs are held.
+    """
+    def __init__(self, size=100000):
+        self.ids = set()
+        self.order = deque()
+        self.size = size
+
+    def __len__(self):
+        return len(self.ids)
+
+    def seen(self, message_id):
+        """
+        Records a message ID
+        :return: bool - True if the ID was already recorded
+        """
+        if not self.size:
+            return False
+        elif message_id in self.ids:
+            return True
+
+        if len(self.order) >= self.size:
+            self.ids.discard(self.order.popleft())
+
+        self.ids.add(message_id)
+        self.order.append(message_id)
+        return False
+
+
+class ReplicaStream(object):
+    """
+    The position of one replicant in the replication log
+    """
+    def __init__(self, conn, name, cursor):
+        self.conn = conn
+        self.name = name
+        self.cursor = cursor  # the last sequence number sent or skipped
+        self.last_sent = cursor  # the last sequence number actually sent
+        self.acked = cursor  # the last sequence number the replicant has applied
+
+
+class ReplicationLog(object):
+    """
+    Sequences every message sent to replicants and keeps the most recent ones, so that a replicant reconnecting after
+    a short outage can resume where it left off. Entries are encoded once and sent to each replicant in batches, once
+    batch_bytes have accumulated or flush_interval seconds after the first unsent entry.
+
+    Sequence numbers are only meaningful within an epoch, which changes every time the server starts.
+    """
+    def __init__(self, backlog=100000, batch_bytes=64 * 1024, flush_interval=0.005, loop=None):
+        self.epoch = str(uuid.uuid4())
+        self.seq = 0  # the last sequence number assigned
+        self.entries = deque(maxlen=backlog)  # (sequence, origin, encoded entry)
+        self.streams = dict()  # connection to ReplicaStream
+        self.batch_bytes = batch_bytes
+        self.flush_interval = flush_interval
+        self.loop = loop
+        self.unsent = 0  # bytes appended since the last flush
+        self.flush_scheduled = False
+
+    def first_seq(self):
+        return self.entries[0][0] if self.entries else self.seq + 1
+
+    def add_replicant(self, conn, name, epoch=None, seq=None):
+        """
+        Starts sending the log to a replicant
+        :param epoch: The epoch the replicant last received entries from, if any
+        :param seq: The last sequence number the replicant applied in that epoch
+        :return: bool - True if the replicant resumes from seq, False if it starts from now
+        """
+        resumed = epoch == self.epoch and seq is not None and self.first_seq() - 1 <= seq <= self.seq
+        self.streams[conn] = ReplicaStream(conn, name, seq if resumed else self.seq)
+        return resumed
+
+    def catch_up(self, conn):
+        """
+        Sends a resumed replicant the entries it missed
+        """
+        stream = self.streams.get(conn)
+        if stream is not None:
+            self.flush_stream(stream)
+
+    def remove_replicant(self, conn):
+        self.streams.pop(conn, None)
+
+    def acked(self, conn, seq):
+        stream = self.streams.get(conn)
+        if stream is None:
+            return
+
+        # entries skipped because they came from the replicant count as applied once everything sent before them is
+        if seq >= stream.last_sent:
+            stream.acked = stream.cursor
+        elif seq > stream.acked:
+            stream.acked = seq
+
+    def append(self, origin, queue, payload):
+        """
+        Adds a message to the log
+        :param origin: The name of the server the message was published on, which it is not sent back to
+        :param queue: The queue name
+        :param payload: The message encoded with the json codec
+        """
+        self.seq += 1
+        entry = encode_entry(self.seq, queue, payload)
+        self.entries.append((self.seq, origin, entry))
+        self.unsent += len(entry)
+
+        if self.unsent >= self.batch_bytes:
+            self.flush()
+        elif not self.flush_scheduled:
+            self.flush_scheduled = True
+            (self.loop or get_event_loop()).call_later(self.flush_interval, self.flush)
+
+    def flush(self):
+        self.flush_scheduled = False
+        self.unsent = 0
+        for stream in list(self.streams.values()):
+            self.flush_stream(stream)
+
+    def flush_stream(self, stream):
+        if stream.cursor >= self.seq:
+            return
+
+        first = self.first_seq()
+        start = max(stream.cursor + 1 - first, 0)
+        batch = []
+        size = 0
+        last_sent = None
+        for seq, origin, entry in itertools.islice(self.entries, start, None):
+            if origin == stream.name:
+                continue
+
+            batch.append(entry)
+            last_sent = seq
+            size += len(entry)
+            if size >= self.batch_bytes:
+                self.send(stream, batch)
+                batch = []
+                size = 0
+
+        if batch:
+            self.send(stream, batch)
+        stream.cursor = self.seq
+
+        if last_sent is not None:
+            stream.last_sent = last_sent
+        elif stream.acked >= stream.last_sent:
+            stream.acked = stream.cursor
+
+    def send(self, stream, batch):
+        conn = stream.conn
+        conn.write(batch_frame(conn.uuid, self.epoch, batch, conn.protocol_version))
+
+    def status(self):
+        return dict(
+            epoch=self.epoch,
+            sequence=self.seq,
+            replicants=dict((s.name, dict(sent=s.cursor, acked=s.acked, behind=self.seq - s.acked))
+                            for s in self.streams.values())
+        )
+
+
+class UpstreamBatcher(object):
+    """
+    Batches the messages a replicant forwards to its master. Entries are kept until the master acknowledges them, and
+    the ones still unacknowledged are sent again once the replicant is reconnected, so that messages in flight when the
+    link drops are not lost. The master drops any it already routed by their message IDs. Only the most recent
+    backlog entries are kept while there is no master to send them to.
+    """
+    def __init__(self, batch_bytes=64 * 1024, flush_interval=0.005, backlog=100000, loop=None):
+        self.batch_bytes = batch_bytes
+        self.flush_interval = flush_interval
+        self.backlog = backlog
+        self.loop = loop
+        self.conn = None  # the connection to the master, once it has accepted this server as a replicant
+        self.epoch = str(uuid.uuid4())
+        self.seq = 0
+        self.unacked = deque()  # (sequence, encoded entry)
+        self.dropped = 0  # entries discarded from a full backlog
+        self.pending = []  # entries not sent yet
+        self.size = 0
+        self.flush_scheduled = False
+
+    def __len__(self):
+        return len(self.unacked)
+
+    def attach(self, conn):
+        """
+        Starts sending to a master connection, beginning with every entry it has not acknowledged
+        :return: int - the number of entries dropped since the last connection because the backlog was full
+        """
+        self.conn = conn
+        self.pending = []
+        self.size = 0
+
+        batch = []
+        size = 0
+        for seq, entry in self.unacked:
+            batch.append(entry)
+            size += len(entry)
+            if size >= self.batch_bytes:
+                self.send(batch)
+                batch = []
+                size = 0
+
+        if batch:
+            self.send(batch)
+
+        dropped = self.dropped
+        self.dropped = 0
+        return dropped
+
+    def detach(self, conn):
+        if self.conn is conn:
+            self.conn = None
+
+    def acked(self, seq):
+        unacked = self.unacked
+        while unacked and unacked[0][0] <= seq:
+            unacked.popleft()
+
+    def append(self, queue, message, payload=None):
+        if payload is None:
+            payload = encode_message(message)
+
+        self.seq += 1
+        entry = encode_entry(self.seq, queue, payload)
+        self.unacked.append((self.seq, entry))
+        if len(self.unacked) > self.backlog:
+            self.unacked.popleft()
+            self.dropped += 1
+
+        if self.conn is None:
+            return
+
+        self.pending.append(entry)
+        self.size += len(entry)
+
+        if self.size >= self.batch_bytes:
+            self.flush()
+        elif not self.flush_scheduled:
+            self.flush_scheduled = True
+            (self.loop or get_event_loop()).call_later(self.flush_interval, self.flush)
+
+    def flush(self):
+        self.flush_scheduled = False
+        if self.pending and self.conn is not None:
+            self.send(self.pending)
+
+        self.pending = []
+        self.size = 0
+
+    def send(self, entries):
+        conn = self.conn
+        conn.write(batch_frame(conn.uuid, self.epoch, entries, conn.protocol_version))
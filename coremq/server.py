@@ -31,7 +31,7 @@ import sys
 import time
 import uuid
 from multiprocessing import Process
-from common import ConnectionClosed, get_message, send_message
+from common import ConnectionClosed, construct_message, get_message, send_message
 
 PY2 = sys.version[0] == '2'
 
@@ -77,7 +77,8 @@ class TCPRequestHandler(BaseRequestHandler):
                 elif 'coremq_gethistory' in message:
                     self.get_history(conn_id, message['coremq_gethistory'])
                 else:
-                    self.respond(conn_id, 'OK: Message sent')
+                    if TCPRequestHandler.connections[conn_id]['options'].get('ack', True):
+                        self.respond(conn_id, 'OK: Message sent')
                     self.broadcast(queue, message)
                     self.store_message(queue, message)
 
@@ -141,12 +142,15 @@ class TCPRequestHandler(BaseRequestHandler):
                 del opts[key]
 
     def broadcast(self, queue, message):
+        data = None
         for conn_id, d in TCPRequestHandler.connections.items():
             if conn_id == message['coremq_sender'] and queue != conn_id and d['options'].get('echo', False) is False:
                 continue
 
             if queue in d['subscriptions']:
-                send_message(d['handler'].request, queue, message)
+                if data is None:
+                    data = construct_message(queue, message)
+                d['handler'].request.send(data)
 
     def store_message(self, queue, message):
         if not queue in ThreadedTCPServer.HISTORY:
@@ -187,4 +191,7 @@ def start():
 
 
 if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        PORT = int(sys.argv[1])
+
     start()
\ No newline at end of file
@@ -0,0 +1,351 @@
+"""
+CoreMQ
+------
+A pure-Python messaging queue.
+
+License
+-------
+The MIT License (MIT)
+Copyright (c) 2015 Ross Peoples <ross.peoples@gmail.com>
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import bisect
+import mmap
+import os
+import struct
+import time
+import zlib
+
+# Every record is: crc32, header, queue name, message. The crc covers everything after itself, so a record that was
+# only partially written before a crash is detected and cut off when the log is opened again.
+RECORD_CRC = struct.Struct('!I')
+RECORD_HEADER = struct.Struct('!IQdH')  # message length, sequence, timestamp, queue name length
+RECORD_OVERHEAD = RECORD_CRC.size + RECORD_HEADER.size
+INDEX_ENTRY = struct.Struct('!QQ')  # sequence, position in the segment
+
+FSYNC_ALWAYS = 'always'  # fsync once per event loop iteration, after every batch of appends
+FSYNC_INTERVAL = 'interval'  # fsync every fsync_interval seconds
+FSYNC_NEVER = 'never'  # leave it to the operating system
+FSYNC_POLICIES = (FSYNC_ALWAYS, FSYNC_INTERVAL, FSYNC_NEVER)
+
+
+class Segment(object):
+    """
+    One file of the log. Segments are named after the sequence number of their first record and only the newest one
+    is ever appended to. Each has a sparse index file mapping some sequence numbers to file positions.
+    """
+    def __init__(self, directory, base):
+        self.base = base
+        self.path = os.path.join(directory, '%020d.log' % base)
+        self.index_path = os.path.join(directory, '%020d.idx' % base)
+        self.size = 0
+        self.last_seq = base - 1
+        self.last_time = 0
+        self.index = []  # sorted (sequence, position) pairs
+        self.last_indexed = -1
+        self.file = None
+        self.index_file = None
+        self.flushed = 0
+        self._map = None
+
+    def open_for_append(self):
+        self.file = open(self.path, 'ab')
+        self.index_file = open(self.index_path, 'ab')
+        self.flushed = self.size
+
+    def flush(self):
+        if self.file and self.flushed < self.size:
+            self.file.flush()
+            self.index_file.flush()
+            self.flushed = self.size
+
+    def sync(self):
+        if self.file:
+            self.flush()
+            os.fsync(self.file.fileno())
+            os.fsync(self.index_file.fileno())
+
+    def seal(self):
+        if self.file:
+            self.sync()
+            self.file.close()
+            self.index_file.close()
+            self.file = None
+            self.index_file = None
+
+    def view(self, end):
+        """
+        Returns a read-only memory map that covers at least the first end bytes of the segment. The map of the segment
+        being appended to is replaced when it has to grow.
+        """
+        if self._map is None or len(self._map) < end:
+            self.flush()
+            if self._map is not None:
+                self._map.close()
+
+            with open(self.path, 'rb') as f:
+                self._map = mmap.mmap(f.fileno(), self.size, access=mmap.ACCESS_READ)
+
+        return self._map
+
+    def close(self):
+        self.seal()
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+    def delete(self):
+        self.close()
+        for path in (self.path, self.index_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class SegmentLog(object):
+    """
+    Append-only log of published messages, split into segment files. Records are addressed by a (segment, position)
+    reference returned from append, and read back through memory maps. Segments roll over at segment_size and are
+    deleted oldest first once the log is larger than retention_bytes, or older than retention_age seconds.
+    """
+    def __init__(self, path, segment_size=64 * 1024 * 1024, fsync=FSYNC_INTERVAL, retention_bytes=0,
+                 retention_age=0, index_interval=4096):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError('fsync must be one of: %s' % ', '.join(FSYNC_POLICIES))
+
+        self.path = path
+        self.segment_size = segment_size
+        self.fsync = fsync
+        self.retention_bytes = retention_bytes
+        self.retention_age = retention_age
+        self.index_interval = index_interval
+        self.segments = dict()  # base sequence to Segment
+        self.bases = []  # sorted base sequences
+        self.active = None
+        self.next_seq = 0
+        self.dirty = False
+
+    def open(self):
+        """
+        Loads the existing segments, discarding any partially written records at the end of the newest one
+        """
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+        for name in sorted(os.listdir(self.path)):
+            if name.endswith('.log'):
+                base = int(name[:-4])
+                self.segments[base] = Segment(self.path, base)
+                self.bases.append(base)
+
+        for i, base in enumerate(self.bases):
+            self._load(self.segments[base], verify=(i == len(self.bases) - 1))
+
+        if self.bases:
+            self.active = self.segments[self.bases[-1]]
+            self.next_seq = self.active.last_seq + 1
+            self.active.open_for_append()
+        else:
+            self._roll()
+
+        self.enforce_retention()
+
+    def _load(self, segment, verify):
+        segment.size = os.path.getsize(segment.path)
+        segment.index = self._read_index(segment)
+        if segment.index:
+            segment.last_indexed = segment.index[-1][1]
+
+        # only the newest segment can have been torn by a crash, older ones were synced when they were sealed
+        start = segment.index[-1][1] if segment.index and not verify else 0
+        valid_end = start
+        for seq, timestamp, queue, position, end, length in self._scan(segment, start, verify):
+            segment.last_seq = seq
+            segment.last_time = timestamp
+            valid_end = end
+
+        if valid_end < segment.size:
+            # the map must not outlive the bytes it covers
+            if segment._map is not None:
+                segment._map.close()
+                segment._map = None
+
+            with open(segment.path, 'r+b') as f:
+                f.truncate(valid_end)
+            segment.size = valid_end
+            segment.index = [e for e in segment.index if e[1] < valid_end]
+            segment.last_indexed = segment.index[-1][1] if segment.index else -1
+            self._write_index(segment)
+
+    @staticmethod
+    def _read_index(segment):
+        if not os.path.exists(segment.index_path):
+            return []
+
+        with open(segment.index_path, 'rb') as f:
+            data = f.read()
+
+        count = len(data) // INDEX_ENTRY.size
+        return [INDEX_ENTRY.unpack_from(data, i * INDEX_ENTRY.size) for i in range(count)]
+
+    @staticmethod
+    def _write_index(segment):
+        with open(segment.index_path, 'wb') as f:
+            for entry in segment.index:
+                f.write(INDEX_ENTRY.pack(*entry))
+
+    def _scan(self, segment, start=0, verify=False):
+        """
+        Walks the records of a segment from a position without decoding any messages
+        :return: generator of (sequence, timestamp, queue, position, end, message length) tuples
+        """
+        if segment.size <= start:
+            return
+
+        view = segment.view(segment.size)
+        position = start
+        while position + RECORD_OVERHEAD <= segment.size:
+            length, seq, timestamp, queue_length = RECORD_HEADER.unpack_from(view, position + RECORD_CRC.size)
+            end = position + RECORD_OVERHEAD + queue_length + length
+            if end > segment.size:
+                break
+
+            if verify:
+                crc = RECORD_CRC.unpack_from(view, position)[0]
+                if zlib.crc32(view[position + RECORD_CRC.size:end]) & 0xffffffff != crc:
+                    break
+
+            queue = view[position + RECORD_OVERHEAD:position + RECORD_OVERHEAD + queue_length].decode('utf-8')
+            yield seq, timestamp, queue, position, end, length
+            position = end
+
+    def _roll(self):
+        if self.active:
+            self.active.seal()
+
+        segment = Segment(self.path, self.next_seq)
+        segment.open_for_append()
+        self.segments[segment.base] = segment
+        self.bases.append(segment.base)
+        self.active = segment
+
+    def append(self, queue, message, timestamp=None):
+        """
+        Appends a record to the log
+        :param queue: The queue name
+        :param message: The encoded message bytes
+        :param timestamp: The time the message was sent, defaults to now
+        :return: (int, tuple) - the sequence number and a reference that can be passed to read
+        """
+        if self.active.size >= self.segment_size:
+            self._roll()
+            self.enforce_retention()
+
+        segment = self.active
+        seq = self.next_seq
+        timestamp = timestamp or time.time()
+        queue = queue.encode('utf-8')
+        body = RECORD_HEADER.pack(len(message), seq, timestamp, len(queue)) + queue + message
+        crc = zlib.crc32(body) & 0xffffffff
+
+        position = segment.size
+        segment.file.write(RECORD_CRC.pack(crc))
+        segment.file.write(body)
+        segment.size += RECORD_CRC.size + len(body)
+        segment.last_seq = seq
+        segment.last_time = timestamp
+
+        if segment.last_indexed < 0 or position - segment.last_indexed >= self.index_interval:
+            segment.index.append((seq, position))
+            segment.index_file.write(INDEX_ENTRY.pack(seq, position))
+            segment.last_indexed = position
+
+        self.next_seq += 1
+        self.dirty = True
+        return seq, (segment.base, position)
+
+    def read(self, ref):
+        """
+        Reads a record back from the log
+        :param ref: The reference returned by append or scan
+        :return: (str, bytes, float) - queue name, message and timestamp, or None if the record has been deleted
+        """
+        base, position = ref
+        segment = self.segments.get(base)
+        if segment is None or position + RECORD_OVERHEAD > segment.size:
+            return None
+
+        view = segment.view(position + RECORD_OVERHEAD)
+        length, seq, timestamp, queue_length = RECORD_HEADER.unpack_from(view, position + RECORD_CRC.size)
+        start = position + RECORD_OVERHEAD
+        end = start + queue_length + length
+        view = segment.view(end)
+        return view[start:start + queue_length].decode('utf-8'), view[start + queue_length:end], timestamp
+
+    def scan(self, start_seq=0):
+        """
+        Iterates over the records in the log without reading the messages, using the sparse index to skip ahead
+        :param start_seq: The first sequence number of interest
+        :return: generator of (sequence, timestamp, queue, reference, message length) tuples
+        """
+        first = max(bisect.bisect_right(self.bases, start_seq) - 1, 0)
+        for base in self.bases[first:]:
+            segment = self.segments[base]
+            position = 0
+            i = bisect.bisect_right(segment.index, (start_seq, float('inf'))) - 1
+            if i >= 0:
+                position = segment.index[i][1]
+
+            for seq, timestamp, queue, pos, end, length in self._scan(segment, position):
+                if seq >= start_seq:
+                    yield seq, timestamp, queue, (base, pos), length
+
+    def sync(self):
+        """
+        Writes any buffered records to disk. Appends between calls are committed together.
+        """
+        if self.dirty and self.active:
+            if self.fsync == FSYNC_NEVER:
+                self.active.flush()
+            else:
+                self.active.sync()
+            self.dirty = False
+
+    def enforce_retention(self):
+        """
+        Deletes the oldest segments that are beyond the retention limits. The segment being appended to is always kept.
+        """
+        total = sum(self.segments[b].size for b in self.bases)
+        cutoff = time.time() - self.retention_age if self.retention_age else 0
+
+        while len(self.bases) > 1:
+            oldest = self.segments[self.bases[0]]
+            too_big = self.retention_bytes and total > self.retention_bytes
+            too_old = cutoff and oldest.last_time < cutoff
+            if not (too_big or too_old):
+                break
+
+            total -= oldest.size
+            oldest.delete()
+            del self.segments[oldest.base]
+            self.bases.pop(0)
+
+    def close(self):
+        for base in self.bases:
+            self.segments[base].close()
+
+        self.active = None
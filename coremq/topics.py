@@ -0,0 +1,206 @@
+"""
+CoreMQ
+------
+A pure-Python messaging queue.
+
+License
+-------
+The MIT License (MIT)
+Copyright (c) 2015 Ross Peoples <ross.peoples@gmail.com>
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+from collections import OrderedDict
+
+# Queue names are split into levels on dots. In a subscription pattern, * matches exactly one level and # matches any
+# number of levels, including none, so orders.* matches orders.eu and orders.# matches orders, orders.eu and
+# orders.eu.42. # may only be used as the last level.
+SEPARATOR = '.'
+ONE_LEVEL = '*'
+ANY_LEVELS = '#'
+
+
+def is_pattern(name):
+    if ONE_LEVEL not in name and ANY_LEVELS not in name:
+        return False
+
+    return any(level in (ONE_LEVEL, ANY_LEVELS) for level in name.split(SEPARATOR))
+
+
+def validate_pattern(pattern):
+    """
+    Raises ValueError if a subscription pattern is not valid
+    """
+    levels = pattern.split(SEPARATOR)
+    if ANY_LEVELS in levels[:-1]:
+        raise ValueError('%s may only be used as the last level of a pattern: %s' % (ANY_LEVELS, pattern))
+
+
+def validate_topic(name):
+    """
+    Raises ValueError if a queue name is a pattern, which can be subscribed to but not published to
+    """
+    if is_pattern(name):
+        raise ValueError('Cannot publish to a pattern: %s' % name)
+
+
+def matches(pattern, topic):
+    """
+    Checks a single queue name against a single pattern
+    """
+    levels = topic.split(SEPARATOR)
+    for i, p in enumerate(pattern.split(SEPARATOR)):
+        if p == ANY_LEVELS:
+            return True
+        elif i >= len(levels) or (p != ONE_LEVEL and p != levels[i]):
+            return False
+
+    return len(levels) == i + 1
+
+
+class TopicNode(object):
+    __slots__ = ('children', 'values', 'rest')
+
+    def __init__(self):
+        self.children = dict()  # level to TopicNode, including * for one level wildcards
+        self.values = set()  # values subscribed to patterns ending at this node
+        self.rest = set()  # values subscribed to patterns ending at this node followed by #
+
+
+class TopicTrie(object):
+    """
+    Subscription patterns stored by level, so that finding the patterns matching a queue name takes time in
+    proportion to the number of levels in the name rather than the number of patterns. Results are cached per queue
+    name, and a change to a pattern only drops the cached names that pattern matches.
+    """
+    def __init__(self, cache_size=10000):
+        self.root = TopicNode()
+        self.patterns = dict()  # pattern to the number of values subscribed to it
+        self.cache = OrderedDict()  # queue name to frozenset of values, least recently used first
+        self.cache_size = cache_size
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def __contains__(self, pattern):
+        return pattern in self.patterns
+
+    def add(self, pattern, value):
+        """
+        :return: bool - True if nothing was subscribed to the pattern before
+        """
+        node = self.root
+        levels = pattern.split(SEPARATOR)
+        for level in levels[:-1]:
+            node = node.children.setdefault(level, TopicNode())
+
+        if levels[-1] == ANY_LEVELS:
+            target = node.rest
+        else:
+            target = node.children.setdefault(levels[-1], TopicNode()).values
+
+        if value in target:
+            return False
+
+        target.add(value)
+        self.invalidate(pattern)
+        count = self.patterns.get(pattern, 0)
+        self.patterns[pattern] = count + 1
+        return count == 0
+
+    def discard(self, pattern, value):
+        """
+        :return: bool - True if nothing is subscribed to the pattern any more
+        """
+        path = [self.root]
+        levels = pattern.split(SEPARATOR)
+        for level in levels[:-1]:
+            node = path[-1].children.get(level)
+            if node is None:
+                return False
+            path.append(node)
+
+        if levels[-1] == ANY_LEVELS:
+            target = path[-1].rest
+        else:
+            node = path[-1].children.get(levels[-1])
+            if node is None:
+                return False
+            path.append(node)
+            target = node.values
+
+        if value not in target:
+            return False
+
+        target.discard(value)
+        self.invalidate(pattern)
+
+        # remove the nodes left empty, deepest first
+        for i in range(len(path) - 1, 0, -1):
+            node = path[i]
+            if node.children or node.values or node.rest:
+                break
+            del path[i - 1].children[levels[i - 1]]
+
+        count = self.patterns[pattern] - 1
+        if count:
+            self.patterns[pattern] = count
+            return False
+
+        del self.patterns[pattern]
+        return True
+
+    def match(self, topic):
+        """
+        :return: frozenset - the values subscribed to any pattern matching the queue name
+        """
+        result = self.cache.pop(topic, None)
+        if result is None:
+            result = self._match(topic)
+            if len(self.cache) >= self.cache_size:
+                self.cache.popitem(last=False)
+
+        self.cache[topic] = result
+        return result
+
+    def _match(self, topic):
+        result = set()
+        nodes = [self.root]
+        for level in topic.split(SEPARATOR):
+            following = []
+            for node in nodes:
+                result.update(node.rest)
+                child = node.children.get(level)
+                if child is not None:
+                    following.append(child)
+                child = node.children.get(ONE_LEVEL)
+                if child is not None:
+                    following.append(child)
+
+            nodes = following
+            if not nodes:
+                return frozenset(result)
+
+        for node in nodes:
+            result.update(node.values)
+            result.update(node.rest)
+
+        return frozenset(result)
+
+    def invalidate(self, pattern):
+        for topic in [t for t in self.cache if matches(pattern, t)]:
+            del self.cache[topic]
@@ -0,0 +1,187 @@
+"""
+CoreMQ
+------
+A pure-Python messaging queue.
+
+License
+-------
+The MIT License (MIT)
+Copyright (c) 2015 Ross Peoples <ross.peoples@gmail.com>
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+from collections import deque
+import cProfile
+import time
+
+clock = getattr(time, 'perf_counter', time.time)
+
+STAGE_PARSE = 'parse'  # splitting received bytes into frames
+STAGE_DECODE = 'decode'  # decoding a frame into a message
+STAGE_ROUTE = 'route'  # finding the connections a message goes to
+STAGE_STORE = 'store'  # adding a message to history and storage
+STAGE_FANOUT = 'fanout'  # encoding a message and handing it to every recipient
+STAGE_WRITE = 'write'  # writing to one connection
+STAGES = (STAGE_PARSE, STAGE_DECODE, STAGE_ROUTE, STAGE_STORE, STAGE_FANOUT, STAGE_WRITE)
+
+
+class Tracer(object):
+    """
+    Times the stages of the message pipeline and passes the timings to sinks. Call sites check enabled before doing
+    anything, so a tracer without sinks costs one attribute lookup per stage:
+
+        t = tracer.start() if tracer.enabled else 0
+        ...
+        if t:
+            tracer.record(STAGE_ROUTE, t, queue)
+
+    :param sample_every: Time only one in this many calls to start
+    """
+    def __init__(self, sample_every=1):
+        self.sinks = []
+        self.enabled = False
+        self.sample_every = max(int(sample_every), 1)
+        self.calls = 0
+
+    def add_sink(self, sink):
+        """
+        :param sink: Called with (stage, seconds, queue) for every sampled stage
+        """
+        self.sinks.append(sink)
+        self.enabled = True
+
+    def remove_sink(self, sink):
+        self.sinks.remove(sink)
+        self.enabled = bool(self.sinks)
+        close = getattr(sink, 'close', None)
+        if close is not None:
+            close()
+
+    def start(self):
+        """
+        :return: float - the start time, or 0 if this call is not sampled
+        """
+        self.calls += 1
+        if self.calls % self.sample_every:
+            return 0
+
+        return clock()
+
+    def record(self, stage, started, queue=None):
+        duration = clock() - started
+        for sink in self.sinks:
+            sink(stage, duration, queue)
+
+    def close(self):
+        for sink in list(self.sinks):
+            self.remove_sink(sink)
+
+
+class RingSink(object):
+    """
+    Keeps the most recent timings in memory
+    """
+    def __init__(self, size=10000):
+        self.entries = deque(maxlen=size)
+
+    def __call__(self, stage, duration, queue):
+        self.entries.append((time.time(), stage, duration, queue))
+
+    def summary(self):
+        """
+        :return: dict of stage to dict of count, mean and max seconds over the timings in the ring
+        """
+        result = dict()
+        for timestamp, stage, duration, queue in self.entries:
+            s = result.get(stage)
+            if s is None:
+                s = result[stage] = dict(count=0, total=0.0, max=0.0)
+
+            s['count'] += 1
+            s['total'] += duration
+            s['max'] = max(s['max'], duration)
+
+        for s in result.values():
+            s['mean'] = s.pop('total') / s['count']
+
+        return result
+
+
+class FileSink(object):
+    """
+    Appends timings to a file, one tab-separated line of time, stage, seconds and queue each
+    """
+    def __init__(self, path):
+        self.file = open(path, 'a')
+
+    def __call__(self, stage, duration, queue):
+        self.file.write('%.6f\t%s\t%.9f\t%s\n' % (time.time(), stage, duration, queue or ''))
+
+    def close(self):
+        self.file.close()
+
+
+class ProfileSink(object):
+    """
+    Runs cProfile while tracing is enabled and writes its stats to a new file every window seconds, named after the
+    time the window started. The timings themselves are ignored, stages only mark when a window has ended.
+    """
+    def __init__(self, path_prefix, window=60):
+        self.path_prefix = path_prefix
+        self.window = window
+        self.profile = None
+        self.started = 0
+
+    def __call__(self, stage, duration, queue):
+        now = time.time()
+        if self.profile is None:
+            self.begin(now)
+        elif now - self.started >= self.window:
+            self.dump()
+            self.begin(now)
+
+    def begin(self, now):
+        self.profile = cProfile.Profile()
+        self.started = now
+        self.profile.enable()
+
+    def dump(self):
+        self.profile.disable()
+        self.profile.dump_stats('%s-%d.prof' % (self.path_prefix, self.started))
+        self.profile = None
+
+    def close(self):
+        if self.profile is not None:
+            self.dump()
+
+
+def create_sink(kind, path=None, ring_size=10000, window=60):
+    """
+    Creates a sink from configuration values
+    :param kind: ring, file or profile
+    :param path: The file for file sinks, or the file name prefix for profile sinks
+    """
+    if kind == 'ring':
+        return RingSink(ring_size)
+    elif kind in ('file', 'profile') and not path:
+        raise ValueError('The %s trace sink requires trace_path' % kind)
+    elif kind == 'file':
+        return FileSink(path)
+    elif kind == 'profile':
+        return ProfileSink(path, window)
+
+    raise ValueError('Unknown trace sink: %s' % kind)
@@ -0,0 +1,368 @@
+"""
+CoreMQ
+------
+A pure-Python messaging queue.
+
+License
+-------
+The MIT License (MIT)
+Copyright (c) 2015 Ross Peoples <ross.peoples@gmail.com>
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+from common import construct_frame, decode_message, encode_message, FrameParser, JSON_CODEC, PROTOCOL_V2
+from eventloop import get_event_loop
+from topics import is_pattern, TopicTrie
+import asyncio
+import itertools
+import os
+import socket
+import zlib
+
+# Bus control messages are sent on a queue name containing a space, which no client can ever publish to
+CONTROL_QUEUE = ' coremq_bus'
+
+
+def create_listen_socket(address, backlog=100, reuse_port=False):
+    """
+    Creates the client listening socket. With reuse_port, every worker process binds its own socket to the same
+    address and the kernel spreads new connections between them.
+    """
+    # accepted sockets inherit the protocol, and asyncio only disables Nagle's algorithm for explicit IPPROTO_TCP
+    # sockets, without which a small write that follows another waits for the peer's delayed ACK
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+    if reuse_port:
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            raise RuntimeError('Multiple workers require SO_REUSEPORT, which this platform does not support')
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+    sock.bind(address)
+    sock.listen(backlog)
+    sock.setblocking(False)
+    return sock
+
+
+class WorkerPeer(asyncio.Protocol):
+    """
+    Outgoing bus connection to another worker. Published messages the other worker is interested in are written here,
+    framed like they would be for any other recipient.
+    """
+    protocol_version = PROTOCOL_V2
+    codec = JSON_CODEC
+
+    def __init__(self, bus, worker_id):
+        super(WorkerPeer, self).__init__()
+
+        self.bus = bus
+        self.worker_id = worker_id
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.bus.peer_connected(self)
+
+    def connection_lost(self, exc):
+        self.bus.peer_lost(self)
+
+    def write(self, data):
+        try:
+            self.transport.write(data)
+        except Exception:
+            self.transport.close()
+
+    def send_control(self, message):
+        self.write(construct_frame(CONTROL_QUEUE, encode_message(message), PROTOCOL_V2, JSON_CODEC.id))
+
+
+class WorkerBusProtocol(asyncio.Protocol):
+    """
+    Incoming bus connection from another worker
+    """
+    def __init__(self, bus):
+        super(WorkerBusProtocol, self).__init__()
+
+        self.bus = bus
+        self.parser = FrameParser()
+        self.worker_id = None
+
+    def data_received(self, data):
+        for queue, message, flags in self.parser.feed(data):
+            message = decode_message(message, flags)
+            if queue == CONTROL_QUEUE:
+                self.bus.control_received(self, message)
+            else:
+                self.bus.message_received(queue, message)
+
+    def connection_lost(self, exc):
+        if self.worker_id is not None:
+            self.bus.forget(self.worker_id)
+
+
+class WorkerBus(object):
+    """
+    Connects the worker processes of one broker over Unix sockets. Each worker tells the others which queues its
+    connections are subscribed to and only receives messages for those. The history of each queue is kept by a single
+    owner worker, chosen by hashing the queue name, which receives every message for the queue.
+    """
+    def __init__(self, worker_id, count, socket_dir, port, loop=None, logger=None):
+        self.worker_id = worker_id
+        self.count = count
+        self.socket_dir = socket_dir
+        self.port = port
+        self.loop = loop or get_event_loop()
+        self.logger = logger
+        self.peers = dict()  # worker ID to connected WorkerPeer
+        self.interest = dict()  # queue name or pattern to IDs of the workers subscribed to it
+        self.patterns = TopicTrie()  # the patterns in interest, for matching queue names
+        self.wants_all = set()  # IDs of the workers with replicants, which receive every message
+        self.local_interest = set()  # queue names subscribed to in this worker, None meaning every queue
+        self.responders = dict()  # queue name to IDs of the workers with responders for it
+        self.local_responders = set()  # queue names with responders in this worker
+        self.responder_turn = itertools.count()  # spreads requests between the workers with responders
+        self.requests = dict()  # history request ID to callback
+        self.request_ids = itertools.count(1)
+        self.server = None
+        self.shutting_down = False
+
+        # set by the broker
+        self.message_handler = None  # called with (queue, message) for messages published in other workers
+        self.history_handler = None  # called with a list of queue names, returns dict of queue name to history
+        self.settings_handler = None  # called with coremq_history_settings changes made in other workers
+        self.request_handler = None  # called with (queue, message) for requests sent to a responder in this worker
+
+    def socket_path(self, worker_id):
+        return os.path.join(self.socket_dir, 'coremq-%s-%s.sock' % (self.port, worker_id))
+
+    def owner(self, queue):
+        return (zlib.crc32(queue.encode('utf-8')) & 0xffffffff) % self.count
+
+    def owns(self, queue):
+        return self.owner(queue) == self.worker_id
+
+    async def start(self):
+        path = self.socket_path(self.worker_id)
+        if os.path.exists(path):
+            os.remove(path)
+
+        self.server = await self.loop.create_unix_server(lambda: WorkerBusProtocol(self), path)
+        for i in range(self.count):
+            if i != self.worker_id:
+                self.loop.create_task(self.connect(i))
+
+    async def connect(self, worker_id):
+        while not self.shutting_down and worker_id not in self.peers:
+            try:
+                await self.loop.create_unix_connection(
+                    lambda: WorkerPeer(self, worker_id), self.socket_path(worker_id)
+                )
+            except (OSError, socket.error):
+                # the other worker has not started listening yet
+                await asyncio.sleep(0.1)
+
+    def close(self):
+        self.shutting_down = True
+        for peer in list(self.peers.values()):
+            peer.transport.close()
+
+        if self.server:
+            self.server.close()
+
+    def peer_connected(self, peer):
+        self.peers[peer.worker_id] = peer
+        peer.send_control(dict(
+            hello=self.worker_id, interest=list(self.local_interest), responders=list(self.local_responders)
+        ))
+        if self.logger:
+            self.logger.debug('Worker %s connected to worker %s', self.worker_id, peer.worker_id)
+
+    def peer_lost(self, peer):
+        if self.peers.get(peer.worker_id) is peer:
+            del self.peers[peer.worker_id]
+
+        if not self.shutting_down:
+            if self.logger:
+                self.logger.warning('Lost bus connection to worker %s, reconnecting...', peer.worker_id)
+            self.loop.create_task(self.connect(peer.worker_id))
+
+    def forget(self, worker_id):
+        self.wants_all.discard(worker_id)
+        for queue in list(self.interest):
+            self.interest_removed(worker_id, queue)
+
+        for queue in list(self.responders):
+            self.responder_removed_in(worker_id, queue)
+
+    def broadcast_control(self, message):
+        for peer in self.peers.values():
+            peer.send_control(message)
+
+    # local subscription changes, called by SubscriptionIndex
+
+    def queue_added(self, queue):
+        self.local_interest.add(queue)
+        self.broadcast_control(dict(add=queue))
+
+    def queue_removed(self, queue):
+        self.local_interest.discard(queue)
+        self.broadcast_control(dict(remove=queue))
+
+    def responder_added(self, queue):
+        self.local_responders.add(queue)
+        self.broadcast_control(dict(add_responder=queue))
+
+    def responder_removed(self, queue):
+        self.local_responders.discard(queue)
+        self.broadcast_control(dict(remove_responder=queue))
+
+    # remote subscription changes
+
+    def interest_added(self, worker_id, queue):
+        if queue is None:
+            self.wants_all.add(worker_id)
+            return
+
+        self.interest.setdefault(queue, set()).add(worker_id)
+        if is_pattern(queue):
+            self.patterns.add(queue, worker_id)
+
+    def interest_removed(self, worker_id, queue):
+        if queue is None:
+            self.wants_all.discard(worker_id)
+            return
+
+        workers = self.interest.get(queue)
+        if workers is not None:
+            workers.discard(worker_id)
+            if not workers:
+                del self.interest[queue]
+
+            if is_pattern(queue):
+                self.patterns.discard(queue, worker_id)
+
+    def responder_added_in(self, worker_id, queue):
+        self.responders.setdefault(queue, set()).add(worker_id)
+
+    def responder_removed_in(self, worker_id, queue):
+        workers = self.responders.get(queue)
+        if workers is not None:
+            workers.discard(worker_id)
+            if not workers:
+                del self.responders[queue]
+
+    def send_request(self, queue, message):
+        """
+        Passes a request to one of the other workers with responders for its queue, taking turns between them
+        :return: bool - False if no other worker has a responder for the queue
+        """
+        workers = sorted(i for i in self.responders.get(queue, ()) if i in self.peers)
+        if not workers:
+            return False
+
+        self.peers[workers[next(self.responder_turn) % len(workers)]].send_control(dict(request=[queue, message]))
+        return True
+
+    def recipients(self, queue):
+        """
+        Returns the peers that must receive a message published to a queue in this worker
+        """
+        ids = set(self.wants_all)
+        ids.update(self.interest.get(queue, ()))
+        if self.patterns:
+            ids.update(self.patterns.match(queue))
+        ids.add(self.owner(queue))
+        ids.discard(self.worker_id)
+        return [self.peers[i] for i in ids if i in self.peers]
+
+    def message_received(self, queue, message):
+        self.message_handler(queue, message)
+
+    def control_received(self, conn, message):
+        if 'hello' in message:
+            conn.worker_id = message['hello']
+            self.forget(conn.worker_id)
+            for queue in message.get('interest', ()):
+                self.interest_added(conn.worker_id, queue)
+            for queue in message.get('responders', ()):
+                self.responder_added_in(conn.worker_id, queue)
+        elif 'add' in message:
+            self.interest_added(conn.worker_id, message['add'])
+        elif 'remove' in message:
+            self.interest_removed(conn.worker_id, message['remove'])
+        elif 'add_responder' in message:
+            self.responder_added_in(conn.worker_id, message['add_responder'])
+        elif 'remove_responder' in message:
+            self.responder_removed_in(conn.worker_id, message['remove_responder'])
+        elif 'request' in message:
+            self.request_handler(*message['request'])
+        elif 'history_request' in message:
+            peer = self.peers.get(conn.worker_id)
+            if peer is not None:
+                peer.send_control(dict(
+                    history_reply=message['request_id'],
+                    history=self.history_handler(message['history_request'])
+                ))
+        elif 'history_settings' in message:
+            self.settings_handler(message['history_settings'])
+        elif 'history_reply' in message:
+            callback = self.requests.pop(message['history_reply'], None)
+            if callback is not None:
+                callback(message['history'])
+
+    def request_history(self, queues, callback, timeout=1.0):
+        """
+        Asks the owners of queues for their history
+        :param queues: The queue names, none of which are owned by this worker, and patterns, which are sent to every
+                       other worker
+        :param callback: Called once with a dict of queue name to history, which is empty for any worker that did not
+                         answer within the timeout
+        :param timeout: Seconds to wait for the other workers
+        """
+        by_owner = dict()
+        for q in queues:
+            if is_pattern(q):
+                for i in range(self.count):
+                    if i != self.worker_id:
+                        by_owner.setdefault(i, []).append(q)
+            else:
+                by_owner.setdefault(self.owner(q), []).append(q)
+
+        result = dict()
+        remaining = [len(by_owner)]
+
+        def reply(history):
+            result.update(history)
+            remaining[0] -= 1
+            if remaining[0] == 0:
+                callback(result)
+
+        for owner, owned in by_owner.items():
+            peer = self.peers.get(owner)
+            if peer is None:
+                reply(dict())
+                continue
+
+            request_id = next(self.request_ids)
+            self.requests[request_id] = reply
+            peer.send_control(dict(history_request=owned, request_id=request_id))
+            self.loop.call_later(timeout, self.expire_request, request_id)
+
+    def expire_request(self, request_id):
+        callback = self.requests.pop(request_id, None)
+        if callback is not None:
+            callback(dict())
@@ -24,19 +24,182 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
-import json
-import socket
 from aio_client import CoreMqClientFactory, CoreMqClientProtocol
-from common import comma_string_to_list, get_logger, load_configuration
+from common import comma_string_to_list, construct_frame, construct_message, decode_message, get_codec, get_logger, \
+    load_configuration, validate_queue, FrameParser, ProtocolError, JSON_CODEC, PROTOCOL_V2
+from eventloop import get_event_loop, install_event_loop
+from topics import is_pattern, validate_pattern, TopicTrie
 from autobahn.asyncio.websocket import WebSocketServerProtocol, WebSocketServerFactory
-import trollius as asyncio
+from autobahn.websocket.compress import PERMESSAGE_COMPRESSION_EXTENSION, PerMessageDeflate, PerMessageDeflateOffer, \
+    PerMessageDeflateOfferAccept
+import asyncio
 import uuid
+import zlib
+
+COMPRESSION_NONE = 'none'
+COMPRESSION_DEFLATE = 'deflate'  # permessage-deflate, when the browser offers it
+
+# Browsers that ask for this WebSocket subprotocol are sent binary frames in CoreMQ's version 2 wire format instead of
+# JSON text, see WsProtocol.binary
+BINARY_SUBPROTOCOL = 'coremq.v2'
+
+
+class SubscriptionIndex(object):
+    """
+    Inverted index from queue name to the set of WebSockets subscribed to it, so that a message from CoreMQ only
+    touches the browsers that actually want it. Pattern subscriptions are kept in a TopicTrie.
+    """
+    def __init__(self):
+        self.queues = dict()
+        self.patterns = TopicTrie()
+        self.listener = None  # told when a queue gains its first or loses its last subscriber, see Upstream
+
+    def add(self, queue, ws):
+        if is_pattern(queue):
+            if self.patterns.add(queue, ws) and self.listener:
+                self.listener.queue_added(queue)
+            return
+
+        subs = self.queues.get(queue)
+        if subs is None:
+            subs = self.queues[queue] = set()
+            if self.listener:
+                self.listener.queue_added(queue)
+
+        subs.add(ws)
+
+    def discard(self, queue, ws):
+        if is_pattern(queue):
+            if self.patterns.discard(queue, ws) and self.listener:
+                self.listener.queue_removed(queue)
+            return
+
+        subs = self.queues.get(queue)
+        if subs is None:
+            return
+
+        subs.discard(ws)
+        if not subs:
+            del self.queues[queue]
+            if self.listener:
+                self.listener.queue_removed(queue)
+
+    def names(self):
+        return list(self.queues) + list(self.patterns.patterns)
+
+    def get(self, queue):
+        subs = self.queues.get(queue, ())
+        if not self.patterns:
+            return subs
+
+        matched = self.patterns.match(queue)
+        if not matched:
+            return subs
+        elif not subs:
+            return matched
+
+        return matched.union(subs)
+
+
+class Upstream(object):
+    """
+    Keeps the connection to CoreMQ subscribed to exactly the queues and patterns that browsers are subscribed to, so
+    the bridge is only sent messages someone will receive. Changes made in the same event loop iteration are sent
+    together, and everything is subscribed again after reconnecting.
+    """
+    def __init__(self, index):
+        self.index = index
+        self.connection = None
+        self.changes = dict()  # queue name to True to subscribe or False to unsubscribe
+        self.flush_scheduled = False
+        index.listener = self
+
+    def queue_added(self, queue):
+        self.change(queue, True)
+
+    def queue_removed(self, queue):
+        self.change(queue, False)
+
+    def change(self, queue, subscribe):
+        if self.connection is None:
+            return
+
+        self.changes[queue] = subscribe
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            get_event_loop().call_soon(self.flush)
+
+    def flush(self):
+        self.flush_scheduled = False
+        changes, self.changes = self.changes, dict()
+        if self.connection is None:
+            return
+
+        removed = [q for q, subscribe in changes.items() if not subscribe]
+        if removed:
+            self.connection.send_message(self.connection.uuid, dict(coremq_unsubscribe=removed))
+
+        added = [q for q, subscribe in changes.items() if subscribe]
+        if added:
+            self.connection.send_message(self.connection.uuid, dict(coremq_subscribe=added))
+
+    def connected(self, connection):
+        self.connection = connection
+        self.changes.clear()
+        queues = self.index.names()
+        if queues:
+            connection.send_message(connection.uuid, dict(coremq_subscribe=queues))
+
+    def disconnected(self, connection):
+        if self.connection is connection:
+            self.connection = None
+
+
+class LeveledDeflate(PerMessageDeflate):
+    """
+    permessage-deflate with a configurable compression level. Autobahn always compresses at the zlib default.
+    CoreWS is only ever the server side of a WebSocket.
+    """
+    compress_level = zlib.Z_DEFAULT_COMPRESSION
+
+    def start_compress_message(self):
+        if self._compressor is None or self.server_no_context_takeover:
+            self._compressor = zlib.compressobj(
+                self.compress_level, zlib.DEFLATED, -self.server_max_window_bits, self.mem_level
+            )
+
+
+def accept_deflate(offers):
+    """
+    Accepts the browser's first permessage-deflate offer, see ServerState.context_takeover
+    """
+    for offer in offers:
+        if isinstance(offer, PerMessageDeflateOffer):
+            no_context_takeover = None if ServerState.context_takeover else True
+            return PerMessageDeflateOfferAccept(offer, no_context_takeover=no_context_takeover)
+
+
+def flush_connections():
+    ServerState.flush_scheduled = False
+    connections, ServerState.flushing = ServerState.flushing, set()
+    for ws in connections:
+        ws.flush()
 
 
 class ServerState(object):
     connections = dict()
+    subscribers = SubscriptionIndex()  # queue name to subscribed WebSockets
+    upstream = Upstream(subscribers)
     logger = None
     mq_connection = None
+    flush_interval = 0  # seconds messages wait to be sent together in one frame, 0 sends each one right away
+    flush_bytes = 64 * 1024  # a connection's messages are sent early once this many bytes are waiting
+    flushing = set()  # connections with messages waiting for the next flush
+    flush_scheduled = False
+    compression = COMPRESSION_NONE
+    compression_level = zlib.Z_DEFAULT_COMPRESSION
+    context_takeover = True  # False compresses every frame on its own, using less memory per connection
+    codec = JSON_CODEC  # used with CoreMQ, and for the messages the bridge sends binary browsers itself
 
 
 class WsProtocol(WebSocketServerProtocol):
@@ -45,47 +208,145 @@ class WsProtocol(WebSocketServerProtocol):
 
         self.request = None
         self.uuid = str(uuid.uuid4())
-        self.subscriptions = [self.uuid]
+        self.subscriptions = set()  # queue names and patterns, the connection ID is added once the socket is open
+        self.binary = False  # True if the browser asked for BINARY_SUBPROTOCOL
+        self.pending = []  # encoded messages waiting for the next flush
+        self.pending_size = 0
         ServerState.connections[self.uuid] = self
 
+    def is_subscribed(self, queue):
+        return self in ServerState.subscribers.get(queue)
+
+    def subscribe(self, queue):
+        if queue not in self.subscriptions:
+            self.subscriptions.add(queue)
+            ServerState.subscribers.add(queue, self)
+
+    def unsubscribe(self, queue):
+        if queue in self.subscriptions:
+            self.subscriptions.discard(queue)
+            ServerState.subscribers.discard(queue, self)
+
+    def send(self, payload):
+        """
+        Sends an encoded message, or adds it to the messages waiting for the next flush when flush_interval is set
+        :param payload: bytes from JSON_CODEC.dumps, or a version 2 frame for binary connections
+        """
+        if not ServerState.flush_interval:
+            self.sendMessage(payload, self.binary)
+            return
+
+        self.pending.append(payload)
+        self.pending_size += len(payload)
+        if self.pending_size >= ServerState.flush_bytes:
+            ServerState.flushing.discard(self)
+            self.flush()
+            return
+
+        ServerState.flushing.add(self)
+        if not ServerState.flush_scheduled:
+            ServerState.flush_scheduled = True
+            get_event_loop().call_later(ServerState.flush_interval, flush_connections)
+
+    def flush(self):
+        """
+        Sends the waiting messages, several of them together in one frame as a JSON array, or back to back for binary
+        connections, since version 2 frames carry their own lengths
+        """
+        pending = self.pending
+        if not pending:
+            return
+
+        self.pending = []
+        self.pending_size = 0
+        if self.state != self.STATE_OPEN:
+            return
+
+        if self.binary:
+            self.sendMessage(b''.join(pending), True)
+        elif len(pending) == 1:
+            self.sendMessage(pending[0])
+        else:
+            self.sendMessage(b''.join((b'[', b','.join(pending), b']')))
+
+    def reply(self, message, queue=None):
+        """
+        Sends a message from the bridge itself, or an answer from CoreMQ, in the format of the connection. Binary
+        connections receive it on their own queue.
+        :param message: dict
+        :param queue: Optional queue name added to JSON messages
+        """
+        if self.binary:
+            self.send(construct_message(self.uuid, message, PROTOCOL_V2, ServerState.codec))
+            return
+
+        if queue is not None:
+            message['queue'] = queue
+
+        self.send(JSON_CODEC.dumps(message))
+
     def onConnect(self, request):
         self.request = request
-        ServerState.logger.info('Connections: %s' % len(ServerState.connections))
+        ServerState.logger.info('Connections: %s', len(ServerState.connections))
+
+        if BINARY_SUBPROTOCOL in request.protocols:
+            self.binary = True
+            return BINARY_SUBPROTOCOL
 
     def onOpen(self):
-        pass
+        self.subscribe(self.uuid)
 
     def onMessage(self, payload, isBinary):
         ServerState.logger.debug(payload)
-        message = json.loads(payload.decode('utf-8'))
 
         if isBinary:
-            self.sendMessage(payload, isBinary)
+            self.publish_frames(payload)
             return
 
-        if 'coremq_subscribe' in message:
-            queues = message['coremq_subscribe']
+        message = JSON_CODEC.loads(payload)
+
+        if 'coremq_subscribe' in message or 'coremq_unsubscribe' in message:
+            subscribe = 'coremq_subscribe' in message
+            queues = message['coremq_subscribe' if subscribe else 'coremq_unsubscribe']
             if not queues:
-                self.sendMessage(json.dumps(dict(error='No queues found')))
+                self.reply(dict(error='No queues found'))
                 return
             elif not isinstance(queues, (list, tuple)):
                 queues = [queues]
 
+            try:
+                for q in queues:
+                    validate_queue(q)
+                    if is_pattern(q):
+                        validate_pattern(q)
+            except ValueError as ex:
+                self.reply(dict(error=str(ex)))
+                return
+
             for q in queues:
-                if q not in self.subscriptions:
-                    self.subscriptions.append(q)
+                if subscribe:
+                    self.subscribe(q)
+                elif q != self.uuid:
+                    self.unsubscribe(q)
+        elif 'coremq_batch' in message:
+            if ServerState.mq_connection:
+                ServerState.mq_connection.send_message(
+                    ServerState.mq_connection.uuid, dict(coremq_batch=message['coremq_batch'], coremq_fwdto=self.uuid)
+                )
+            else:
+                self.reply(dict(error='Not connected to CoreMQ'))
         elif 'corews_status' in message:
             mq_server = None
             if ServerState.mq_connection:
                 mq_server = ServerState.mq_connection.factory.connected_server
 
-            self.sendMessage(json.dumps(dict(
+            self.reply(dict(
                 connections=len(ServerState.connections),
                 mq_server=mq_server
-            )))
+            ))
         else:
             if 'queue' not in message:
-                self.sendMessage(json.dumps(dict(error='Command not recognized')))
+                self.reply(dict(error='Command not recognized'))
             else:
                 queue = message['queue']
                 del message['queue']
@@ -93,41 +354,132 @@ class WsProtocol(WebSocketServerProtocol):
                 if ServerState.mq_connection:
                     ServerState.mq_connection.send_message(queue, message)
                 else:
-                    self.sendMessage(json.dumps(dict(error='Not connected to CoreMQ')))
+                    self.reply(dict(error='Not connected to CoreMQ'))
+
+    def publish_frames(self, payload):
+        """
+        Publishes the messages in a binary WebSocket message, which holds one or more version 2 frames. Each frame names
+        its queue and the codec its message was encoded with, such as msgpack.
+        """
+        parser = FrameParser()
+        try:
+            frames = parser.feed(payload)
+            if parser.buffer:
+                raise ProtocolError('Incomplete frame')
+
+            messages = []
+            for queue, data, flags in frames:
+                validate_queue(queue)
+                message = decode_message(data, flags) if data is not None else None
+                if not isinstance(message, dict):
+                    raise ValueError('Message must be a dictionary')
+
+                messages.append((queue, message))
+        except Exception as ex:
+            self.reply(dict(error=str(ex)))
+            return
+
+        if not ServerState.mq_connection:
+            self.reply(dict(error='Not connected to CoreMQ'))
+            return
+
+        for queue, message in messages:
+            message['coremq_fwdto'] = self.uuid
+            ServerState.mq_connection.send_message(queue, message)
 
     def onClose(self, wasClean, code, reason):
         if self.uuid in ServerState.connections:
             del ServerState.connections[self.uuid]
 
-        ServerState.logger.info('Connections: %s' % len(ServerState.connections))
+        for q in list(self.subscriptions):
+            self.unsubscribe(q)
+
+        ServerState.flushing.discard(self)
+        self.pending = []
+
+        ServerState.logger.info('Connections: %s', len(ServerState.connections))
 
 
 class WsMqClient(CoreMqClientProtocol):
-    def begin_replication(self, server_name):
-        self.send_message(self.uuid, dict(coremq_replicant=server_name))
+    def __init__(self, *args, **kwargs):
+        super(WsMqClient, self).__init__(*args, **kwargs)
+        self.connected_future.add_done_callback(self.connected)
+
+    def connected(self, future):
+        ServerState.mq_connection = self
+        ServerState.upstream.connected(self)
+
+    def connection_lost(self, exc):
+        if ServerState.mq_connection is self:
+            ServerState.mq_connection = None
+        ServerState.upstream.disconnected(self)
+        super(WsMqClient, self).connection_lost(exc)
+
+    def frame_received(self, queue, data, flags=0):
+        if queue == self.uuid or not self.uuid:
+            super(WsMqClient, self).frame_received(queue, data, flags)
+        else:
+            self.deliver(queue, data, flags)
 
     def new_message(self, queue, message):
-        loop = asyncio.get_event_loop()
-
-        # make sure to blackhole any OK responses coming back from begin_replication
-        if queue == self.uuid:
-            if 'response' in message and 'Replication' in message['response']:
-                if not message['response'].startswith('OK:'):
-                    ServerState.logger.error('From replication client: %s' % message['response'])
-                    self.close()
-                    loop.stop()
-                    return
+        if queue != self.uuid:
+            return
+
+        # answers to commands forwarded for a browser carry its connection ID, the rest are to the bridge's own
+        ws = ServerState.connections.get(message.pop('coremq_fwdto', None))
+        if ws is not None:
+            if ws.state == ws.STATE_OPEN:
+                ws.reply(message, ws.uuid)
+        elif message.get('response', '').startswith('ERROR'):
+            ServerState.logger.error('From CoreMQ: %s', message['response'])
+
+    def deliver(self, queue, data, flags):
+        """
+        Sends a message from CoreMQ to the browsers subscribed to its queue. Binary connections receive it as it
+        arrived, in a version 2 frame, so it is only decoded when a JSON connection needs it or it could be an echo.
+        :param queue: The queue name
+        :param data: The encoded message
+        :param flags: The header flags of the frame, which identify the codec
+        """
+        recipients = ServerState.subscribers.get(queue)
+        if not recipients:
+            return
+
+        # messages a browser published through this bridge are not echoed back to it
+        message = None
+        skip = None
+        if self.uuid.encode('utf-8') in data:
+            message = decode_message(data, flags)
+            if message.get('coremq_sender') == self.uuid:
+                skip = message.get('coremq_fwdto')
+
+        # the message is serialized once per format. Unless messages are batched per connection, it is also framed once
+        # per format and the same frame is written to every recipient
+        payloads = dict()
+        prepared = dict()
+        for c in recipients:
+            if c.uuid == skip or c.state != c.STATE_OPEN:
+                continue
+
+            payload = payloads.get(c.binary)
+            if payload is None:
+                if c.binary:
+                    payload = construct_frame(queue, data, PROTOCOL_V2, flags)
                 else:
-                    return
+                    if message is None:
+                        message = decode_message(data, flags)
+                    message['queue'] = queue
+                    payload = JSON_CODEC.dumps(message)
+                payloads[c.binary] = payload
 
-        message['queue'] = queue
+            if ServerState.flush_interval:
+                c.send(payload)
+                continue
 
-        for i, c in ServerState.connections.items():
-            if queue in c.subscriptions:
-                if 'coremq_sender' in message and message['coremq_sender'] == self.uuid and\
-                        'coremq_fwdto' in message and message['coremq_fwdto'] == i:
-                    continue
-                c.sendMessage(json.dumps(message))
+            if c.binary not in prepared:
+                prepared[c.binary] = c.factory.prepareMessage(payload, c.binary)
+
+            c.sendPreparedMessage(prepared[c.binary])
 
 
 def main():
@@ -136,32 +488,43 @@ def main():
     address = config.get('CoreWS', 'address', '0.0.0.0')
     port = int(config.get('CoreWS', 'port', '9000'))
     mq_servers = comma_string_to_list(config.get('CoreMQ', 'cluster_nodes', '').split(','))
+    ServerState.flush_interval = float(config.get('CoreWS', 'flush_interval', '0'))
+    ServerState.flush_bytes = int(config.get('CoreWS', 'flush_bytes', str(ServerState.flush_bytes)))
+    ServerState.compression = config.get('CoreWS', 'compression', COMPRESSION_NONE)
+    ServerState.compression_level = int(config.get('CoreWS', 'compression_level', str(ServerState.compression_level)))
+    ServerState.context_takeover = config.get('CoreWS', 'compression_context_takeover', 'yes').lower() in (
+        'yes', 'true', 'on', '1'
+    )
+    ServerState.codec = get_codec(config.get('CoreWS', 'codec', JSON_CODEC.name))
 
     ServerState.logger.info('CoreWS Starting up...')
+    event_loop = install_event_loop(config.get('CoreWS', 'event_loop', 'asyncio'))
+    ServerState.logger.info('Event loop: %s', event_loop)
     ws_factory = WebSocketServerFactory('ws://%s:%s/ws' % (address, port))
     ws_factory.protocol = WsProtocol
 
-    loop = asyncio.get_event_loop()
+    if ServerState.compression == COMPRESSION_DEFLATE:
+        LeveledDeflate.compress_level = ServerState.compression_level
+        extension = PERMESSAGE_COMPRESSION_EXTENSION[PerMessageDeflate.EXTENSION_NAME]
+        PERMESSAGE_COMPRESSION_EXTENSION[PerMessageDeflate.EXTENSION_NAME] = dict(extension, PMCE=LeveledDeflate)
+        ws_factory.setProtocolOptions(perMessageCompressionAccept=accept_deflate)
+    elif ServerState.compression != COMPRESSION_NONE:
+        raise ValueError('Unknown compression: %s' % ServerState.compression)
+
+    loop = get_event_loop()
     server_coro = loop.create_server(ws_factory, address, port)
     server = loop.run_until_complete(server_coro)
     ServerState.logger.info('WebSocket Server running')
 
-    mq_factory = CoreMqClientFactory(WsMqClient, mq_servers, loop=loop)
+    mq_factory = CoreMqClientFactory(WsMqClient, mq_servers, loop=loop, codec=ServerState.codec.name)
 
-    @asyncio.coroutine
-    def connect(*args):
-        ServerState.mq_connection = None
+    async def connect(*args):
         while True:
-            yield asyncio.From(mq_factory.connect())
+            await mq_factory.connect()
             if not mq_factory.connection:
-                ServerState.logger.warn('No CoreMQ servers found. Retrying in 3 seconds...')
-                yield asyncio.From(asyncio.sleep(3))
+                ServerState.logger.warning('No CoreMQ servers found. Retrying in 3 seconds...')
+                await asyncio.sleep(3)
             else:
-                conn = mq_factory.connection[1]
-                conn.connected_future.add_done_callback(
-                    lambda _: conn.begin_replication('%s:%s' % (socket.gethostname(), port))
-                )
-                ServerState.mq_connection = conn
                 break
 
     mq_factory.lost_connection_callback = connect
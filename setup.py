@@ -21,24 +21,28 @@ setup(
         'Intended Audience :: Developers',
         'License :: OSI Approved :: MIT License',
         'Operating System :: OS Independent',
-        'Programming Language :: Python :: 2',
-        'Programming Language :: Python :: 2.7',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.4'
+        'Programming Language :: Python :: 3.5',
         'Topic :: Utilities',
         'Topic :: Software Development :: Libraries',
     ],
     keywords='message queue web socket websocket websockets',
-    description='Message queue and WebSocket server implementation using asyncio for Python 2.7+ and 3.4+',
+    description='Message queue and WebSocket server implementation using asyncio for Python 3.5+',
     download_url='https://github.com/deejross/coremq/archive/master.tar.gz',
     install_requires=[
-        'trollius',
         'autobahn[asyncio]'
     ],
+    extras_require={
+        'orjson': ['orjson'],
+        'msgpack': ['msgpack'],
+        'benchmark': ['psutil'],
+        'uvloop': ['uvloop'],
+    },
     license='MIT',
     long_description=open(os.path.join(CURRENT_DIR, 'README.rst')).read(),
     name='coremq',
     packages=['coremq'],
+    python_requires='>=3.5',
     url='https://github.com/deejross/coremq/',
     version='1.0.0'
 )
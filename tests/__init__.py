@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the servers import their modules as siblings, like they do when run as scripts
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'coremq'))
@@ -0,0 +1,69 @@
+import asyncio
+import unittest
+
+from admission import AdmissionLimiter
+
+
+class AdmissionLimiterTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.admitted = []
+
+    def tearDown(self):
+        asyncio.set_event_loop(None)
+        self.loop.close()
+
+    def callback(self, name):
+        return lambda: self.admitted.append(name)
+
+    def test_no_rate_admits_everything(self):
+        limiter = AdmissionLimiter()
+        for i in range(100):
+            self.assertTrue(limiter.admit(self.callback(i)))
+
+        self.assertEqual(len(self.admitted), 100)
+
+    def test_connections_over_the_burst_wait(self):
+        limiter = AdmissionLimiter(rate=20, burst=2)
+        self.assertTrue(limiter.admit(self.callback('a')))
+        self.assertTrue(limiter.admit(self.callback('b')))
+        self.assertFalse(limiter.admit(self.callback('c')))
+        self.assertFalse(limiter.admit(self.callback('d')))
+        self.assertEqual(self.admitted, ['a', 'b'])
+        self.assertEqual(len(limiter), 2)
+
+        # one token every 50 ms
+        self.loop.run_until_complete(asyncio.sleep(0.07))
+        self.assertEqual(self.admitted, ['a', 'b', 'c'])
+        self.loop.run_until_complete(asyncio.sleep(0.07))
+        self.assertEqual(self.admitted, ['a', 'b', 'c', 'd'])
+        self.assertEqual(len(limiter), 0)
+
+    def test_refill_is_capped_at_burst(self):
+        limiter = AdmissionLimiter(rate=10, burst=3)
+        limiter.tokens = 0
+        limiter.updated -= 60
+        limiter.refill()
+        self.assertEqual(limiter.tokens, 3)
+
+        limiter.tokens = 0
+        limiter.updated -= 0.15
+        limiter.refill()
+        self.assertAlmostEqual(limiter.tokens, 1.5, places=1)
+
+    def test_cancelled_connection_is_not_admitted(self):
+        limiter = AdmissionLimiter(rate=20, burst=1)
+        limiter.admit(self.callback('a'))
+        waiting = self.callback('b')
+        self.assertFalse(limiter.admit(waiting))
+        limiter.cancel(waiting)
+        limiter.cancel(waiting)
+
+        self.loop.run_until_complete(asyncio.sleep(0.07))
+        self.assertEqual(self.admitted, ['a'])
+        self.assertEqual(len(limiter), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
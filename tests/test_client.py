@@ -0,0 +1,29 @@
+import socket
+import unittest
+
+from coremq import MessageQueue
+from common import construct_message
+
+
+class MessageQueueTest(unittest.TestCase):
+    def test_window_must_be_positive(self):
+        with self.assertRaises(ValueError):
+            MessageQueue('127.0.0.1', window=0)
+
+        self.assertEqual(MessageQueue('127.0.0.1', window=1).window, 1)
+
+    def test_command_response_skips_subscription_traffic(self):
+        mq = MessageQueue('127.0.0.1')
+        mq.socket, server = socket.socketpair()
+        mq.connection_id = 'c1'
+        try:
+            server.sendall(construct_message('news', {'n': 1}) + construct_message('c1', {'response': 'OK'}))
+            self.assertEqual(mq._command(dict(coremq_subscribe=['news'])), ('c1', {'response': 'OK'}))
+            self.assertEqual(mq.get_message(), ('news', {'n': 1}))
+        finally:
+            mq.close()
+            server.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
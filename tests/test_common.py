@@ -0,0 +1,64 @@
+import socket
+import unittest
+
+from common import ConnectionClosed, FrameParser, ProtocolError, construct_message, get_message, PROTOCOL_V2
+
+
+class FrameParserTest(unittest.TestCase):
+    def assert_rejected(self, data):
+        parser = FrameParser()
+        with self.assertRaises(ProtocolError):
+            parser.feed(data)
+
+        # nothing from the bad data is delivered later
+        self.assertEqual(parser.feed(b'+3 a b'), [('a', b'b', 0)])
+
+    def test_frames_split_across_chunks(self):
+        parser = FrameParser()
+        self.assertEqual(parser.feed(b'+6 q ab'), [])
+        self.assertEqual(parser.feed(b'cd+3 a b'), [('q', b'abcd', 0), ('a', b'b', 0)])
+
+    def test_negative_length(self):
+        self.assert_rejected(b'+-4 q ')
+
+    def test_length_with_sign_or_separator(self):
+        self.assert_rejected(b'+ 4 qqqq')
+        self.assert_rejected(b'+1_0 qqqqqqqqqq')
+
+    def test_queue_name_not_utf8(self):
+        self.assert_rejected(b'+4 q x+5 \xff\xfe ab')
+        self.assert_rejected(b'\x02\x00\x00\x02\x00\x00\x00\x01\xff\xfeX')
+
+
+
+class GetMessageTest(unittest.TestCase):
+    def setUp(self):
+        self.reader, self.writer = socket.socketpair()
+
+    def tearDown(self):
+        self.reader.close()
+        self.writer.close()
+
+    def test_frames_sent_together(self):
+        self.writer.sendall(construct_message('a', {'n': 1}) + construct_message('b', {'n': 2}, PROTOCOL_V2) + b'+2 OK')
+        self.assertEqual(get_message(self.reader), ('a', {'n': 1}))
+        self.assertEqual(get_message(self.reader), ('b', {'n': 2}))
+        self.assertEqual(get_message(self.reader), (None, 'OK'))
+
+    def test_frame_split_across_reads(self):
+        frame = construct_message('q', {'text': 'hello'})
+        self.writer.sendall(frame[:4])
+        with self.assertRaises(socket.timeout):
+            get_message(self.reader, timeout=0.05)
+
+        self.writer.sendall(frame[4:])
+        self.assertEqual(get_message(self.reader), ('q', {'text': 'hello'}))
+
+    def test_closed(self):
+        self.writer.close()
+        with self.assertRaises(ConnectionClosed):
+            get_message(self.reader)
+
+
+if __name__ == '__main__':
+    unittest.main()
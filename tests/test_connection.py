@@ -0,0 +1,133 @@
+import asyncio
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+from coremq import Connection
+from coremq.common import ResponseError
+
+SERVER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'coremq', 'aio_server.py')
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class ConnectionTest(unittest.TestCase):
+    """
+    Runs a broker in a subprocess for each test
+    """
+    def setUp(self):
+        self.port = free_port()
+        self.directory = tempfile.mkdtemp()
+        with open(os.path.join(self.directory, 'coremq.conf'), 'w') as f:
+            f.write('[CoreMQ]\naddress = 127.0.0.1\nport = %s\nlog_level = WARN\n' % self.port)
+
+        self.server = subprocess.Popen([sys.executable, SERVER], cwd=self.directory,
+                                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        deadline = time.time() + 10
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', self.port), 0.5).close()
+                break
+            except socket.error:
+                if time.time() > deadline:
+                    raise
+                time.sleep(0.05)
+
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+        self.server.kill()
+        self.server.wait()
+        shutil.rmtree(self.directory)
+
+    def run_async(self, coro, timeout=30):
+        return self.loop.run_until_complete(asyncio.wait_for(coro, timeout))
+
+    def test_serve_and_reply_under_load(self):
+        async def main():
+            async with Connection('127.0.0.1', port=self.port) as responder, \
+                    Connection('127.0.0.1', port=self.port) as requester:
+                async def serve():
+                    async for queue, request in responder.serve('calc'):
+                        await responder.reply(request, dict(result=request['a'] + 1))
+
+                task = asyncio.ensure_future(serve())
+                await asyncio.sleep(0.2)
+
+                results = await asyncio.gather(
+                    *[requester.request('calc', dict(a=i), timeout=20) for i in range(2000)],
+                    return_exceptions=True
+                )
+                task.cancel()
+                return results
+
+        # every request is answered, by the responder or with an error if its subscription was full
+        results = self.run_async(main())
+        replied = 0
+        for i, result in enumerate(results):
+            if isinstance(result, dict):
+                self.assertEqual(result['result'], i + 1)
+                replied += 1
+            else:
+                self.assertIsInstance(result, ResponseError)
+
+        self.assertGreater(replied, 0)
+
+    def test_full_responder_rejects_requests(self):
+        async def main():
+            async with Connection('127.0.0.1', port=self.port) as responder, \
+                    Connection('127.0.0.1', port=self.port) as requester:
+                sub = responder.serve('calc', maxsize=5)
+                await asyncio.sleep(0.2)
+
+                results = await asyncio.gather(
+                    *[requester.request('calc', dict(a=i), timeout=10) for i in range(20)],
+                    return_exceptions=True
+                )
+                return sub, results
+
+        sub, results = self.run_async(main())
+        self.assertEqual(len(sub), 5)
+        self.assertEqual(sub.dropped, 15)
+        self.assertEqual(sum(1 for r in results if isinstance(r, ResponseError)), 15)
+
+    def test_publish_inside_full_subscription(self):
+        async def main():
+            async with Connection('127.0.0.1', port=self.port) as consumer, \
+                    Connection('127.0.0.1', port=self.port) as producer:
+                sub = consumer.subscribe('news', maxsize=10)
+                await asyncio.sleep(0.2)
+                await producer.publish_many(('news', dict(i=i)) for i in range(100))
+                await asyncio.sleep(0.5)
+
+                seen = []
+                async for queue, message in sub:
+                    # acknowledgements still arrive while the subscription is full
+                    await consumer.publish('echo', message)
+                    seen.append(message['i'])
+                    if not len(sub):
+                        break
+
+                return sub, seen
+
+        sub, seen = self.run_async(main())
+        self.assertEqual(seen, list(range(90, 100)))
+        self.assertEqual(sub.dropped, 90)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+import time
+import unittest
+
+from history import HistorySettings, HistoryStore
+
+
+class HistorySettingsPatternTest(unittest.TestCase):
+    def setUp(self):
+        self.store = HistoryStore(HistorySettings(depth=10))
+        self.one = HistorySettings(depth=1)
+        self.many = HistorySettings(depth=2)
+
+    def test_patterns_match_like_subscriptions(self):
+        self.store.set_settings('orders.*', self.one)
+        self.store.set_settings('tmp.#', self.many)
+
+        self.assertIs(self.store.settings_for('orders.eu'), self.one)
+        self.assertIs(self.store.settings_for('orders.eu.42'), self.store.default)
+        self.assertIs(self.store.settings_for('orders'), self.store.default)
+        self.assertIs(self.store.settings_for('tmp'), self.many)
+        self.assertIs(self.store.settings_for('tmp.a.b'), self.many)
+
+    def test_exact_queue_name(self):
+        self.store.set_settings('orders', self.one)
+        self.assertIs(self.store.settings_for('orders'), self.one)
+        self.assertIs(self.store.settings_for('orders.eu'), self.store.default)
+
+    def test_invalid_pattern(self):
+        with self.assertRaises(ValueError):
+            self.store.set_settings('orders.#.eu', self.one)
+
+
+
+class HistoryStoreLimitsTest(unittest.TestCase):
+    def test_budget_evicts_least_recently_used_queue(self):
+        store = HistoryStore(HistorySettings(depth=10), budget=250)
+        store.append('a', b'a', 100)
+        store.append('b', b'b', 100)
+        self.assertEqual(store.get('a'), [b'a'])
+
+        store.append('c', b'c', 100)
+        self.assertEqual(list(store.keys()), ['a', 'c'])
+        self.assertEqual(store.size, 200)
+        self.assertEqual(store.get('b'), [])
+
+    def test_budget_keeps_the_last_queue(self):
+        store = HistoryStore(HistorySettings(depth=10), budget=50)
+        store.append('a', b'a', 100)
+        store.append('a', b'b', 100)
+        self.assertEqual(store.get('a'), [b'a', b'b'])
+        self.assertEqual(store.size, 200)
+
+    def test_max_age_prunes_old_messages(self):
+        store = HistoryStore(HistorySettings(depth=10, max_age=60))
+        now = time.time()
+        store.append('a', b'old', 100, now - 120)
+        store.append('a', b'new', 100, now)
+        self.assertEqual(store.get('a'), [b'new'])
+        self.assertEqual(store.size, 100)
+
+        store.append('b', b'old', 100, now - 120)
+        self.assertEqual(store.get('b'), [])
+        self.assertNotIn('b', store)
+
+
+if __name__ == '__main__':
+    unittest.main()
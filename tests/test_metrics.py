@@ -0,0 +1,60 @@
+import unittest
+
+from metrics import Metrics, OTHER_QUEUES
+
+
+class PrometheusTest(unittest.TestCase):
+    def setUp(self):
+        self.metrics = Metrics()
+        self.metrics.publish('orders', 10)
+        self.metrics.deliver('orders', 2, 20, 0.002)
+        self.metrics.dropped = 1
+
+    def render(self, gauges=None, labels=None):
+        text = self.metrics.prometheus(gauges, labels)
+        self.assertTrue(text.endswith('\n'))
+        return text.splitlines()
+
+    def test_counters(self):
+        lines = self.render()
+        self.assertIn('# TYPE coremq_published_messages_total counter', lines)
+        self.assertIn('coremq_published_messages_total{queue="orders"} 1', lines)
+        self.assertIn('coremq_delivered_bytes_total{queue="orders"} 20', lines)
+        self.assertIn('coremq_dropped_messages_total 1', lines)
+
+    def test_histogram_buckets_are_cumulative(self):
+        lines = self.render()
+        self.assertIn('# TYPE coremq_fanout histogram', lines)
+        self.assertIn('coremq_fanout_bucket{le="1"} 0', lines)
+        self.assertIn('coremq_fanout_bucket{le="2"} 1', lines)
+        self.assertIn('coremq_fanout_bucket{le="+Inf"} 1', lines)
+        self.assertIn('coremq_fanout_sum 2', lines)
+        self.assertIn('coremq_fanout_count 1', lines)
+        self.assertIn('coremq_delivery_latency_seconds_bucket{le="0.001"} 0', lines)
+        self.assertIn('coremq_delivery_latency_seconds_bucket{le="0.0025"} 1', lines)
+
+    def test_labels_are_added_and_escaped(self):
+        self.metrics.publish('a"b\\c', 1)
+        lines = self.render(labels=dict(worker=0))
+        self.assertIn('coremq_published_messages_total{queue="orders",worker="0"} 1', lines)
+        self.assertIn('coremq_published_messages_total{queue="a\\"b\\\\c",worker="0"} 1', lines)
+        self.assertIn('coremq_dropped_messages_total{worker="0"} 1', lines)
+
+    def test_only_numeric_gauges(self):
+        lines = self.render(gauges=dict(connections=3, name='x', replicating=True))
+        self.assertIn('# TYPE coremq_connections gauge', lines)
+        self.assertIn('coremq_connections 3', lines)
+        self.assertFalse([line for line in lines if 'coremq_name' in line or 'coremq_replicating' in line])
+
+    def test_queues_beyond_max_queues_are_grouped(self):
+        metrics = Metrics(max_queues=1)
+        metrics.publish('a', 1)
+        metrics.publish('b', 1)
+        metrics.publish('c', 1)
+        lines = metrics.prometheus().splitlines()
+        self.assertIn('coremq_published_messages_total{queue="a"} 1', lines)
+        self.assertIn('coremq_published_messages_total{queue="%s"} 2' % OTHER_QUEUES, lines)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+import json
+import unittest
+
+from common import FrameParser, decode_message, PROTOCOL_V2
+from replication import DedupCache, MessageIds, UpstreamBatcher
+
+
+class FakeMaster(object):
+    protocol_version = PROTOCOL_V2
+
+    def __init__(self):
+        self.uuid = 'master'
+        self.parser = FrameParser()
+        self.received = []
+
+    def write(self, data):
+        for queue, payload, flags in self.parser.feed(data):
+            self.received.extend(decode_message(payload, flags)['coremq_replication'])
+
+
+class UpstreamBatcherTest(unittest.TestCase):
+    def append(self, batcher, *queues):
+        for q in queues:
+            batcher.append(q, None, json.dumps(dict(q=q)).encode('utf-8'))
+
+    def test_unacknowledged_entries_are_resent(self):
+        batcher = UpstreamBatcher(batch_bytes=1)
+        first = FakeMaster()
+        batcher.attach(first)
+        self.append(batcher, 'a', 'b', 'c')
+        self.assertEqual([e[0] for e in first.received], [1, 2, 3])
+
+        batcher.acked(1)
+        batcher.detach(first)
+        self.append(batcher, 'd')
+
+        second = FakeMaster()
+        self.assertEqual(batcher.attach(second), 0)
+        self.assertEqual([(e[0], e[1]) for e in second.received], [(2, 'b'), (3, 'c'), (4, 'd')])
+
+        batcher.acked(4)
+        self.assertEqual(len(batcher), 0)
+
+    def test_backlog_is_bounded(self):
+        batcher = UpstreamBatcher(backlog=2)
+        self.append(batcher, 'a', 'b', 'c')
+
+        master = FakeMaster()
+        self.assertEqual(batcher.attach(master), 1)
+        self.assertEqual([e[1] for e in master.received], ['b', 'c'])
+
+
+
+class DedupCacheTest(unittest.TestCase):
+    def test_repeated_ids_are_seen(self):
+        cache = DedupCache(10)
+        self.assertFalse(cache.seen('a'))
+        self.assertTrue(cache.seen('a'))
+        self.assertFalse(cache.seen('b'))
+        self.assertEqual(len(cache), 2)
+
+    def test_oldest_id_is_forgotten_at_size(self):
+        cache = DedupCache(3)
+        for message_id in ('a', 'b', 'c', 'd'):
+            self.assertFalse(cache.seen(message_id))
+
+        self.assertEqual(len(cache), 3)
+        self.assertTrue(cache.seen('b'))
+        self.assertTrue(cache.seen('d'))
+        self.assertFalse(cache.seen('a'))
+
+        # recording 'a' again pushed out 'b', the oldest
+        self.assertFalse(cache.seen('b'))
+
+    def test_size_zero_disables(self):
+        cache = DedupCache(0)
+        self.assertFalse(cache.seen('a'))
+        self.assertFalse(cache.seen('a'))
+        self.assertEqual(len(cache), 0)
+
+    def test_message_ids_differ_between_processes(self):
+        first, second = MessageIds(), MessageIds()
+        ids = [first.next(), first.next(), second.next()]
+        self.assertEqual(len(set(ids)), 3)
+        self.assertEqual(ids[0].split('.')[0], ids[1].split('.')[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+import asyncio
+import logging
+import unittest
+
+from aio_server import CoreMqServerProtocol, ServerState, SLOW_CONSUMER_PAUSE_PUBLISHER
+
+
+class FakeTransport(object):
+    def __init__(self):
+        self.reading = True
+        self.aborted = False
+        self.written = []
+
+    def pause_reading(self):
+        self.reading = False
+
+    def resume_reading(self):
+        self.reading = True
+
+    def write(self, data):
+        self.written.append(data)
+
+    def abort(self):
+        self.aborted = True
+
+    def get_write_buffer_size(self):
+        return 0
+
+
+class SlowConsumerTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.max_write_buffer = ServerState.max_write_buffer
+        ServerState.max_write_buffer = 1000
+        ServerState.logger = ServerState.logger or logging.getLogger('CoreMQ')
+
+    def tearDown(self):
+        ServerState.max_write_buffer = self.max_write_buffer
+        ServerState.publisher = None
+        for conn in list(ServerState.connections.values()):
+            del ServerState.connections[conn.uuid]
+        self.loop.close()
+
+    def connection(self, replicant=False):
+        conn = CoreMqServerProtocol(loop=self.loop)
+        conn.transport = FakeTransport()
+        conn.writing_paused = True
+        conn.is_replicant = replicant
+        conn.options['slow_consumer'] = SLOW_CONSUMER_PAUSE_PUBLISHER
+        return conn
+
+    def test_pauses_publisher(self):
+        consumer = self.connection()
+        publisher = self.connection()
+        ServerState.publisher = publisher
+        for i in range(20):
+            consumer.write(b'x' * 100)
+
+        self.assertFalse(publisher.transport.reading)
+        self.assertEqual(consumer.outbox_size, 2000)
+
+        # reading from the publisher resumes once the consumer catches up
+        consumer.resume_writing()
+        self.assertTrue(publisher.transport.reading)
+        self.assertEqual(len(consumer.transport.written), 20)
+
+    def test_bounded_without_publisher(self):
+        consumer = self.connection()
+        for i in range(100):
+            consumer.write(b'x' * 100)
+
+        self.assertLessEqual(consumer.outbox_size, ServerState.max_write_buffer)
+        self.assertEqual(consumer.dropped, 90)
+
+    def test_bounded_when_publisher_keeps_writing(self):
+        consumer = self.connection()
+        ServerState.publisher = self.connection()
+        for i in range(100):
+            consumer.write(b'x' * 100)
+
+        self.assertLessEqual(consumer.outbox_size, 2 * ServerState.max_write_buffer + 100)
+
+    def test_replicant_disconnected_without_publisher(self):
+        replicant = self.connection(replicant=True)
+        for i in range(20):
+            replicant.write(b'x' * 100)
+
+        self.assertTrue(replicant.transport.aborted)
+        self.assertLessEqual(replicant.outbox_size, ServerState.max_write_buffer)
+
+
+if __name__ == '__main__':
+    unittest.main()
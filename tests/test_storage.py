@@ -0,0 +1,116 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from storage import SegmentLog, RECORD_OVERHEAD
+
+MESSAGE = b'x' * (100 - RECORD_OVERHEAD - 1)  # every record on queue 'q' takes 100 bytes
+
+
+class SegmentLogTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def open(self, **kwargs):
+        log = SegmentLog(self.path, **kwargs)
+        log.open()
+        self.addCleanup(log.close)
+        return log
+
+    def read(self, log, ref):
+        record = log.read(ref)
+        if record is None:
+            return None
+
+        queue, message, timestamp = record
+        return queue, bytes(message)
+
+    def segment_path(self, base):
+        return os.path.join(self.path, '%020d.log' % base)
+
+    def test_torn_tail_is_truncated_on_reopen(self):
+        log = SegmentLog(self.path)
+        log.open()
+        for i in range(3):
+            log.append('q', MESSAGE)
+        log.close()
+
+        with open(self.segment_path(0), 'ab') as f:
+            f.write(b'\x00' * (RECORD_OVERHEAD + 10))
+
+        log = self.open()
+        self.assertEqual(log.next_seq, 3)
+        self.assertEqual(os.path.getsize(self.segment_path(0)), 300)
+
+    def test_corrupt_record_is_truncated_on_reopen(self):
+        log = SegmentLog(self.path)
+        log.open()
+        refs = [log.append('q', MESSAGE)[1] for i in range(3)]
+        log.close()
+
+        with open(self.segment_path(0), 'r+b') as f:
+            f.seek(299)
+            f.write(b'y')
+
+        log = self.open()
+        self.assertEqual(log.next_seq, 2)
+        self.assertEqual(os.path.getsize(self.segment_path(0)), 200)
+        self.assertIsNone(log.read(refs[2]))
+        self.assertEqual(self.read(log, refs[1]), ('q', MESSAGE))
+
+        seq, ref = log.append('q', MESSAGE)
+        self.assertEqual((seq, ref), (2, (0, 200)))
+
+    def test_segments_roll_at_segment_size(self):
+        log = self.open(segment_size=250)
+        refs = [log.append('q', MESSAGE)[1] for i in range(5)]
+
+        self.assertEqual(log.bases, [0, 3])
+        self.assertEqual(refs[2], (0, 200))
+        self.assertEqual(refs[3], (3, 0))
+        for ref in refs:
+            self.assertEqual(self.read(log, ref), ('q', MESSAGE))
+
+    def test_retention_bytes_deletes_oldest_segments(self):
+        log = self.open(segment_size=100, retention_bytes=250)
+        refs = [log.append('q', MESSAGE)[1] for i in range(5)]
+
+        self.assertEqual(log.bases, [2, 3, 4])
+        self.assertFalse(os.path.exists(self.segment_path(0)))
+        self.assertIsNone(log.read(refs[0]))
+        self.assertEqual(self.read(log, refs[4]), ('q', MESSAGE))
+
+    def test_retention_age_deletes_old_segments(self):
+        log = self.open(segment_size=100, retention_age=60)
+        old = time.time() - 120
+        log.append('q', MESSAGE, old)
+        log.append('q', MESSAGE, old)
+        log.append('q', MESSAGE)
+
+        self.assertEqual(log.bases, [2])
+
+    def test_sparse_index_after_restart(self):
+        log = SegmentLog(self.path, index_interval=250)
+        log.open()
+        for i in range(10):
+            log.append('q', MESSAGE + str(i).encode('utf-8'))
+        log.close()
+
+        log = self.open(index_interval=250)
+        self.assertEqual(log.segments[0].index, [(0, 0), (3, 303), (6, 606), (9, 909)])
+
+        records = list(log.scan(5))
+        self.assertEqual([r[0] for r in records], [5, 6, 7, 8, 9])
+        self.assertEqual(records[0][3], (0, 505))
+        self.assertEqual(self.read(log, records[0][3]), ('q', MESSAGE + b'5'))
+
+        self.assertEqual(log.append('q', MESSAGE)[0], 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
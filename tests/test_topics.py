@@ -0,0 +1,61 @@
+import unittest
+
+from topics import matches, TopicTrie
+
+
+class TopicTrieTest(unittest.TestCase):
+    def setUp(self):
+        self.trie = TopicTrie()
+
+    def test_one_level_wildcard(self):
+        self.trie.add('orders.*', 'a')
+        self.trie.add('*.eu', 'b')
+        self.assertEqual(self.trie.match('orders.eu'), frozenset(['a', 'b']))
+        self.assertEqual(self.trie.match('orders.us'), frozenset(['a']))
+        self.assertEqual(self.trie.match('orders'), frozenset())
+        self.assertEqual(self.trie.match('orders.eu.42'), frozenset())
+
+    def test_any_levels_wildcard(self):
+        self.trie.add('orders.#', 'a')
+        self.trie.add('#', 'b')
+        self.assertEqual(self.trie.match('orders'), frozenset(['a', 'b']))
+        self.assertEqual(self.trie.match('orders.eu.42'), frozenset(['a', 'b']))
+        self.assertEqual(self.trie.match('trades'), frozenset(['b']))
+
+    def test_agrees_with_matches(self):
+        patterns = ['a.*', 'a.#', '*.b', '*.*', 'a.*.c', '#', 'a.b']
+        for i, pattern in enumerate(patterns):
+            self.trie.add(pattern, i)
+
+        for topic in ['a', 'b', 'a.b', 'a.c', 'x.b', 'a.b.c', 'a.x.c', 'a.b.d']:
+            expected = frozenset(i for i, p in enumerate(patterns) if matches(p, topic))
+            self.assertEqual(self.trie.match(topic), expected, topic)
+
+    def test_unsubscribe_invalidates_cache(self):
+        self.trie.add('orders.*', 'a')
+        self.trie.add('orders.eu', 'b')
+        self.assertEqual(self.trie.match('orders.eu'), frozenset(['a', 'b']))
+        self.assertEqual(self.trie.match('trades.eu'), frozenset())
+
+        self.assertTrue(self.trie.discard('orders.*', 'a'))
+        self.assertNotIn('orders.eu', self.trie.cache)
+        self.assertIn('trades.eu', self.trie.cache)
+        self.assertEqual(self.trie.match('orders.eu'), frozenset(['b']))
+
+    def test_subscribe_invalidates_cache(self):
+        self.assertEqual(self.trie.match('orders.eu'), frozenset())
+        self.trie.add('orders.#', 'a')
+        self.assertEqual(self.trie.match('orders.eu'), frozenset(['a']))
+
+    def test_pattern_counts(self):
+        self.assertTrue(self.trie.add('orders.*', 'a'))
+        self.assertFalse(self.trie.add('orders.*', 'b'))
+        self.assertFalse(self.trie.add('orders.*', 'b'))
+        self.assertFalse(self.trie.discard('orders.*', 'a'))
+        self.assertTrue(self.trie.discard('orders.*', 'b'))
+        self.assertEqual(len(self.trie), 0)
+        self.assertEqual(self.trie.root.children, dict())
+
+
+if __name__ == '__main__':
+    unittest.main()